@@ -0,0 +1,123 @@
+import logging
+import select
+import threading
+import time
+
+import psycopg2
+from psycopg2 import extensions
+
+logger = logging.getLogger(__name__)
+
+# Канал LISTEN/NOTIFY, в который триггер на таблице admins сообщает об изменениях
+ADMINS_CHANNEL = 'admins_changed'
+
+
+# Множество идентификаторов администраторов в памяти процесса.
+# Загружается один раз и сбрасывается при изменении таблицы admins;
+# ttl ограничивает устаревание, если уведомление об изменении потерялось.
+class AdminCache:
+    def __init__(self, loader, ttl=300.0):
+        self._loader = loader
+        self.ttl = ttl
+        self._ids = None
+        self._loaded_at = 0.0
+        self._version = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.invalidations = 0
+
+    def _is_fresh(self):
+        return self._ids is not None and (not self.ttl or time.monotonic() - self._loaded_at < self.ttl)
+
+    # Проверка без обращения к БД: None, если множество нужно загрузить заново
+    def peek(self, user_id):
+        ids = self._ids
+        if ids is None or not self._is_fresh():
+            return None
+        self.hits += 1
+        return user_id in ids
+
+    def contains(self, user_id):
+        result = self.peek(user_id)
+        if result is not None:
+            return result
+        self.misses += 1
+        return user_id in self._reload()
+
+    def _reload(self):
+        with self._lock:
+            if self._is_fresh():
+                return self._ids
+            version = self._version
+            ids = frozenset(self._loader())
+            # Если во время загрузки пришла инвалидация, результат может быть устаревшим:
+            # используем его для текущей проверки, но не кэшируем
+            if version == self._version:
+                self._ids = ids
+                self._loaded_at = time.monotonic()
+            self.reloads += 1
+            return ids
+
+    def invalidate(self):
+        self._version += 1
+        self._ids = None
+        self.invalidations += 1
+
+    def stats(self):
+        ids = self._ids
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'reloads': self.reloads,
+            'invalidations': self.invalidations,
+            'size': len(ids) if ids is not None else 0,
+            'loaded': ids is not None,
+        }
+
+
+# Фоновый поток, который слушает канал admins_changed на отдельном соединении
+# и сбрасывает кэш, когда таблицу admins меняет любой процесс.
+class AdminChangeListener(threading.Thread):
+    def __init__(self, cache, connect_kwargs, channel=ADMINS_CHANNEL):
+        super().__init__(name='admin-listener', daemon=True)
+        self._cache = cache
+        self._connect_kwargs = connect_kwargs
+        self._channel = channel
+        self._stop_event = threading.Event()
+
+    def run(self):
+        backoff = 1
+        while not self._stop_event.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(**self._connect_kwargs)
+                conn.set_isolation_level(extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                conn.cursor().execute(f"LISTEN {self._channel}")
+                # Пока соединения не было, уведомления могли потеряться
+                self._cache.invalidate()
+                backoff = 1
+                while not self._stop_event.is_set():
+                    if select.select([conn], [], [], 1.0) == ([], [], []):
+                        continue
+                    conn.poll()
+                    if conn.notifies:
+                        conn.notifies.clear()
+                        self._cache.invalidate()
+            except Exception as e:
+                logger.warning(f"Ошибка подписки на изменения администраторов: {e}")
+                self._cache.invalidate()
+                self._stop_event.wait(backoff)
+                backoff = min(backoff * 2, 60)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+    def stop(self, timeout=5):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
@@ -0,0 +1,85 @@
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+import database
+from metrics import DB_DURATION, timed
+from tracing import span
+
+# Загружаем переменные из .env
+load_dotenv()
+
+# Запросы к БД выполняются в отдельных потоках, чтобы не останавливать цикл событий бота.
+# Потоков не больше, чем соединений в пуле: лишние всё равно ждали бы свободное соединение.
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", str(database.DB_POOL_MAX)))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix='db')
+    return _executor
+
+def shutdown_executor(wait=True):
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=wait)
+            _executor = None
+
+# Выполняет синхронную функцию в пуле потоков БД, сохраняя contextvars вызывающей задачи.
+# Каждый вызов — интервал 'db' в трассе обновления, в том числе вызовы в обход обёрток ниже.
+async def run_db(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    with span('db', getattr(func, '__name__', type(func).__name__)):
+        ctx = contextvars.copy_context()
+        return await loop.run_in_executor(get_executor(), functools.partial(ctx.run, func, *args, **kwargs))
+
+# Асинхронная обёртка над функцией из database.py с той же сигнатурой
+def _async(func):
+    @timed(DB_DURATION, func.__name__)
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_db(func, *args, **kwargs)
+    return wrapper
+
+add_admin = _async(database.add_admin)
+remove_admin = _async(database.remove_admin)
+
+# Пока кэш администраторов актуален, проверка выполняется прямо в цикле событий без перехода в поток
+async def is_admin(user_id):
+    result = database.peek_admin(user_id)
+    if result is None:
+        with DB_DURATION.time('is_admin'):
+            result = await run_db(database.is_admin, user_id)
+    return result
+
+save_ticket = _async(database.save_ticket)
+bulk_update_status = _async(database.bulk_update_status)
+save_feedback = _async(database.save_feedback)
+get_ticket_stats = _async(database.get_ticket_stats)
+get_admin_panel_page = _async(database.get_admin_panel_page)
+search_tickets = _async(database.search_tickets)
+get_user_tickets = _async(database.get_user_tickets)
+claim_outbox_batch = _async(database.claim_outbox_batch)
+mark_outbox_sent = _async(database.mark_outbox_sent)
+mark_outbox_retry = _async(database.mark_outbox_retry)
+mark_outbox_failed = _async(database.mark_outbox_failed)
+load_user_data = _async(database.load_user_data)
+get_user_data_row = _async(database.get_user_data_row)
+save_user_data_batch = _async(database.save_user_data_batch)
+schedule_message_deletion = _async(database.schedule_message_deletion)
+get_expired_messages = _async(database.get_expired_messages)
+remove_message_expiry = _async(database.remove_message_expiry)
+create_ticket_partitions = _async(database.create_ticket_partitions)
+archive_resolved_tickets = _async(database.archive_resolved_tickets)
+drop_empty_ticket_partitions = _async(database.drop_empty_ticket_partitions)
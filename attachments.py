@@ -0,0 +1,401 @@
+import asyncio
+import glob
+import hashlib
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+
+import httpx
+from dotenv import load_dotenv
+
+from metrics import ATTACHMENT_DURATION, timed
+from tracing import traced
+
+# Загружаем переменные из .env
+load_dotenv()
+
+# Каталог для вложений заявок; файлы лежат здесь, пока письмо с ними не отправлено
+ATTACHMENTS_DIR = os.path.abspath(os.getenv("ATTACHMENTS_DIR", "attachments"))
+ATTACHMENT_MAX_SIZE = int(os.getenv("ATTACHMENT_MAX_SIZE", str(20 * 1024 * 1024)))                # один файл, байт
+TICKET_ATTACHMENTS_MAX_SIZE = int(os.getenv("TICKET_ATTACHMENTS_MAX_SIZE", str(50 * 1024 * 1024)))  # все файлы заявки, байт
+ATTACHMENTS_DIR_MAX_SIZE = int(os.getenv("ATTACHMENTS_DIR_MAX_SIZE", str(1024 * 1024 * 1024)))    # весь каталог, байт
+# Сколько может занимать кэш загруженных файлов; сверх этого вытесняются файлы, не нужные ни одной заявке, байт
+ATTACHMENT_CACHE_MAX_SIZE = int(os.getenv("ATTACHMENT_CACHE_MAX_SIZE", str(512 * 1024 * 1024)))
+# Файлы моложе этого возраста не удаляются при очистке: их может загружать другой экземпляр, с
+ATTACHMENT_ORPHAN_MIN_AGE = float(os.getenv("ATTACHMENT_ORPHAN_MIN_AGE", "3600"))
+
+# Размер блока при загрузке и чтении файлов
+CHUNK_SIZE = 64 * 1024
+# Незавершённая загрузка
+PARTIAL_SUFFIX = '.part'
+
+logger = logging.getLogger(__name__)
+
+
+# Вложение не помещается в ограничения; текст сообщения можно показать пользователю
+class AttachmentLimitError(Exception):
+    pass
+
+
+# Учёт места, занятого каталогом вложений. Место резервируется до начала загрузки,
+# поэтому одновременные загрузки не могут вместе превысить ограничение.
+class SpoolBudget:
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, size):
+        with self._lock:
+            if self.limit and self.used + size > self.limit:
+                return False
+            self.used += size
+            return True
+
+    def release(self, size):
+        with self._lock:
+            self.used = max(0, self.used - size)
+
+    # Учитывает место, которое уже занято и не может быть отклонено
+    def add(self, size):
+        with self._lock:
+            self.used += size
+
+
+_budget = SpoolBudget(ATTACHMENTS_DIR_MAX_SIZE)
+_client = None
+
+
+# Кэш содержимого вложений. blobs/<sha256> хранит каждый файл один раз,
+# by_uid/<file_unique_id> содержит хэш файла, уже загруженного из Telegram.
+# Вложения заявок — жёсткие ссылки на blob, поэтому число ссылок (st_nlink - 1) служит
+# счётчиком заявок, которые используют файл. Файлы без ссылок остаются в кэше
+# и вытесняются по давности использования, когда кэш превышает квоту.
+class BlobStore:
+    def __init__(self, blobs_dir, aliases_dir, quota):
+        self.blobs_dir = blobs_dir
+        self.aliases_dir = aliases_dir
+        self.quota = quota
+        self.size = 0
+        self._inflight = {}     # file_unique_id -> future загрузки, которую уже кто-то выполняет
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_downloaded = 0
+        self.bytes_saved = 0
+
+    def blob_path(self, digest):
+        return os.path.join(self.blobs_dir, digest)
+
+    def _alias_path(self, unique_id):
+        return os.path.join(self.aliases_dir, _safe_name(unique_id))
+
+    # Путь к уже загруженному файлу или None
+    def lookup(self, unique_id):
+        alias = self._alias_path(unique_id)
+        try:
+            with open(alias) as f:
+                blob = self.blob_path(f.read().strip())
+            # Время изменения служит отметкой последнего использования для вытеснения
+            os.utime(blob)
+            return blob
+        except FileNotFoundError:
+            # Файл вытеснен из кэша — ссылка на него больше не нужна
+            if os.path.exists(alias):
+                os.remove(alias)
+            return None
+
+    # Переносит загруженный файл в кэш. Если файл с таким содержимым уже есть, загрузка удаляется.
+    # Возвращает путь к blob и число байт, добавленных на диск.
+    def add(self, partial, digest, unique_id=None):
+        blob = self.blob_path(digest)
+        if os.path.exists(blob):
+            os.remove(partial)
+            os.utime(blob)
+            added = 0
+        else:
+            os.replace(partial, blob)
+            added = os.path.getsize(blob)
+            self.size += added
+        if unique_id:
+            alias = self._alias_path(unique_id)
+            with open(alias + PARTIAL_SUFFIX, 'w') as f:
+                f.write(digest)
+            os.replace(alias + PARTIAL_SUFFIX, alias)
+        return blob, added
+
+    # Создаёт вложение заявки, ссылающееся на blob. Возвращает число байт, занятых копией,
+    # если файловая система не поддерживает жёсткие ссылки.
+    def link(self, blob, file_path):
+        try:
+            os.link(blob, file_path)
+            return 0
+        except OSError:
+            shutil.copyfile(blob, file_path)
+            return os.path.getsize(file_path)
+
+    # Удаляет давно не использованные файлы без ссылок, пока кэш не уложится в квоту,
+    # а в каталоге не освободится needed байт
+    def evict(self, needed=0):
+        if self.size <= self.quota and (not _budget.limit or _budget.used + needed <= _budget.limit):
+            return 0
+        candidates = []
+        for entry in os.scandir(self.blobs_dir):
+            if entry.name.endswith(PARTIAL_SUFFIX):
+                continue
+            stat = entry.stat()
+            if stat.st_nlink == 1:
+                candidates.append((stat.st_mtime, entry.path, stat.st_size))
+        candidates.sort()
+        freed = 0
+        for _, path, size in candidates:
+            if self.size <= self.quota and (not _budget.limit or _budget.used + needed <= _budget.limit):
+                break
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.error(f"Ошибка при вытеснении {path} из кэша вложений: {e}")
+                continue
+            self.size -= size
+            _budget.release(size)
+            self.evictions += 1
+            freed += size
+        return freed
+
+    # Пересчитывает размер кэша и удаляет прерванные загрузки и ссылки на вытесненные файлы
+    def scan(self):
+        os.makedirs(self.blobs_dir, exist_ok=True)
+        os.makedirs(self.aliases_dir, exist_ok=True)
+        size = 0
+        digests = set()
+        for entry in os.scandir(self.blobs_dir):
+            if entry.name.endswith(PARTIAL_SUFFIX):
+                os.remove(entry.path)
+                continue
+            size += entry.stat().st_size
+            digests.add(entry.name)
+        for entry in os.scandir(self.aliases_dir):
+            try:
+                with open(entry.path) as f:
+                    digest = f.read().strip()
+            except OSError:
+                digest = None
+            if entry.name.endswith(PARTIAL_SUFFIX) or digest not in digests:
+                os.remove(entry.path)
+        self.size = size
+        return size
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'bytes_downloaded': self.bytes_downloaded,
+            'bytes_saved': self.bytes_saved,
+        }
+
+
+_store = BlobStore(
+    os.path.join(ATTACHMENTS_DIR, 'blobs'),
+    os.path.join(ATTACHMENTS_DIR, 'by_uid'),
+    ATTACHMENT_CACHE_MAX_SIZE
+)
+
+def get_cache_stats():
+    return _store.stats()
+
+
+def _get_client():
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(timeout=httpx.Timeout(30.0, read=60.0))
+    return _client
+
+async def close_http_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def _safe_name(file_name):
+    name = os.path.basename(file_name or '') or 'file'
+    return re.sub(r'[^\w.\-]+', '_', name)[:100]
+
+# Имя вложения для письма: без уникального префикса, добавленного при сохранении
+def display_name(file_path):
+    name = os.path.basename(file_path)
+    if os.path.dirname(os.path.abspath(file_path)) == ATTACHMENTS_DIR and re.match(r'^[0-9a-f]{32}_', name):
+        return name[33:]
+    return name
+
+def attachments_size(attachments):
+    total = 0
+    for file_path in attachments or []:
+        try:
+            total += os.path.getsize(file_path)
+        except OSError:
+            pass
+    return total
+
+def _limit_message(size):
+    return f"{size / 1024 / 1024:.1f} МБ"
+
+def _check_limits(size, ticket_size):
+    if size > ATTACHMENT_MAX_SIZE:
+        raise AttachmentLimitError(f"Файл больше {_limit_message(ATTACHMENT_MAX_SIZE)}")
+    if ticket_size + size > TICKET_ATTACHMENTS_MAX_SIZE:
+        raise AttachmentLimitError(f"Вложения заявки не должны превышать {_limit_message(TICKET_ATTACHMENTS_MAX_SIZE)}")
+
+def _copy_and_hash(source, target):
+    digest = hashlib.sha256()
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        while True:
+            chunk = src.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            dst.write(chunk)
+    return digest.hexdigest()
+
+# Загружает файл из Telegram в кэш блоками, не держа его целиком в памяти. Возвращает путь к blob.
+async def _fetch(bot, file_id, ticket_size, unique_id):
+    file = await bot.get_file(file_id)
+    expected = file.file_size or 0
+    _check_limits(expected, ticket_size)
+
+    # Если размер неизвестен, резервируем максимум и возвращаем лишнее после загрузки
+    reserved = expected or ATTACHMENT_MAX_SIZE
+    if not _budget.reserve(reserved):
+        _store.evict(reserved)
+        if not _budget.reserve(reserved):
+            logger.warning(f"Каталог вложений заполнен ({_budget.used} байт), файл {file_id} не загружен")
+            raise AttachmentLimitError("Сервер временно не принимает вложения, попробуйте позже")
+
+    partial = os.path.join(_store.blobs_dir, uuid.uuid4().hex + PARTIAL_SUFFIX)
+    try:
+        if file.file_path.startswith(('http://', 'https://')):
+            limit = min(ATTACHMENT_MAX_SIZE, TICKET_ATTACHMENTS_MAX_SIZE - ticket_size)
+            digest = hashlib.sha256()
+            size = 0
+            async with _get_client().stream('GET', file.file_path) as response:
+                response.raise_for_status()
+                with open(partial, 'wb') as f:
+                    async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                        size += len(chunk)
+                        if size > limit:
+                            raise AttachmentLimitError(f"Файл больше {_limit_message(limit)}")
+                        digest.update(chunk)
+                        f.write(chunk)
+            digest = digest.hexdigest()
+        else:
+            # Локальный Bot API сервер отдаёт путь к файлу на диске
+            digest = await asyncio.to_thread(_copy_and_hash, file.file_path, partial)
+            size = os.path.getsize(partial)
+        blob, added = _store.add(partial, digest, unique_id)
+    except BaseException:
+        _budget.release(reserved)
+        try:
+            os.remove(partial)
+        except OSError:
+            pass
+        raise
+    _budget.release(reserved - added)
+    _store.misses += 1
+    _store.bytes_downloaded += size
+    return blob
+
+# Сохраняет вложение заявки и возвращает путь к нему.
+# Файл, уже загруженный раньше (тот же file_unique_id), повторно из Telegram не загружается.
+# ticket_size — сколько уже занимают вложения этой заявки; file_size — размер из сообщения, если известен.
+@timed(ATTACHMENT_DURATION)
+@traced('download')
+async def download_attachment(bot, file_id, file_name, ticket_size=0, file_unique_id=None, file_size=None):
+    _check_limits(file_size or 0, ticket_size)
+    os.makedirs(_store.blobs_dir, exist_ok=True)
+    os.makedirs(_store.aliases_dir, exist_ok=True)
+
+    blob = None
+    future = None
+    while file_unique_id:
+        blob = _store.lookup(file_unique_id)
+        if blob is not None:
+            break
+        inflight = _store._inflight.get(file_unique_id)
+        if inflight is None:
+            # Загружаем сами; остальные запросы этого файла будут ждать нас
+            future = _store._inflight[file_unique_id] = asyncio.get_running_loop().create_future()
+            break
+        # Тот же файл уже загружается для другого пользователя — дождёмся его.
+        # Если та загрузка не удалась, загрузку начнёт первый проснувшийся, остальные снова ждут
+        await asyncio.shield(inflight)
+    if blob is not None:
+        size = os.path.getsize(blob)
+        _check_limits(size, ticket_size)
+        _store.hits += 1
+        _store.bytes_saved += size
+    else:
+        try:
+            blob = await _fetch(bot, file_id, ticket_size, file_unique_id)
+        finally:
+            if future is not None:
+                if _store._inflight.get(file_unique_id) is future:
+                    del _store._inflight[file_unique_id]
+                future.set_result(None)
+
+    file_path = os.path.join(ATTACHMENTS_DIR, f"{uuid.uuid4().hex}_{_safe_name(file_name)}")
+    copied = _store.link(blob, file_path)
+    if copied:
+        _budget.add(copied)
+    # Вытеснение после создания ссылки: только что загруженный файл уже защищён ею
+    _store.evict()
+    return file_path
+
+def remove_attachments(attachments):
+    for file_path in attachments or []:
+        try:
+            if os.path.exists(file_path):
+                stat = os.stat(file_path)
+                os.remove(file_path)
+                # Место освобождается, только если это была последняя ссылка на содержимое
+                if stat.st_nlink == 1 and os.path.dirname(os.path.abspath(file_path)) == ATTACHMENTS_DIR:
+                    _budget.release(stat.st_size)
+                logger.info(f"Удалён временный файл: {file_path}")
+        except Exception as e:
+            logger.error(f"Ошибка при удалении файла {file_path}: {e}")
+
+# Удаляет при запуске вложения, на которые не ссылаются ни очередь писем, ни незаконченные заявки,
+# а также прерванные загрузки и временные файлы прежних версий бота в рабочем каталоге.
+# Затем пересчитывает занятое место и вытесняет из кэша лишнее.
+def cleanup_orphans(referenced, min_age=ATTACHMENT_ORPHAN_MIN_AGE):
+    referenced = {os.path.abspath(path) for path in referenced}
+    os.makedirs(ATTACHMENTS_DIR, exist_ok=True)
+    candidates = glob.glob(os.path.join(ATTACHMENTS_DIR, '*')) + glob.glob('temp_*')
+    now = time.time()
+    removed = 0
+    used = 0
+    for path in candidates:
+        path = os.path.abspath(path)
+        try:
+            if not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            if path in referenced or now - stat.st_mtime < min_age:
+                # Жёсткие ссылки на кэш места не занимают
+                if os.path.dirname(path) == ATTACHMENTS_DIR and stat.st_nlink == 1:
+                    used += stat.st_size
+                continue
+            os.remove(path)
+            removed += 1
+        except OSError as e:
+            logger.error(f"Ошибка при очистке вложения {path}: {e}")
+    _budget.used = used + _store.scan()
+    _store.evict()
+    if removed:
+        logger.info(f"Удалено забытых вложений: {removed}")
+    return removed
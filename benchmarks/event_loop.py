@@ -0,0 +1,103 @@
+# Бенчмарк: как синхронные запросы к БД в async-обработчиках влияют на задержку остальных пользователей.
+#
+# Имитирует поток обновлений: часть из них «медленные» (долгий запрос к БД), остальные «быстрые».
+# Режим sync вызывает запрос прямо в цикле событий (как было раньше), режим async —
+# через async_db.run_db. Задержка считается от запланированного момента прихода обновления
+# до окончания его обработки.
+#
+# Запуск:
+#   python benchmarks/event_loop.py                 # запросы имитируются через time.sleep
+#   python benchmarks/event_loop.py --db            # настоящие запросы SELECT pg_sleep(...) к БД из .env
+#   python benchmarks/event_loop.py --updates 500 --rate 200 --slow-ratio 0.1 --slow-ms 50
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from async_db import run_db, shutdown_executor  # noqa: E402
+from database import get_connection, close_pool  # noqa: E402
+
+
+def sleep_query(ms):
+    time.sleep(ms / 1000)
+
+def pg_sleep_query(ms):
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT pg_sleep(%s)", (ms / 1000,))
+        conn.rollback()
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+async def handle_update(mode, query, ms, scheduled_at, latencies, kind):
+    if mode == 'sync':
+        query(ms)
+    else:
+        await run_db(query, ms)
+    latencies[kind].append((time.perf_counter() - scheduled_at) * 1000)
+
+async def run(mode, args, query):
+    rnd = random.Random(args.seed)
+    latencies = {'fast': [], 'slow': []}
+    tasks = []
+    interval = 1 / args.rate
+    started = time.perf_counter()
+    for i in range(args.updates):
+        scheduled_at = started + i * interval
+        delay = scheduled_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if rnd.random() < args.slow_ratio:
+            kind, ms = 'slow', args.slow_ms
+        else:
+            kind, ms = 'fast', args.fast_ms
+        tasks.append(asyncio.create_task(handle_update(mode, query, ms, scheduled_at, latencies, kind)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    return latencies, elapsed
+
+def report(mode, latencies, elapsed, updates):
+    print(f"\nРежим: {mode} — {updates} обновлений за {elapsed:.2f} с ({updates / elapsed:.0f} обновлений/с)")
+    print(f"{'тип':<6}{'кол-во':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'max, мс':>10}{'ср., мс':>10}")
+    for kind in ('fast', 'slow'):
+        values = latencies[kind]
+        if not values:
+            continue
+        print(
+            f"{kind:<6}{len(values):>8}"
+            f"{percentile(values, 50):>10.1f}{percentile(values, 95):>10.1f}"
+            f"{percentile(values, 99):>10.1f}{max(values):>10.1f}{statistics.mean(values):>10.1f}"
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description="Задержка обработки обновлений до и после переноса запросов к БД в пул потоков")
+    parser.add_argument('--updates', type=int, default=300, help="количество обновлений")
+    parser.add_argument('--rate', type=float, default=100, help="обновлений в секунду")
+    parser.add_argument('--slow-ratio', type=float, default=0.1, help="доля медленных запросов")
+    parser.add_argument('--slow-ms', type=float, default=50, help="длительность медленного запроса, мс")
+    parser.add_argument('--fast-ms', type=float, default=2, help="длительность быстрого запроса, мс")
+    parser.add_argument('--db', action='store_true', help="выполнять SELECT pg_sleep в настоящей БД")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    query = pg_sleep_query if args.db else sleep_query
+    try:
+        for mode in ('sync', 'async'):
+            latencies, elapsed = asyncio.run(run(mode, args, query))
+            report(mode, latencies, elapsed, args.updates)
+    finally:
+        shutdown_executor()
+        close_pool()
+
+if __name__ == '__main__':
+    main()
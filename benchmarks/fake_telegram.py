@@ -0,0 +1,243 @@
+# Имитация Telegram для локальных проверок и нагрузочных тестов.
+#
+# FakeBotApi — минимальный Bot API сервер: принимает вызовы бота (sendMessage, editMessageText, ...),
+# запоминает их и отвечает правдоподобными объектами. Бот подключается к нему через TELEGRAM_BASE_URL.
+# UpdateSender — отправляет обновления на webhook бота с секретным заголовком, как это делает Telegram.
+#
+# Пример:
+#   python benchmarks/fake_telegram.py serve --port 8081
+#   TELEGRAM_BASE_URL=http://127.0.0.1:8081 BOT_MODE=webhook WEBHOOK_URL=http://127.0.0.1:8080 WEBHOOK_SECRET=S python main.py
+#   python benchmarks/fake_telegram.py send --webhook http://127.0.0.1:8080/telegram --secret S --users 10
+import argparse
+import asyncio
+import itertools
+import json
+import time
+from collections import defaultdict
+
+import aiohttp
+from aiohttp import web
+
+BOT_USER = {'id': 1000000001, 'is_bot': True, 'first_name': 'HelperBot', 'username': 'helper_bot'}
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(100000)
+
+
+def _user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+
+def _chat(chat_id):
+    return {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group'}
+
+def make_message_update(user_id, text=None, **fields):
+    message = {
+        'message_id': next(_message_ids),
+        'date': int(time.time()),
+        'chat': _chat(user_id),
+        'from': _user(user_id),
+    }
+    if text is not None:
+        message['text'] = text
+        if text.startswith('/'):
+            command = text.split()[0]
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+    message.update(fields)
+    return {'update_id': next(_update_ids), 'message': message}
+
+def make_contact_update(user_id, phone_number):
+    return make_message_update(user_id, contact={'phone_number': phone_number, 'first_name': f'User{user_id}', 'user_id': user_id})
+
+def make_photo_update(user_id, file_id, file_unique_id=None, size=1024, media_group_id=None):
+    fields = {'photo': [{'file_id': file_id, 'file_unique_id': file_unique_id or file_id, 'width': 800, 'height': 600, 'file_size': size}]}
+    if media_group_id:
+        fields['media_group_id'] = media_group_id
+    return make_message_update(user_id, **fields)
+
+def make_callback_update(user_id, data, message_id=1):
+    return {
+        'update_id': next(_update_ids),
+        'callback_query': {
+            'id': str(next(_update_ids)),
+            'from': _user(user_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': _chat(user_id),
+                'from': BOT_USER,
+                'text': '...',
+            },
+        },
+    }
+
+
+# Минимальный Bot API сервер
+class FakeBotApi:
+    def __init__(self, file_size=1024, latency=0.0):
+        self.file_size = file_size          # размер файлов, которые отдаёт getFile
+        self.latency = latency              # искусственная задержка ответа, с
+        self.calls = []                     # (время, метод, параметры)
+        self.counts = defaultdict(int)
+        self.updates = asyncio.Queue()      # для getUpdates (режим polling)
+        self._listeners = defaultdict(list) # chat_id -> очереди ожидающих ответа бота
+        self._runner = None
+
+    # Ждать следующего сообщения бота в чате (для измерения задержки ответа)
+    def listen(self, chat_id):
+        queue = asyncio.Queue()
+        self._listeners[chat_id].append(queue)
+        return queue
+
+    def unlisten(self, chat_id, queue):
+        if queue in self._listeners.get(chat_id, []):
+            self._listeners[chat_id].remove(queue)
+
+    def _notify(self, chat_id, method, params):
+        for queue in self._listeners.get(chat_id, []):
+            queue.put_nowait((time.perf_counter(), method, params))
+
+    @staticmethod
+    async def _params(request):
+        if request.content_type == 'application/json':
+            return await request.json()
+        form = await request.post()
+        params = {}
+        for key, value in form.items():
+            if isinstance(value, str):
+                try:
+                    params[key] = json.loads(value)
+                except ValueError:
+                    params[key] = value
+            else:
+                params[key] = value
+        return params
+
+    def _message(self, chat_id, text=None, message_id=None):
+        message = {
+            'message_id': message_id or next(_message_ids),
+            'date': int(time.time()),
+            'chat': _chat(int(chat_id)),
+            'from': BOT_USER,
+        }
+        if text is not None:
+            message['text'] = text
+        return message
+
+    async def handle_method(self, request):
+        method = request.match_info['method']
+        params = await self._params(request)
+        self.calls.append((time.perf_counter(), method, params))
+        self.counts[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        chat_id = params.get('chat_id')
+        lower = method.lower()
+        if lower == 'getme':
+            result = BOT_USER
+        elif lower == 'getupdates':
+            result = await self._get_updates(float(params.get('timeout', 0) or 0))
+        elif lower in ('sendmessage', 'senddocument', 'sendphoto'):
+            result = self._message(chat_id, params.get('text'))
+        elif lower in ('editmessagetext', 'editmessagereplymarkup'):
+            result = self._message(chat_id, params.get('text'), params.get('message_id'))
+        elif lower == 'getfile':
+            file_id = params['file_id']
+            result = {'file_id': file_id, 'file_unique_id': file_id, 'file_size': self.file_size, 'file_path': f'files/{file_id}'}
+        else:
+            # setWebhook, deleteWebhook, deleteMessage, answerCallbackQuery и прочие
+            result = True
+
+        if chat_id is not None:
+            self._notify(int(chat_id), method, params)
+        return web.json_response({'ok': True, 'result': result})
+
+    async def _get_updates(self, timeout):
+        updates = []
+        try:
+            updates.append(await asyncio.wait_for(self.updates.get(), timeout=max(timeout, 0.01)))
+        except asyncio.TimeoutError:
+            return []
+        while not self.updates.empty() and len(updates) < 100:
+            updates.append(self.updates.get_nowait())
+        return updates
+
+    async def handle_file(self, request):
+        return web.Response(body=b'\0' * self.file_size)
+
+    def app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route('*', '/bot{token}/{method}', self.handle_method)
+        app.router.add_get('/file/bot{token}/{path:.*}', self.handle_file)
+        return app
+
+    async def start(self, host='127.0.0.1', port=8081):
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+# Отправитель обновлений на webhook бота
+class UpdateSender:
+    def __init__(self, url, secret):
+        self.url = url
+        self.secret = secret
+        self._session = None
+
+    async def __aenter__(self):
+        self._session = aiohttp.ClientSession()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._session.close()
+
+    async def send(self, update):
+        async with self._session.post(
+            self.url,
+            json=update,
+            headers={'X-Telegram-Bot-Api-Secret-Token': self.secret}
+        ) as response:
+            return response.status
+
+
+async def _serve(args):
+    api = FakeBotApi()
+    base_url = await api.start(port=args.port)
+    print(f"Имитация Bot API: {base_url} (Ctrl+C для выхода)")
+    try:
+        while True:
+            await asyncio.sleep(args.report)
+            print(f"Вызовы Bot API от бота: {dict(api.counts)}")
+    finally:
+        await api.stop()
+
+async def _send(args):
+    async with UpdateSender(args.webhook, args.secret) as sender:
+        statuses = await asyncio.gather(*(
+            sender.send(make_message_update(10000 + i, '/start')) for i in range(args.users)
+        ))
+    print(f"Отправлено обновлений: {len(statuses)}, ответы webhook: {sorted(set(statuses))}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Имитация Telegram Bot API и отправка обновлений на webhook")
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve = commands.add_parser('serve', help="запустить имитацию Bot API")
+    serve.add_argument('--port', type=int, default=8081)
+    serve.add_argument('--report', type=float, default=5.0, help="как часто печатать счётчики вызовов, с")
+    send = commands.add_parser('send', help="отправить /start от нескольких пользователей на webhook")
+    send.add_argument('--webhook', required=True, help="адрес webhook бота, например http://127.0.0.1:8080/telegram")
+    send.add_argument('--secret', default='')
+    send.add_argument('--users', type=int, default=10)
+    args = parser.parse_args()
+    try:
+        asyncio.run(_serve(args) if args.command == 'serve' else _send(args))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,380 @@
+# Нагрузочный тест бота целиком: N пользователей проходят мастер заявки, администратор меняет статусы.
+#
+# Бот запускается отдельным процессом (python main.py) в режиме webhook и работает с
+# имитацией Bot API (fake_telegram.py), локальным SMTP-приёмником (smtp_sink.py) и PostgreSQL из .env —
+# лучше указать отдельную базу, тест создаёт в ней заявки. Каждый пользователь проходит шаги
+# /start → create_ticket → config_* → организация → ФИО → телефон → описание → вложения → finish_ticket,
+# делая паузу --think между шагами. Затем администратор переводит заявки в «В работе» и «Решено»,
+# а пользователи ставят оценку.
+#
+# Задержка шага — от отправки обновления на webhook до сообщения бота, которым шаг завершается
+# (например, «Заявка #… принята» для finish_ticket); остальные сообщения в чат пропускаются.
+# Запросы к БД считаются по метрикам бота (db_call_duration_seconds_count), пиковая память — по ru_maxrss
+# процесса бота после его остановки.
+#
+# Запуск:
+#   python benchmarks/load_test.py --users 50
+#   python benchmarks/load_test.py --users 200 --think 0.2 --env RATE_LIMIT_GLOBAL=1000 --env RATE_LIMIT_PRIVATE=100
+#   python benchmarks/load_test.py --save-baseline benchmarks/baselines/default.json
+#   python benchmarks/load_test.py --compare benchmarks/baselines/default.json
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import signal
+import socket
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import aiohttp
+
+from fake_telegram import FakeBotApi, UpdateSender, make_message_update, make_callback_update, make_photo_update
+from smtp_sink import SmtpSink
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WEBHOOK_SECRET = 'load-test'
+# Первый администратор из main()
+ADMIN_ID = 7186761120
+USER_ID_BASE = 5000000000
+
+# Показатели, которые сравниваются с базовым прогоном; True — чем больше, тем лучше
+COMPARED = {
+    'p50_ms': False,
+    'p95_ms': False,
+    'p99_ms': False,
+    'updates_per_sec': True,
+    'db_queries_per_ticket': False,
+    'peak_rss_mb': False,
+}
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def parse_metrics(text):
+    values = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, _, value = line.rpartition(' ')
+            try:
+                values[name] = float(value)
+            except ValueError:
+                pass
+    return values
+
+def db_calls(metrics):
+    calls = {}
+    for name, value in metrics.items():
+        match = re.fullmatch(r'db_call_duration_seconds_count\{function="([^"]+)"\}', name)
+        if match:
+            calls[match.group(1)] = value
+    return calls
+
+# Пиковая память завершившихся дочерних процессов, МБ
+def children_peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # На Linux ru_maxrss в КБ, на macOS в байтах
+    return rss / 1024 / 1024 if platform.system() == 'Darwin' else rss / 1024
+
+
+class Bot:
+    def __init__(self, args, api_url, smtp_port, workdir):
+        self.webhook_port = free_port()
+        self.metrics_port = free_port()
+        self.webhook = f"http://127.0.0.1:{self.webhook_port}/telegram"
+        self.metrics_url = f"http://127.0.0.1:{self.metrics_port}/metrics"
+        self.log_path = args.bot_log or os.path.join(workdir, 'bot.log')
+        self.env = dict(os.environ)
+        self.env.update({
+            'BOT_TOKEN': '123456:LOAD-TEST',
+            'BOT_MODE': 'webhook',
+            'WEBHOOK_REGISTER': '0',
+            'WEBHOOK_SECRET': WEBHOOK_SECRET,
+            'WEBHOOK_LISTEN': '127.0.0.1',
+            'WEBHOOK_PORT': str(self.webhook_port),
+            'TELEGRAM_BASE_URL': api_url,
+            'METRICS_PORT': str(self.metrics_port),
+            'EMAIL_HOST': '127.0.0.1',
+            'EMAIL_PORT': str(smtp_port),
+            'EMAIL_USE_SSL': '0',
+            'EMAIL_USER': 'bot@example.com',
+            'EMAIL_PASS': 'load-test',
+            'ADMIN_EMAIL': 'admin@example.com',
+            'ATTACHMENTS_DIR': os.path.join(workdir, 'attachments'),
+        })
+        for item in args.env:
+            key, _, value = item.partition('=')
+            self.env[key] = value
+        self.process = None
+        self._log = None
+
+    async def start(self, timeout=60):
+        self._log = open(self.log_path, 'wb')
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.join(ROOT, 'main.py'),
+            cwd=ROOT, env=self.env, stdout=self._log, stderr=asyncio.subprocess.STDOUT
+        )
+        deadline = time.monotonic() + timeout
+        async with aiohttp.ClientSession() as session:
+            while time.monotonic() < deadline:
+                if self.process.returncode is not None:
+                    break
+                try:
+                    async with session.get(self.metrics_url) as response:
+                        if response.status == 200:
+                            return
+                except aiohttp.ClientError:
+                    pass
+                await asyncio.sleep(0.2)
+        raise RuntimeError(f"Бот не запустился, см. {self.log_path}")
+
+    async def metrics(self):
+        async with aiohttp.ClientSession() as session:
+            async with session.get(self.metrics_url) as response:
+                return parse_metrics(await response.text())
+
+    async def stop(self, timeout=30):
+        if self.process is None or self.process.returncode is not None:
+            return
+        if platform.system() == 'Windows':
+            self.process.terminate()
+        else:
+            self.process.send_signal(signal.SIGTERM)
+        try:
+            await asyncio.wait_for(self.process.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            self.process.kill()
+            await self.process.wait()
+        self._log.close()
+
+
+class LoadTest:
+    def __init__(self, args, api, sender):
+        self.args = args
+        self.api = api
+        self.sender = sender
+        self.latencies = defaultdict(list)   # шаг -> задержки, мс
+        self.timeouts = defaultdict(int)
+        self.updates = 0
+        self.tickets = {}                    # user_id -> номер заявки
+
+    # Отправляет обновление и ждёт ответа бота в чат, текст которого содержит expect
+    # (None — любой ответ); возвращает параметры ответа
+    async def step(self, name, chat_id, update, expect=None):
+        queue = self.api.listen(chat_id)
+        try:
+            sent = time.perf_counter()
+            status = await self.sender.send(update)
+            self.updates += 1
+            if status != 200:
+                self.timeouts[name] += 1
+                return None
+            while True:
+                try:
+                    received, method, params = await asyncio.wait_for(queue.get(), timeout=self.args.step_timeout)
+                except asyncio.TimeoutError:
+                    self.timeouts[name] += 1
+                    return None
+                if received >= sent and (expect is None or expect in (params.get('text') or '')):
+                    self.latencies[name].append((received - sent) * 1000)
+                    return params
+        finally:
+            # Остальные сообщения этого шага к следующему не относятся
+            self.api.unlisten(chat_id, queue)
+
+    async def think(self, rnd):
+        if self.args.think:
+            await asyncio.sleep(self.args.think * rnd.uniform(0.5, 1.5))
+
+    async def user(self, index):
+        rnd = random.Random(self.args.seed + index)
+        user_id = USER_ID_BASE + index
+        await asyncio.sleep(self.args.ramp * index / max(1, self.args.users))
+        # (шаг, обновление, текст последнего ответа бота на этот шаг)
+        steps = [
+            ('start', make_message_update(user_id, '/start'), 'Добро пожаловать'),
+            ('create_ticket', make_callback_update(user_id, 'create_ticket'), 'Выберите конфигурацию'),
+            ('config', make_callback_update(user_id, 'config_bp'), 'наименование организации'),
+            ('org_dept', make_message_update(user_id, f'ООО Нагрузка {index}, отдел тестирования'), 'ФИО'),
+            ('name', make_message_update(user_id, f'Пользователь {index}'), 'способ ввода номера'),
+            ('phone', make_message_update(user_id, f'+7999{index:07d}'), 'Опишите проблему'),
+            ('description', make_message_update(user_id, f'Не проводится документ, пользователь {index}'), 'Текст добавлен'),
+        ]
+        for i in range(self.args.attachments):
+            steps.append(('attachment', make_photo_update(user_id, f'load-{index}-{i}', size=self.args.file_size),
+                          f'Уже добавлено: {i + 1}'))
+        steps.append(('finish_ticket', make_callback_update(user_id, 'finish_ticket'), 'Заявка #'))
+
+        for name, update, expect in steps:
+            params = await self.step(name, user_id, update, expect)
+            if params is None:
+                return
+            if name == 'finish_ticket':
+                match = re.search(r'#(\d+)', params.get('text') or '')
+                if match:
+                    self.tickets[user_id] = int(match.group(1))
+            await self.think(rnd)
+
+    async def admin(self):
+        rnd = random.Random(self.args.seed)
+        await self.step('admin_panel', ADMIN_ID, make_callback_update(ADMIN_ID, 'admin_panel'))
+        for user_id, ticket_id in sorted(self.tickets.items(), key=lambda item: item[1]):
+            for status in ('В работе', 'Решено'):
+                # Ответ — перерисовка панели; заявки может не быть на её странице
+                await self.step('admin_status', ADMIN_ID, make_callback_update(ADMIN_ID, f'status_{ticket_id}_{status}'))
+                await self.think(rnd)
+
+    async def rate(self, user_id, ticket_id):
+        await self.step('rate', user_id, make_callback_update(user_id, f'rate_{ticket_id}_5'), 'Спасибо за ваш отзыв')
+
+
+def summarize(test, elapsed, calls, peak_rss, emails):
+    all_latencies = [value for values in test.latencies.values() for value in values]
+    tickets = len(test.tickets)
+    return {
+        'p50_ms': percentile(all_latencies, 50),
+        'p95_ms': percentile(all_latencies, 95),
+        'p99_ms': percentile(all_latencies, 99),
+        'updates_per_sec': test.updates / elapsed if elapsed else 0.0,
+        'db_queries_per_ticket': sum(calls.values()) / tickets if tickets else 0.0,
+        'peak_rss_mb': peak_rss,
+        'updates': test.updates,
+        'tickets': tickets,
+        'emails': emails,
+        'timeouts': sum(test.timeouts.values()),
+        'elapsed_sec': elapsed,
+        'steps': {
+            name: {
+                'count': len(values),
+                'p50_ms': percentile(values, 50),
+                'p95_ms': percentile(values, 95),
+                'p99_ms': percentile(values, 99),
+                'mean_ms': statistics.mean(values),
+                'timeouts': test.timeouts.get(name, 0),
+            }
+            for name, values in test.latencies.items()
+        },
+        'db_calls': calls,
+    }
+
+def report(results):
+    print(f"\nОбновлений: {results['updates']} за {results['elapsed_sec']:.1f} с ({results['updates_per_sec']:.1f} обновлений/с), "
+          f"заявок: {results['tickets']}, писем: {results['emails']}, без ответа: {results['timeouts']}")
+    print(f"{'шаг':<15}{'кол-во':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'ср., мс':>10}")
+    for name, step in results['steps'].items():
+        print(f"{name:<15}{step['count']:>8}{step['p50_ms']:>10.1f}{step['p95_ms']:>10.1f}"
+              f"{step['p99_ms']:>10.1f}{step['mean_ms']:>10.1f}")
+    print(f"{'все':<15}{'':>8}{results['p50_ms']:>10.1f}{results['p95_ms']:>10.1f}{results['p99_ms']:>10.1f}")
+    print(f"\nЗапросов к БД на заявку: {results['db_queries_per_ticket']:.1f}")
+    for name, count in sorted(results['db_calls'].items(), key=lambda item: -item[1]):
+        print(f"  {name:<28}{count:>8.0f}")
+    if results['peak_rss_mb'] is not None:
+        print(f"Пиковая память бота: {results['peak_rss_mb']:.1f} МБ")
+
+# Сравнение с базовым прогоном; возвращает список ухудшившихся показателей
+def compare(results, baseline, tolerance):
+    regressions = []
+    print(f"\n{'показатель':<24}{'база':>12}{'сейчас':>12}{'изм.':>9}")
+    for key, higher_is_better in COMPARED.items():
+        old, new = baseline.get(key), results.get(key)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old if old else 0.0
+        worse = -change if higher_is_better else change
+        mark = ''
+        if worse > tolerance:
+            mark = '  регрессия'
+            regressions.append(key)
+        print(f"{key:<24}{old:>12.1f}{new:>12.1f}{change * 100:>8.0f}%{mark}")
+    return regressions
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix='helper-bot-load-')
+    api = FakeBotApi(file_size=args.file_size, latency=args.api_latency / 1000)
+    sink = SmtpSink()
+    api_url = await api.start(port=free_port())
+    smtp_port = free_port()
+    await sink.start(port=smtp_port)
+    bot = Bot(args, api_url, smtp_port, workdir)
+    try:
+        await bot.start()
+        before = db_calls(await bot.metrics())
+        async with UpdateSender(bot.webhook, WEBHOOK_SECRET) as sender:
+            test = LoadTest(args, api, sender)
+            started = time.perf_counter()
+            await asyncio.gather(*(test.user(i) for i in range(args.users)))
+            if args.admin:
+                await test.admin()
+                await asyncio.gather(*(test.rate(user_id, ticket_id) for user_id, ticket_id in test.tickets.items()))
+            elapsed = time.perf_counter() - started
+        # Письма уходят в фоне; ждём их, но в updates/sec это время не входит
+        await sink.wait_for(len(test.tickets), timeout=args.step_timeout)
+        after = db_calls(await bot.metrics())
+        calls = {name: count - before.get(name, 0) for name, count in after.items() if count > before.get(name, 0)}
+    finally:
+        await bot.stop()
+        await sink.stop()
+        await api.stop()
+        if not args.bot_log:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return summarize(test, elapsed, calls, children_peak_rss_mb(), sink.messages)
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота: мастер заявки, смена статусов, задержки, запросы к БД и память")
+    parser.add_argument('--users', type=int, default=50, help="количество пользователей")
+    parser.add_argument('--ramp', type=float, default=5.0, help="за сколько секунд подключаются все пользователи")
+    parser.add_argument('--think', type=float, default=1.0, help="средняя пауза пользователя между шагами, с")
+    parser.add_argument('--attachments', type=int, default=1, help="вложений в заявке")
+    parser.add_argument('--file-size', type=int, default=256 * 1024, help="размер вложения, байт")
+    parser.add_argument('--api-latency', type=float, default=0, help="задержка ответа имитации Bot API, мс")
+    parser.add_argument('--no-admin', dest='admin', action='store_false', help="не менять статусы заявок")
+    parser.add_argument('--step-timeout', type=float, default=60, help="сколько ждать ответа бота на шаг, с")
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE', help="переменная окружения для бота")
+    parser.add_argument('--bot-log', help="куда записать вывод бота (по умолчанию во временный каталог)")
+    parser.add_argument('--save-baseline', metavar='FILE', help="сохранить результаты как базовые")
+    parser.add_argument('--compare', metavar='FILE', help="сравнить с базовыми результатами")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="допустимое ухудшение при сравнении (0.1 = 10%%)")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    report(results)
+
+    params = {key: value for key, value in vars(args).items() if key not in ('save_baseline', 'compare', 'bot_log')}
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save_baseline)), exist_ok=True)
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump({'params': params, 'results': results}, f, ensure_ascii=False, indent=2)
+        print(f"\nБазовые результаты сохранены в {args.save_baseline}")
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('params') != params:
+            print("\nВнимание: параметры базового прогона отличаются, сравнение может быть некорректным")
+        if compare(results, baseline['results'], args.tolerance):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
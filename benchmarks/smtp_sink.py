@@ -0,0 +1,111 @@
+# Локальный SMTP-сервер для нагрузочных тестов: принимает письма без шифрования,
+# любую аутентификацию и считает принятые письма и байты, ничего не сохраняя.
+# Бот подключается к нему с EMAIL_USE_SSL=0.
+#
+# Пример:
+#   python benchmarks/smtp_sink.py --port 2525
+#   EMAIL_HOST=127.0.0.1 EMAIL_PORT=2525 EMAIL_USE_SSL=0 python main.py
+import argparse
+import asyncio
+import time
+
+
+class SmtpSink:
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.connections = 0
+        self.received = []      # время приёма каждого письма (perf_counter)
+        self._server = None
+        self._arrived = asyncio.Event()
+
+    async def start(self, host='127.0.0.1', port=2525):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        return f"{host}:{port}"
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    # Ждать, пока наберётся count писем; возвращает False по таймауту
+    async def wait_for(self, count, timeout):
+        deadline = time.monotonic() + timeout
+        while self.messages < count:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            self._arrived.clear()
+            try:
+                await asyncio.wait_for(self._arrived.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+
+        def reply(line):
+            writer.write(line.encode() + b'\r\n')
+
+        reply('220 smtp-sink')
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode(errors='replace').strip().upper()
+                if command.startswith(('EHLO', 'HELO')):
+                    reply('250-smtp-sink')
+                    reply('250-8BITMIME')
+                    reply('250 AUTH PLAIN LOGIN')
+                elif command.startswith('AUTH'):
+                    reply('235 ok')
+                elif command == 'DATA':
+                    reply('354 end with <CRLF>.<CRLF>')
+                    await writer.drain()
+                    size = 0
+                    while True:
+                        line = await reader.readline()
+                        if not line or line == b'.\r\n':
+                            break
+                        size += len(line)
+                    self.messages += 1
+                    self.bytes += size
+                    self.received.append(time.perf_counter())
+                    self._arrived.set()
+                    reply('250 ok')
+                elif command == 'QUIT':
+                    reply('221 bye')
+                    await writer.drain()
+                    break
+                else:
+                    reply('250 ok')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def _serve(args):
+    sink = SmtpSink()
+    address = await sink.start(port=args.port)
+    print(f"SMTP-приёмник: {address} (Ctrl+C для выхода)")
+    try:
+        while True:
+            await asyncio.sleep(args.report)
+            print(f"Принято писем: {sink.messages}, байт: {sink.bytes}")
+    finally:
+        await sink.stop()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Локальный SMTP-сервер, принимающий и отбрасывающий письма")
+    parser.add_argument('--port', type=int, default=2525)
+    parser.add_argument('--report', type=float, default=5.0, help="как часто печатать счётчики, с")
+    args = parser.parse_args()
+    try:
+        asyncio.run(_serve(args))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,226 @@
+import asyncio
+import functools
+import logging
+import os
+import platform
+import signal
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+from dotenv import load_dotenv
+from psycopg2 import extensions
+from telegram import Update
+
+# Загружаем переменные из .env
+load_dotenv()
+
+# Ключ advisory-блокировки лидера: все экземпляры одного бота должны использовать одинаковый ключ
+LEADER_LOCK_KEY = int(os.getenv("LEADER_LOCK_KEY", "4240002"))
+# Как часто резервный экземпляр пытается стать лидером, а лидер проверяет своё соединение, с
+LEADER_CHECK_INTERVAL = float(os.getenv("LEADER_CHECK_INTERVAL", "1"))
+# Через сколько секунд без ответа PostgreSQL сочтёт соединение лидера мёртвым и снимет блокировку
+LEADER_KEEPALIVE = int(os.getenv("LEADER_KEEPALIVE", "10"))
+
+logger = logging.getLogger(__name__)
+
+
+# Выбор лидера среди экземпляров бота через сессионную advisory-блокировку PostgreSQL.
+# Блокировка живёт, пока живо соединение: после падения лидера её сразу может взять резервный экземпляр,
+# поэтому зависших файлов блокировки не бывает.
+class LeaderElector:
+    def __init__(self, connect_kwargs, key=LEADER_LOCK_KEY, interval=LEADER_CHECK_INTERVAL, keepalive=LEADER_KEEPALIVE):
+        self._connect_kwargs = dict(connect_kwargs)
+        # Серверные keepalive: PostgreSQL быстро заметит пропавшего лидера и освободит блокировку
+        probe = max(1, keepalive // 3)
+        self._connect_kwargs['options'] = (
+            f"-c tcp_keepalives_idle={probe} -c tcp_keepalives_interval={probe} -c tcp_keepalives_count=3"
+        )
+        self.key = key
+        self.interval = interval
+        self.is_leader = False
+        self._conn = None
+        self._elected = asyncio.Event()
+        self._demoted = asyncio.Event()
+        self._demoted.set()
+        self._callbacks = {'elected': [], 'demoted': []}
+        # Соединение с блокировкой используется только из одного потока
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='leader')
+        self._task = None
+
+    def on_elected(self, callback):
+        self._callbacks['elected'].append(callback)
+
+    def on_demoted(self, callback):
+        self._callbacks['demoted'].append(callback)
+
+    async def start(self):
+        if self._task is None:
+            await self._check()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._release)
+        self._executor.shutdown(wait=True)
+        await self._set_leader(False)
+
+    async def wait_elected(self):
+        await self._elected.wait()
+
+    async def wait_demoted(self):
+        await self._demoted.wait()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self._check()
+
+    async def _check(self):
+        loop = asyncio.get_running_loop()
+        try:
+            leader = await loop.run_in_executor(self._executor, self._tick)
+        except Exception as e:
+            logger.warning(f"Ошибка проверки лидерства: {e}")
+            leader = False
+        await self._set_leader(leader)
+
+    # Резервный экземпляр пытается взять блокировку, лидер проверяет, что соединение живо
+    def _tick(self):
+        if self._conn is None or self._conn.closed:
+            self._conn = None
+            conn = psycopg2.connect(**self._connect_kwargs)
+            conn.set_isolation_level(extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            self._conn = conn
+        try:
+            c = self._conn.cursor()
+            if self.is_leader:
+                c.execute("SELECT 1")
+                return True
+            c.execute("SELECT pg_try_advisory_lock(%s)", (self.key,))
+            return c.fetchone()[0]
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # Соединение потеряно — вместе с ним потеряна и блокировка
+            self._close()
+            raise
+
+    def _release(self):
+        if self._conn is not None and not self._conn.closed and self.is_leader:
+            try:
+                self._conn.cursor().execute("SELECT pg_advisory_unlock(%s)", (self.key,))
+            except Exception as e:
+                logger.warning(f"Ошибка снятия блокировки лидера: {e}")
+        self._close()
+
+    def _close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+    async def _set_leader(self, leader):
+        if leader == self.is_leader:
+            return
+        self.is_leader = leader
+        if leader:
+            logger.info("Этот экземпляр стал лидером")
+        else:
+            # Прежний лидер прекращает работу сразу, не дожидаясь обработчиков
+            logger.warning("Этот экземпляр больше не лидер")
+            self._elected.clear()
+            self._demoted.set()
+        for callback in self._callbacks['elected' if leader else 'demoted']:
+            try:
+                await callback()
+            except Exception as e:
+                logger.error(f"Ошибка обработчика смены лидера: {e}")
+        # Новый лидер начинает работу только после подготовки в обработчиках
+        if leader and self.is_leader:
+            self._demoted.clear()
+            self._elected.set()
+
+
+# Экземпляр, общий для процесса; создаётся в main()
+elector = None
+
+def create_elector(connect_kwargs):
+    global elector
+    elector = LeaderElector(connect_kwargs)
+    return elector
+
+# Задача JobQueue, которая выполняется только на лидере.
+# На остальных экземплярах вызов пропускается, поэтому задачу можно регистрировать везде.
+def leader_only(callback):
+    @functools.wraps(callback)
+    async def wrapper(context):
+        if elector is not None and not elector.is_leader:
+            return None
+        return await callback(context)
+    return wrapper
+
+# Остановка по SIGINT/SIGTERM (на Windows — по KeyboardInterrupt)
+def install_stop_signals(stop_event):
+    if platform.system() == "Windows":
+        return
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+# Ждёт первое из событий; возвращает True, если первым наступило не stop_event
+async def _wait_first(awaitable, stop_event):
+    waiter = asyncio.ensure_future(awaitable)
+    stopper = asyncio.ensure_future(stop_event.wait())
+    done, pending = await asyncio.wait({waiter, stopper}, return_when=asyncio.FIRST_COMPLETED)
+    for task in pending:
+        task.cancel()
+    return waiter in done and not stop_event.is_set()
+
+# Long polling с горячим резервом: Telegram допускает только одного получателя getUpdates,
+# поэтому опрашивает только лидер. Резервный экземпляр уже инициализирован и начинает опрос,
+# как только блокировка освободится; потерявший лидерство экземпляр сразу прекращает опрос.
+async def run_polling(application, elector, stop_event=None):
+    stop_event = stop_event or asyncio.Event()
+    install_stop_signals(stop_event)
+
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await elector.start()
+        while not stop_event.is_set():
+            if not elector.is_leader:
+                logger.info("Экземпляр в резерве, ожидание лидерства")
+            if not await _wait_first(elector.wait_elected(), stop_event):
+                break
+            logger.info("Начат опрос обновлений")
+            await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+            await application.start()
+            await _wait_first(elector.wait_demoted(), stop_event)
+            await application.updater.stop()
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+            # Состояние диалогов должно попасть в БД раньше, чем опрос начнёт новый лидер
+            if application.persistence:
+                await application.persistence.flush()
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    finally:
+        await elector.stop()
+        if application.updater.running:
+            await application.updater.stop()
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
@@ -1,6 +1,14 @@
-import psycopg2
+import datetime
+import threading
 from dotenv import load_dotenv
 import os
+from psycopg2 import errors
+from psycopg2.extras import execute_values
+
+from db_pool import ConnectionPool
+from admin_cache import AdminCache, AdminChangeListener
+from ticket_cache import UserTicketCache
+from migrations import migrate, add_months, ensure_ticket_partitions, ticket_partition_month, STATUS_RANK_SQL, SEARCH_CONFIG, TICKET_PARTITION_PREFIX
 
 # Загружаем переменные из .env
 load_dotenv()
@@ -12,215 +20,703 @@ DB_USER = os.getenv("DB_USER")
 DB_NAME = os.getenv("DB_NAME")
 DB_PASS = os.getenv("DB_PASS")
 
-def init_db():
-    conn = None
-    try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            user=DB_USER,
-            password=DB_PASS,
-            database=DB_NAME
-        )
+# Параметры пула соединений
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))             # ожидание свободного соединения, с
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "300"))          # закрывать простаивающие дольше, с
+DB_POOL_MAX_LIFETIME = float(os.getenv("DB_POOL_MAX_LIFETIME", "3600")) # пересоздавать старше, с
+DB_POOL_HEALTH_CHECK = float(os.getenv("DB_POOL_HEALTH_CHECK", "30"))   # проверять SELECT 1 после простоя, с
+
+# Сколько секунд список администраторов может жить в памяти без перезагрузки
+ADMIN_CACHE_TTL = float(os.getenv("ADMIN_CACHE_TTL", "300"))
+
+# Поиск ранжирует не больше стольких самых новых совпадений, чтобы частое слово не сортировало всю таблицу
+SEARCH_CANDIDATES = int(os.getenv("SEARCH_CANDIDATES", "1000"))
+
+# На сколько месяцев вперёд заранее создавать разделы заявок
+TICKET_PARTITIONS_AHEAD = int(os.getenv("TICKET_PARTITIONS_AHEAD", "2"))
+# Сколько ждать блокировку таблицы заявок при удалении раздела, чтобы не задерживать обработчики
+PARTITION_LOCK_TIMEOUT = os.getenv("PARTITION_LOCK_TIMEOUT", "2s")
+
+# Для скольких пользователей хранить в памяти страницы «Мои заявки» (0 — не кэшировать)
+USER_TICKETS_CACHE_SIZE = int(os.getenv("USER_TICKETS_CACHE_SIZE", "1000"))
+# Сколько секунд страница живёт в кэше: ограничивает устаревание при изменениях из других процессов
+USER_TICKETS_CACHE_TTL = float(os.getenv("USER_TICKETS_CACHE_TTL", "60"))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# Общий пул соединений создаётся при первом обращении
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                pool = ConnectionPool(
+                    DB_POOL_MIN,
+                    DB_POOL_MAX,
+                    timeout=DB_POOL_TIMEOUT,
+                    max_idle=DB_POOL_MAX_IDLE,
+                    max_lifetime=DB_POOL_MAX_LIFETIME,
+                    health_check_interval=DB_POOL_HEALTH_CHECK,
+                    **database_connect_kwargs()
+                )
+                pool.open()
+                _pool = pool
+    return _pool
+
+# Соединение из пула на время блока with
+def get_connection():
+    return get_pool().connection()
+
+def get_pool_stats():
+    return get_pool().stats()
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+def database_connect_kwargs():
+    return dict(host=DB_HOST, port=DB_PORT, user=DB_USER, password=DB_PASS, database=DB_NAME)
+
+def _load_admin_ids():
+    with get_connection() as conn:
         c = conn.cursor()
-        # Создание таблицы tickets
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS tickets (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT,
-                config TEXT,
-                org_dept TEXT,
-                name TEXT,
-                phone TEXT,
-                description TEXT,
-                status TEXT DEFAULT 'Принято'
-            )
-        ''')
-        # Создание таблицы admins
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS admins (
-                user_id BIGINT PRIMARY KEY
-            )
-        ''')
-        # Создание таблицы feedback
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS feedback (
-                ticket_id INTEGER PRIMARY KEY,
-                rating INTEGER,
-                FOREIGN KEY (ticket_id) REFERENCES tickets(id)
-            )
-        ''')
-        conn.commit()
+        c.execute("SELECT user_id FROM admins")
+        return {row[0] for row in c.fetchall()}
+
+# Кэш администраторов: is_admin обращается к БД только после изменения таблицы admins
+_admin_cache = AdminCache(_load_admin_ids, ttl=ADMIN_CACHE_TTL)
+_admin_listener = None
+
+# Подписка на изменения таблицы admins из других процессов
+def start_admin_listener():
+    global _admin_listener
+    if _admin_listener is None:
+        _admin_listener = AdminChangeListener(_admin_cache, database_connect_kwargs())
+        _admin_listener.start()
+
+def stop_admin_listener():
+    global _admin_listener
+    if _admin_listener is not None:
+        _admin_listener.stop()
+        _admin_listener = None
+
+def get_admin_cache_stats():
+    return _admin_cache.stats()
+
+# Проверка по кэшу без обращения к БД; None, если кэш нужно загрузить
+def peek_admin(user_id):
+    return _admin_cache.peek(user_id)
+
+# Страницы «Мои заявки»; сбрасываются при изменении заявок пользователя
+_user_tickets_cache = UserTicketCache(USER_TICKETS_CACHE_SIZE, ttl=USER_TICKETS_CACHE_TTL)
+
+def get_user_tickets_cache_stats():
+    return _user_tickets_cache.stats()
+
+# Приводит схему БД к актуальной версии (см. migrations.py)
+def init_db():
+    try:
+        with get_connection() as conn:
+            applied = migrate(conn)
+            if applied:
+                print(f"Применены миграции БД: {', '.join(map(str, applied))}")
+        # Разделы заявок на ближайшие месяцы, даже если задача обслуживания давно не запускалась
+        create_ticket_partitions()
         print("База данных успешно инициализирована!")
     except Exception as e:
         print(f"Ошибка инициализации базы данных: {e}")
-    finally:
-        if conn:
-            conn.close()
+
+# Разделы заявок на текущий и следующие месяцы; возвращает имена созданных разделов
+def create_ticket_partitions(months_ahead=TICKET_PARTITIONS_AHEAD):
+    try:
+        with get_connection() as conn:
+            created = ensure_ticket_partitions(conn.cursor(), months_ahead, lock_timeout=PARTITION_LOCK_TIMEOUT)
+            conn.commit()
+            return created
+    except Exception as e:
+        print(f"Ошибка создания разделов заявок: {e}")
+        return []
+
+# Переносит в tickets_archive до limit решённых заявок, созданных и изменённых больше
+# older_than_days дней назад. Условие по created_at отсекает свежие разделы.
+# Возвращает число перенесённых заявок.
+def archive_resolved_tickets(older_than_days, limit):
+    try:
+        with get_connection() as conn:
+            c = conn.cursor()
+            c.execute('''
+                WITH moved AS (
+                    DELETE FROM tickets
+                    WHERE (id, created_at) IN (
+                        SELECT id, created_at FROM tickets
+                        WHERE status = 'Решено'
+                          AND created_at < now() - make_interval(days => %s)
+                          AND updated_at < now() - make_interval(days => %s)
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING id, user_id, config, org_dept, name, phone, description, status, created_at, updated_at
+                )
+                INSERT INTO tickets_archive (id, user_id, config, org_dept, name, phone, description, status, created_at, updated_at)
+                SELECT * FROM moved
+            ''', (older_than_days, older_than_days, limit))
+            count = c.rowcount
+            conn.commit()
+            return count
+    except Exception as e:
+        print(f"Ошибка архивации заявок: {e}")
+        return 0
+
+# Удаляет пустые разделы заявок за месяцы, закончившиеся больше older_than_days дней назад.
+# Раздел с незакрытой заявкой остаётся. Возвращает имена удалённых разделов.
+def drop_empty_ticket_partitions(older_than_days):
+    cutoff = datetime.datetime.now(datetime.timezone.utc).date() - datetime.timedelta(days=older_than_days)
+    dropped = []
+    try:
+        with get_connection() as conn:
+            c = conn.cursor()
+            c.execute('''
+                SELECT child.relname FROM pg_inherits
+                JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+                WHERE pg_inherits.inhparent = 'tickets'::regclass
+            ''')
+            names = sorted(name for (name,) in c.fetchall() if name.startswith(TICKET_PARTITION_PREFIX))
+            conn.commit()
+            for name in names:
+                month = ticket_partition_month(name)
+                if month is None or add_months(month, 1) > cutoff:
+                    continue
+                c.execute("SET LOCAL lock_timeout = %s", (PARTITION_LOCK_TIMEOUT,))
+                c.execute(f"SELECT EXISTS (SELECT 1 FROM {name})")
+                if c.fetchone()[0]:
+                    conn.rollback()
+                    continue
+                c.execute(f"DROP TABLE {name}")
+                conn.commit()
+                dropped.append(name)
+    except Exception as e:
+        print(f"Ошибка удаления пустых разделов заявок: {e}")
+    return dropped
 
 def add_admin(user_id):
-    conn = None
-    try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            user=DB_USER,
-            password=DB_PASS,
-            database=DB_NAME
-        )
-        c = conn.cursor()
-        c.execute("INSERT INTO admins (user_id) VALUES (%s) ON CONFLICT (user_id) DO NOTHING", (user_id,))
-        conn.commit()
+    try:
+        with get_connection() as conn:
+            c = conn.cursor()
+            c.execute("INSERT INTO admins (user_id) VALUES (%s) ON CONFLICT (user_id) DO NOTHING", (user_id,))
+            conn.commit()
     except Exception as e:
         print(f"Ошибка добавления администратора: {e}")
     finally:
-        if conn:
-            conn.close()
+        _admin_cache.invalidate()
+
+def remove_admin(user_id):
+    try:
+        with get_connection() as conn:
+            c = conn.cursor()
+            c.execute("DELETE FROM admins WHERE user_id = %s", (user_id,))
+            conn.commit()
+    except Exception as e:
+        print(f"Ошибка удаления администратора: {e}")
+    finally:
+        _admin_cache.invalidate()
 
 def is_admin(user_id):
-    conn = None
-    try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            user=DB_USER,
-            password=DB_PASS,
-            database=DB_NAME
-        )
-        c = conn.cursor()
-        c.execute("SELECT user_id FROM admins WHERE user_id = %s", (user_id,))
-        result = c.fetchone()
-        return result is not None
+    try:
+        return _admin_cache.contains(user_id)
     except Exception as e:
         print(f"Ошибка проверки администратора: {e}")
         return False
-    finally:
-        if conn:
-            conn.close()
-
-def save_ticket(user_id, config, org_dept, name, phone, description):
-    conn = None
-    try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            user=DB_USER,
-            password=DB_PASS,
-            database=DB_NAME
-        )
-        c = conn.cursor()
-        c.execute(
-            "INSERT INTO tickets (user_id, config, org_dept, name, phone, description) VALUES (%s, %s, %s, %s, %s, %s) RETURNING id",
-            (user_id, config, org_dept, name, phone, description)
-        )
-        ticket_id = c.fetchone()[0]
-        conn.commit()
+
+# Заявка и email-уведомление о ней сохраняются в одной транзакции
+def save_ticket(user_id, config, org_dept, name, phone, description, attachments=None):
+    insert = "INSERT INTO tickets (user_id, config, org_dept, name, phone, description) VALUES (%s, %s, %s, %s, %s, %s) RETURNING id, created_at"
+    try:
+        with get_connection() as conn:
+            c = conn.cursor()
+            try:
+                c.execute(insert, (user_id, config, org_dept, name, phone, description))
+            except errors.CheckViolation:
+                # Нет раздела на текущий месяц (задача обслуживания давно не запускалась): создаём и повторяем
+                conn.rollback()
+                ensure_ticket_partitions(c, TICKET_PARTITIONS_AHEAD, lock_timeout=PARTITION_LOCK_TIMEOUT)
+                conn.commit()
+                c.execute(insert, (user_id, config, org_dept, name, phone, description))
+            ticket_id, created_at = c.fetchone()
+            c.execute(
+                "INSERT INTO email_outbox (ticket_id, ticket_created_at, attachments) VALUES (%s, %s, %s)",
+                (ticket_id, created_at, list(attachments or []))
+            )
+            conn.commit()
+        _user_tickets_cache.invalidate(user_id)
         return ticket_id
     except Exception as e:
         print(f"Ошибка сохранения заявки: {e}")
         return None
-    finally:
-        if conn:
-            conn.close()
-
-def update_status(ticket_id, status):
-    conn = None
-    try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            user=DB_USER,
-            password=DB_PASS,
-            database=DB_NAME
-        )
-        c = conn.cursor()
-        c.execute("UPDATE tickets SET status = %s WHERE id = %s", (status, ticket_id))
-        conn.commit()
+
+# Условие на created_at по секундам создания заявок (created — список секунд Unix, как в кнопках),
+# чтобы PostgreSQL читал только их разделы. Пустое условие, если время создания какой-то заявки неизвестно.
+def _created_at_filter(created, column='created_at'):
+    if not created or None in created:
+        return "", []
+    return (
+        f" AND {column} >= %s AND {column} < %s",
+        [datetime.datetime.fromtimestamp(min(created), datetime.timezone.utc),
+         datetime.datetime.fromtimestamp(max(created) + 1, datetime.timezone.utc)]
+    )
+
+# Секунда создания заявки (Unix) для кнопок: по ней запросы находят раздел заявки
+CREATED_EPOCH_SQL = "floor(extract(epoch FROM {table}created_at))::bigint"
+
+# Смена статуса нескольких заявок одним запросом. Меняются только заявки в одном из from_statuses;
+# created — секунды создания заявок, ограничивают запрос их разделами.
+# Возвращает [(id, user_id, секунда создания)] изменённых заявок.
+def bulk_update_status(ticket_ids, status, from_statuses, created=None):
+    condition, params = _created_at_filter(created)
+    try:
+        with get_connection() as conn:
+            c = conn.cursor()
+            c.execute(
+                f"UPDATE tickets SET status = %s WHERE id = ANY(%s) AND status = ANY(%s){condition} "
+                f"RETURNING id, user_id, {CREATED_EPOCH_SQL.format(table='')}",
+                [status, list(ticket_ids), list(from_statuses)] + params
+            )
+            result = c.fetchall()
+            conn.commit()
+        for user_id in {user_id for _, user_id, _ in result}:
+            _user_tickets_cache.invalidate(user_id)
+        return result
     except Exception as e:
-        print(f"Ошибка обновления статуса: {e}")
-    finally:
-        if conn:
-            conn.close()
-
-def get_user_id_by_ticket(ticket_id):
-    conn = None
-    try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            user=DB_USER,
-            password=DB_PASS,
-            database=DB_NAME
-        )
-        c = conn.cursor()
-        c.execute("SELECT user_id FROM tickets WHERE id = %s", (ticket_id,))
-        result = c.fetchone()
-        return result[0] if result else None
+        print(f"Ошибка массового обновления статуса: {e}")
+        return []
+
+# Оценка сохраняется, только если заявка существует и принадлежит user_id: внешнего ключа
+# на разделённую tickets нет, а callback_data кнопки можно подделать. Вместе с оценкой хранится
+# время создания заявки (для триггера статистики). created — секунда создания из кнопки оценки:
+# поиск заявки читает один раздел. Возвращает True, если оценка сохранена.
+def save_feedback(ticket_id, rating, user_id, created=None):
+    condition, params = _created_at_filter([created])
+    try:
+        with get_connection() as conn:
+            c = conn.cursor()
+            c.execute(f'''
+                INSERT INTO feedback (ticket_id, rating, ticket_created_at)
+                SELECT id, %s, created_at FROM tickets_all WHERE id = %s AND user_id = %s{condition}
+                ON CONFLICT (ticket_id) DO UPDATE SET rating = EXCLUDED.rating
+                RETURNING ticket_id
+            ''', [rating, ticket_id, user_id] + params)
+            saved = c.fetchone() is not None
+            conn.commit()
+        if saved:
+            _user_tickets_cache.invalidate(user_id)
+        return saved
     except Exception as e:
-        print(f"Ошибка получения user_id: {e}")
+        print(f"Ошибка сохранения отзыва: {e}")
+        return False
+
+# Заявки (включая архив) с оценками для выгрузки, по порядку номеров. Строки читаются
+# именованным курсором на сервере пачками по batch_size, поэтому в памяти не больше одной пачки.
+# Фильтры необязательны: statuses и configs — списки, date_from/date_to — границы created_at [с, до).
+# Ошибки не перехватываются: незаконченная выгрузка не должна выглядеть успешной.
+def iter_tickets_for_export(statuses=None, date_from=None, date_to=None, configs=None, batch_size=1000):
+    query = '''
+        SELECT tickets_all.id, tickets_all.created_at, tickets_all.updated_at, status, config, org_dept,
+               name, phone, user_id, description, feedback.rating
+        FROM tickets_all
+        LEFT JOIN feedback ON feedback.ticket_id = tickets_all.id
+        WHERE TRUE
+    '''
+    params = []
+    if statuses:
+        query += " AND status = ANY(%s)"
+        params.append(list(statuses))
+    if date_from is not None:
+        query += " AND tickets_all.created_at >= %s"
+        params.append(date_from)
+    if date_to is not None:
+        query += " AND tickets_all.created_at < %s"
+        params.append(date_to)
+    if configs:
+        query += " AND config = ANY(%s)"
+        params.append(list(configs))
+    query += " ORDER BY tickets_all.id"
+    with get_connection() as conn:
+        try:
+            with conn.cursor(name='tickets_export') as c:
+                c.itersize = batch_size
+                c.execute(query, params)
+                yield from c
+        finally:
+            conn.rollback()
+
+# Сводная статистика из ticket_stats_totals / ticket_stats_daily (их обновляют триггеры).
+# Строка — (ключ, решено, сумма времени решения с, гистограмма времени, оценок, сумма оценок, гистограмма оценок).
+# Возвращает {'total': строка, 'recent': строка за days дней, 'config': [...], 'org': [...]}
+# или None при ошибке; каждый запрос читает ограниченное число строк по первичному ключу.
+def get_ticket_stats(days, limit):
+    columns = "key, resolved, resolve_seconds, resolve_hist, ratings, rating_sum, rating_hist"
+    try:
+        with get_connection() as conn:
+            c = conn.cursor()
+            c.execute(f"SELECT {columns} FROM ticket_stats_totals WHERE dimension = 'all' AND key = ''")
+            total = c.fetchone()
+            c.execute(f'''
+                SELECT {columns} FROM ticket_stats_daily
+                WHERE dimension = 'all' AND key = '' AND day > (now() AT TIME ZONE 'UTC')::date - %s
+            ''', (days,))
+            daily = c.fetchall()
+            result = {'total': total, 'recent': _sum_stats_rows('', daily)}
+            for dimension in ('config', 'org'):
+                c.execute(f'''
+                    SELECT {columns} FROM ticket_stats_totals
+                    WHERE dimension = %s ORDER BY resolved DESC LIMIT %s
+                ''', (dimension, limit))
+                result[dimension] = c.fetchall()
+            return result
+    except Exception as e:
+        print(f"Ошибка получения статистики: {e}")
         return None
-    finally:
-        if conn:
-            conn.close()
-
-def get_tickets_by_status(status):
-    conn = None
-    try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            user=DB_USER,
-            password=DB_PASS,
-            database=DB_NAME
+
+def _sum_stats_rows(key, rows):
+    if not rows:
+        return None
+    return (
+        key,
+        sum(row[1] for row in rows),
+        sum(row[2] for row in rows),
+        [sum(values) for values in zip(*(row[3] for row in rows))],
+        sum(row[4] for row in rows),
+        sum(row[5] for row in rows),
+        [sum(values) for values in zip(*(row[6] for row in rows))],
+    )
+
+# Статусы, которые показывает панель администратора (порядок разделов — STATUS_RANK_SQL)
+PANEL_STATUSES = ('Принято', 'В работе', 'Решено')
+
+# Страница панели администратора одним запросом вместе с оценками.
+# Пагинация по ключу (ранг статуса, id): after — курсор последней строки предыдущей страницы,
+# before — курсор первой строки следующей. Возвращает (строки, есть_предыдущая, есть_следующая).
+# Панель показывает заявки всех разделов tickets, поэтому читает страницу индекса tickets_panel_idx
+# каждого раздела; число разделов ограничено сроком архивации. Секунда создания в строке нужна кнопкам,
+# чтобы смена статуса и оценка затрагивали только раздел заявки.
+def get_admin_panel_page(limit, after=None, before=None, description_length=200):
+    # В feedback нет колонки status, поэтому выражение ранга можно использовать без псевдонима
+    query = f'''
+        SELECT tickets.id, status, user_id, config, org_dept, name, phone,
+               left(description, %s), feedback.rating, {STATUS_RANK_SQL}, {CREATED_EPOCH_SQL.format(table='tickets.')}
+        FROM tickets
+        LEFT JOIN feedback ON feedback.ticket_id = tickets.id
+        WHERE status = ANY(%s)
+    '''
+    params = [description_length, list(PANEL_STATUSES)]
+    if before is not None:
+        query += f" AND ({STATUS_RANK_SQL}, tickets.id) < (%s, %s) ORDER BY {STATUS_RANK_SQL} DESC, tickets.id DESC LIMIT %s"
+        params += [before[0], before[1], limit + 1]
+    else:
+        if after is not None:
+            query += f" AND ({STATUS_RANK_SQL}, tickets.id) > (%s, %s)"
+            params += [after[0], after[1]]
+        query += f" ORDER BY {STATUS_RANK_SQL}, tickets.id LIMIT %s"
+        params.append(limit + 1)
+    try:
+        with get_connection() as conn:
+            c = conn.cursor()
+            c.execute(query, params)
+            rows = c.fetchall()
+    except Exception as e:
+        print(f"Ошибка получения страницы панели администратора: {e}")
+        return [], False, False
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if before is not None:
+        rows.reverse()
+        return rows, has_more, True
+    return rows, after is not None, has_more
+
+# Страница «Мои заявки» пользователя, включая архив, от новых к старым, вместе с оценками.
+# Пагинация по ключу (user_id, id) по индексам tickets_user_id_idx и tickets_archive_user_id_idx:
+# older_than — номер последней заявки предыдущей страницы, newer_than — первой заявки следующей.
+# Возвращает (строки, есть_старее, есть_новее); строка — (id, status, config, created_at, описание, рейтинг).
+# Страницы кэшируются в памяти до изменения заявок пользователя.
+def get_user_tickets(user_id, limit, older_than=None, newer_than=None, description_length=100):
+    key = (limit, older_than, newer_than, description_length)
+    page, version = _user_tickets_cache.get(user_id, key)
+    if page is not None:
+        return page
+
+    query = '''
+        SELECT tickets_all.id, status, config, tickets_all.created_at, left(description, %s), feedback.rating
+        FROM tickets_all
+        LEFT JOIN feedback ON feedback.ticket_id = tickets_all.id
+        WHERE user_id = %s
+    '''
+    params = [description_length, user_id]
+    if newer_than is not None:
+        query += " AND tickets_all.id > %s ORDER BY tickets_all.id LIMIT %s"
+        params += [newer_than, limit + 1]
+    else:
+        if older_than is not None:
+            query += " AND tickets_all.id < %s"
+            params.append(older_than)
+        query += " ORDER BY tickets_all.id DESC LIMIT %s"
+        params.append(limit + 1)
+    try:
+        with get_connection() as conn:
+            c = conn.cursor()
+            c.execute(query, params)
+            rows = c.fetchall()
+    except Exception as e:
+        print(f"Ошибка получения заявок пользователя: {e}")
+        return [], False, False
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if newer_than is not None:
+        rows.reverse()
+        page = (rows, True, has_more)
+    else:
+        page = (rows, has_more, older_than is not None)
+    _user_tickets_cache.put(user_id, key, page, version)
+    return page
+
+# Полнотекстовый поиск заявок, включая архив, по описанию, организации, имени и телефону
+# (индексы tickets_search_idx, tickets_archive_search_idx). Запрос разбирается как в поисковиках:
+# слова, "фраза", -исключение, or. Если запрос — номер заявки (123 или #123), эта заявка идёт первой.
+# Возвращает (строки, есть_следующая_страница);
+# строка — (id, status, user_id, config, org_dept, name, phone, описание, рейтинг).
+# Запрос подставляется в SQL как константа, поэтому планировщик видит, насколько часто слово:
+# редкое ищется по GIN-индексу, частое — обходом первичного ключа с конца до SEARCH_CANDIDATES совпадений.
+def search_tickets(text, limit, offset=0, description_length=200):
+    number = text.strip().lstrip('#')
+    ticket_id = int(number) if number.isdigit() and int(number) < 2 ** 31 else None
+    query = f'''
+        WITH matches AS (
+            (SELECT id, status, user_id, config, org_dept, name, phone,
+                    left(description, %(description_length)s) AS description,
+                    ts_rank(search_vector, websearch_to_tsquery('{SEARCH_CONFIG}', %(text)s)) AS rank,
+                    FALSE AS exact
+             FROM tickets_all
+             WHERE search_vector @@ websearch_to_tsquery('{SEARCH_CONFIG}', %(text)s)
+             ORDER BY id DESC LIMIT %(candidates)s)
+            UNION ALL
+            SELECT id, status, user_id, config, org_dept, name, phone,
+                   left(description, %(description_length)s), 0, TRUE
+            FROM tickets_all
+            WHERE id = %(ticket_id)s AND NOT search_vector @@ websearch_to_tsquery('{SEARCH_CONFIG}', %(text)s)
         )
-        c = conn.cursor()
-        c.execute("SELECT * FROM tickets WHERE status = %s", (status,))
-        result = c.fetchall()
-        return result
+        SELECT matches.id, status, user_id, config, org_dept, name, phone, description, feedback.rating
+        FROM matches
+        LEFT JOIN feedback ON feedback.ticket_id = matches.id
+        ORDER BY exact OR matches.id = %(ticket_id)s DESC, rank DESC, matches.id DESC
+        LIMIT %(limit)s OFFSET %(offset)s
+    '''
+    params = {
+        'text': text, 'ticket_id': ticket_id, 'candidates': SEARCH_CANDIDATES,
+        'description_length': description_length, 'limit': limit + 1, 'offset': offset,
+    }
+    try:
+        with get_connection() as conn:
+            c = conn.cursor()
+            c.execute(query, params)
+            rows = c.fetchall()
     except Exception as e:
-        print(f"Ошибка получения заявок: {e}")
+        print(f"Ошибка поиска заявок: {e}")
+        return [], False
+    return rows[:limit], len(rows) > limit
+
+# Забирает пачку готовых к отправке уведомлений вместе с данными заявок.
+# Забранные строки откладываются на lease_seconds, чтобы другой обработчик не взял их повторно;
+# если отправитель упадёт, уведомление снова станет доступным по истечении этого времени.
+# Заявка ищется по номеру и времени создания, поэтому читается только её раздел.
+def claim_outbox_batch(limit, lease_seconds):
+    try:
+        with get_connection() as conn:
+            c = conn.cursor()
+            c.execute('''
+                WITH claimed AS (
+                    UPDATE email_outbox
+                    SET attempts = attempts + 1,
+                        next_attempt_at = now() + make_interval(secs => %s)
+                    WHERE id IN (
+                        SELECT id FROM email_outbox
+                        WHERE status = 'pending' AND next_attempt_at <= now()
+                        ORDER BY next_attempt_at
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING id, ticket_id, ticket_created_at, attachments, attempts
+                )
+                SELECT claimed.id, claimed.ticket_id, claimed.attachments, claimed.attempts,
+                       t.config, t.org_dept, t.name, t.phone, t.description
+                FROM claimed
+                LEFT JOIN tickets t ON t.id = claimed.ticket_id AND t.created_at = claimed.ticket_created_at
+                ORDER BY claimed.id
+            ''', (lease_seconds, limit))
+            result = c.fetchall()
+            conn.commit()
+            return result
+    except Exception as e:
+        print(f"Ошибка получения уведомлений из очереди: {e}")
         return []
-    finally:
-        if conn:
-            conn.close()
-
-def save_feedback(ticket_id, rating):
-    conn = None
-    try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            user=DB_USER,
-            password=DB_PASS,
-            database=DB_NAME
-        )
-        c = conn.cursor()
-        c.execute("INSERT INTO feedback (ticket_id, rating) VALUES (%s, %s) ON CONFLICT (ticket_id) DO UPDATE SET rating = %s",
-                  (ticket_id, rating, rating))
-        conn.commit()
+
+def mark_outbox_sent(outbox_id):
+    try:
+        with get_connection() as conn:
+            c = conn.cursor()
+            c.execute(
+                "UPDATE email_outbox SET status = 'sent', sent_at = now(), last_error = NULL WHERE id = %s",
+                (outbox_id,)
+            )
+            conn.commit()
     except Exception as e:
-        print(f"Ошибка сохранения отзыва: {e}")
-    finally:
-        if conn:
-            conn.close()
-
-def get_feedback(ticket_id):
-    conn = None
-    try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            user=DB_USER,
-            password=DB_PASS,
-            database=DB_NAME
-        )
-        c = conn.cursor()
-        c.execute("SELECT rating FROM feedback WHERE ticket_id = %s", (ticket_id,))
-        result = c.fetchone()
-        return result[0] if result else None
+        print(f"Ошибка обновления уведомления {outbox_id}: {e}")
+
+def mark_outbox_retry(outbox_id, error, delay_seconds):
+    try:
+        with get_connection() as conn:
+            c = conn.cursor()
+            c.execute(
+                "UPDATE email_outbox SET next_attempt_at = now() + make_interval(secs => %s), last_error = %s WHERE id = %s",
+                (delay_seconds, error, outbox_id)
+            )
+            conn.commit()
+    except Exception as e:
+        print(f"Ошибка обновления уведомления {outbox_id}: {e}")
+
+def mark_outbox_failed(outbox_id, error):
+    try:
+        with get_connection() as conn:
+            c = conn.cursor()
+            c.execute(
+                "UPDATE email_outbox SET status = 'failed', last_error = %s WHERE id = %s",
+                (error, outbox_id)
+            )
+            conn.commit()
+    except Exception as e:
+        print(f"Ошибка обновления уведомления {outbox_id}: {e}")
+
+# Пути вложений, которые ещё нужны: письма в очереди и незаконченные заявки
+def get_referenced_attachments():
+    try:
+        with get_connection() as conn:
+            c = conn.cursor()
+            c.execute('''
+                SELECT unnest(attachments) FROM email_outbox WHERE status = 'pending'
+                UNION
+                SELECT jsonb_array_elements_text(data->'attachments') FROM user_data
+                WHERE jsonb_typeof(data->'attachments') = 'array'
+            ''')
+            return [row[0] for row in c.fetchall()]
     except Exception as e:
-        print(f"Ошибка получения отзыва: {e}")
+        print(f"Ошибка получения списка вложений: {e}")
         return None
-    finally:
-        if conn:
-            conn.close()
\ No newline at end of file
+
+# Состояние диалогов (user_data) для PostgresPersistence.
+# Без since загружает всё не старше max_age_days и удаляет заброшенные диалоги;
+# с since — только строки, изменённые после этого момента.
+def load_user_data(max_age_days, since=None):
+    try:
+        with get_connection() as conn:
+            c = conn.cursor()
+            if since is None:
+                c.execute(
+                    "DELETE FROM user_data WHERE updated_at < now() - make_interval(days => %s)",
+                    (max_age_days,)
+                )
+                c.execute("SELECT user_id, data, updated_at FROM user_data")
+            else:
+                c.execute("SELECT user_id, data, updated_at FROM user_data WHERE updated_at > %s", (since,))
+            result = c.fetchall()
+            conn.commit()
+            return result
+    except Exception as e:
+        print(f"Ошибка загрузки состояния диалогов: {e}")
+        return []
+
+# (data, updated_at) пользователя или None
+def get_user_data_row(user_id):
+    try:
+        with get_connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT data, updated_at FROM user_data WHERE user_id = %s", (user_id,))
+            return c.fetchone()
+    except Exception as e:
+        print(f"Ошибка загрузки состояния диалога {user_id}: {e}")
+        return None
+
+# Записывает пачку состояний одним запросом: upserts — пары (user_id, JSON), deletes — user_id.
+# Возвращает {user_id: updated_at} записанных строк или None при ошибке.
+def save_user_data_batch(upserts, deletes):
+    try:
+        with get_connection() as conn:
+            c = conn.cursor()
+            stamps = {}
+            if upserts:
+                rows = execute_values(c, '''
+                    INSERT INTO user_data (user_id, data) VALUES %s
+                    ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data, updated_at = now()
+                    RETURNING user_id, updated_at
+                ''', upserts, template="(%s, %s::jsonb)", fetch=True)
+                stamps.update(rows)
+            if deletes:
+                c.execute("DELETE FROM user_data WHERE user_id = ANY(%s)", (list(deletes),))
+            conn.commit()
+            return stamps
+    except Exception as e:
+        print(f"Ошибка сохранения состояния диалогов: {e}")
+        return None
+
+# Сообщения будут удалены из чатов через delay секунд (см. message_expiry.py);
+# messages — список (chat_id, message_id), записываются одним запросом
+def schedule_message_deletion(messages, delay):
+    if not messages:
+        return True
+    try:
+        with get_connection() as conn:
+            c = conn.cursor()
+            execute_values(c, '''
+                INSERT INTO message_expiry (chat_id, message_id, expires_at) VALUES %s
+                ON CONFLICT (chat_id, message_id) DO UPDATE SET expires_at = EXCLUDED.expires_at
+            ''', [(chat_id, message_id, delay) for chat_id, message_id in messages],
+                template="(%s, %s, now() + make_interval(secs => %s))")
+            conn.commit()
+            return True
+    except Exception as e:
+        print(f"Ошибка планирования удаления сообщений {messages}: {e}")
+        return False
+
+def get_expired_messages(limit):
+    try:
+        with get_connection() as conn:
+            c = conn.cursor()
+            c.execute('''
+                SELECT chat_id, message_id FROM message_expiry
+                WHERE expires_at <= now()
+                ORDER BY expires_at
+                LIMIT %s
+            ''', (limit,))
+            return c.fetchall()
+    except Exception as e:
+        print(f"Ошибка получения сообщений для удаления: {e}")
+        return []
+
+# messages — список (chat_id, message_id)
+def remove_message_expiry(messages):
+    if not messages:
+        return
+    try:
+        with get_connection() as conn:
+            c = conn.cursor()
+            execute_values(c, '''
+                DELETE FROM message_expiry e USING (VALUES %s) AS v (chat_id, message_id)
+                WHERE e.chat_id = v.chat_id AND e.message_id = v.message_id
+            ''', messages, template="(%s::bigint, %s::bigint)")
+            conn.commit()
+    except Exception as e:
+        print(f"Ошибка удаления записей об удалённых сообщениях: {e}")
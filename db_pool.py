@@ -0,0 +1,246 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+
+logger = logging.getLogger(__name__)
+
+
+# Не удалось дождаться свободного соединения за отведённое время
+class PoolTimeoutError(Exception):
+    pass
+
+
+# Соединение из пула вместе с метками времени для проверки и переработки
+class _PooledConnection:
+    __slots__ = ('conn', 'created_at', 'last_used')
+
+    def __init__(self, conn):
+        now = time.monotonic()
+        self.conn = conn
+        self.created_at = now
+        self.last_used = now
+
+
+# Пул соединений с PostgreSQL с ограничением размера.
+# Соединения проверяются перед выдачей, простаивающие сверх min закрываются,
+# слишком старые пересоздаются.
+class ConnectionPool:
+    def __init__(self, minconn, maxconn, timeout=10.0, max_idle=300.0, max_lifetime=3600.0,
+                 health_check_interval=30.0, **connect_kwargs):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError(f"Некорректные размеры пула: min={minconn}, max={maxconn}")
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.health_check_interval = health_check_interval
+        self._connect_kwargs = connect_kwargs
+
+        self._cond = threading.Condition()
+        self._idle = []      # стек свободных соединений: последнее возвращённое выдаётся первым
+        self._in_use = {}    # id(conn) -> _PooledConnection
+        self._opening = 0    # соединения, которые сейчас устанавливаются или проверяются
+        self._closed = False
+
+        self._counters = {
+            'checkouts': 0,
+            'waits': 0,
+            'wait_time': 0.0,
+            'timeouts': 0,
+            'creations': 0,
+            'health_check_failures': 0,
+            'recycled': 0,
+        }
+
+    # Открывает минимальное количество соединений заранее
+    def open(self):
+        for _ in range(self.minconn):
+            with self._cond:
+                if self._size() >= self.minconn:
+                    return
+                self._opening += 1
+            try:
+                entry = self._create()
+            except Exception:
+                with self._cond:
+                    self._opening -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._opening -= 1
+                self._idle.append(entry)
+                self._cond.notify()
+
+    def _size(self):
+        return len(self._idle) + len(self._in_use) + self._opening
+
+    def _create(self):
+        conn = psycopg2.connect(**self._connect_kwargs)
+        with self._cond:
+            self._counters['creations'] += 1
+        return _PooledConnection(conn)
+
+    def _close_entry(self, entry):
+        try:
+            entry.conn.close()
+        except Exception as e:
+            logger.warning(f"Ошибка при закрытии соединения с БД: {e}")
+
+    # Проверяет соединение, простоявшее дольше health_check_interval
+    def _is_healthy(self, entry, now):
+        if entry.conn.closed:
+            return False
+        if self.max_lifetime and now - entry.created_at > self.max_lifetime:
+            with self._cond:
+                self._counters['recycled'] += 1
+            return False
+        if now - entry.last_used < self.health_check_interval:
+            return True
+        try:
+            c = entry.conn.cursor()
+            c.execute("SELECT 1")
+            c.fetchone()
+            entry.conn.rollback()
+            return True
+        except Exception as e:
+            logger.warning(f"Соединение с БД не прошло проверку: {e}")
+            with self._cond:
+                self._counters['health_check_failures'] += 1
+            return False
+
+    # Закрывает свободные соединения, простоявшие дольше max_idle, оставляя не меньше minconn.
+    # Вызывается под self._cond и возвращает соединения, которые нужно закрыть вне блокировки.
+    def _collect_idle(self, now):
+        expired = []
+        if not self.max_idle:
+            return expired
+        # Самые давно неиспользуемые соединения лежат в начале стека
+        while self._idle and self._size() > self.minconn and now - self._idle[0].last_used > self.max_idle:
+            expired.append(self._idle.pop(0))
+            self._counters['recycled'] += 1
+        return expired
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        waited_since = None
+        while True:
+            entry = None
+            create = False
+            with self._cond:
+                if self._closed:
+                    raise psycopg2.InterfaceError("Пул соединений закрыт")
+                while not self._idle and self._size() >= self.maxconn:
+                    if waited_since is None:
+                        waited_since = time.monotonic()
+                        self._counters['waits'] += 1
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._counters['timeouts'] += 1
+                        raise PoolTimeoutError(
+                            f"Нет свободных соединений с БД за {self.timeout} с (max={self.maxconn})"
+                        )
+                    self._cond.wait(remaining)
+                    if self._closed:
+                        raise psycopg2.InterfaceError("Пул соединений закрыт")
+                if self._idle:
+                    entry = self._idle.pop()
+                else:
+                    create = True
+                self._opening += 1
+
+            if create:
+                try:
+                    entry = self._create()
+                except Exception:
+                    with self._cond:
+                        self._opening -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._is_healthy(entry, time.monotonic()):
+                self._close_entry(entry)
+                with self._cond:
+                    self._opening -= 1
+                    self._cond.notify()
+                continue
+
+            with self._cond:
+                self._opening -= 1
+                self._in_use[id(entry.conn)] = entry
+                self._counters['checkouts'] += 1
+                if waited_since is not None:
+                    self._counters['wait_time'] += time.monotonic() - waited_since
+            return entry.conn
+
+    def putconn(self, conn, discard=False):
+        with self._cond:
+            entry = self._in_use.get(id(conn))
+            closed = self._closed
+        if entry is None and closed:
+            # Пул закрыли, пока соединение было выдано
+            conn.close()
+            return
+        if entry is None:
+            raise psycopg2.InterfaceError("Соединение не принадлежит пулу")
+
+        if not discard and not conn.closed:
+            # Незавершённая транзакция не должна достаться следующему пользователю
+            try:
+                if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                discard = True
+        else:
+            discard = True
+
+        now = time.monotonic()
+        with self._cond:
+            self._in_use.pop(id(conn), None)
+            if discard or self._closed:
+                expired = [entry]
+            else:
+                entry.last_used = now
+                self._idle.append(entry)
+                expired = self._collect_idle(now)
+            self._cond.notify()
+        for item in expired:
+            self._close_entry(item)
+
+    # Выдаёт соединение на время блока with. После сетевых ошибок соединение выбрасывается.
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        discard = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            discard = True
+            raise
+        finally:
+            self.putconn(conn, discard=discard or conn.closed)
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            in_use = list(self._in_use.values())
+            self._in_use.clear()
+            self._cond.notify_all()
+        for entry in idle + in_use:
+            self._close_entry(entry)
+
+    def stats(self):
+        with self._cond:
+            result = dict(self._counters)
+            result.update({
+                'size': self._size(),
+                'idle': len(self._idle),
+                'in_use': len(self._in_use),
+                'min': self.minconn,
+                'max': self.maxconn,
+            })
+        return result
@@ -0,0 +1,161 @@
+# Выгрузка заявок с оценками в CSV или XLSX для отчётности.
+# Строки читаются из БД курсором на сервере и сразу пишутся в файл, поэтому
+# расход памяти не зависит от числа заявок.
+#
+# Пример:
+#   python export.py tickets_2026_09.xlsx --from 2026-09-01 --to 2026-09-30
+#   python export.py resolved.csv --status Решено --config ЗУП --config УТ
+import argparse
+import contextlib
+import csv
+import datetime
+import os
+import re
+import sys
+import zipfile
+from xml.sax.saxutils import escape
+
+from database import iter_tickets_for_export, close_pool
+
+# Разделитель CSV: точка с запятой, чтобы файл открывался в русском Excel по столбцам
+CSV_DELIMITER = ';'
+# Сколько строк читать с сервера за раз
+EXPORT_BATCH_SIZE = 1000
+
+EXPORT_FORMATS = ('csv', 'xlsx')
+EXPORT_COLUMNS = (
+    "Номер", "Создана", "Изменена", "Статус", "Конфигурация", "Организация/отдел",
+    "Имя", "Телефон", "UserID", "Описание", "Оценка",
+)
+
+# Символы, недопустимые в XML (кроме табуляции и переводов строки)
+_XML_INVALID = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def _format_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return value
+
+
+def write_csv(rows, path):
+    count = 0
+    # utf-8-sig: Excel распознаёт кодировку по BOM
+    with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+        writer = csv.writer(f, delimiter=CSV_DELIMITER)
+        writer.writerow(EXPORT_COLUMNS)
+        for row in rows:
+            writer.writerow([_format_value(value) for value in row])
+            count += 1
+    return count
+
+
+# Минимальная книга XLSX из одного листа. Лист пишется в архив потоком по строке,
+# строки хранятся прямо в ячейках (inlineStr), без общей таблицы строк в памяти.
+_XLSX_STATIC = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+        'Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    'xl/workbook.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Заявки" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'
+    ),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+        'Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'
+    ),
+}
+
+
+def _xlsx_cell(value):
+    value = _format_value(value)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return f'<c><v>{value}</v></c>'
+    text = escape(_XML_INVALID.sub('', str(value)))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def write_xlsx(rows, path):
+    count = 0
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, content in _XLSX_STATIC.items():
+            archive.writestr(name, content)
+        with archive.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write((
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+            ).encode())
+            sheet.write(('<row>' + ''.join(_xlsx_cell(title) for title in EXPORT_COLUMNS) + '</row>').encode())
+            for row in rows:
+                sheet.write(('<row>' + ''.join(_xlsx_cell(value) for value in row) + '</row>').encode())
+                count += 1
+            sheet.write(b'</sheetData></worksheet>')
+    return count
+
+
+# Выгружает заявки в path; fmt — 'csv' или 'xlsx'. Возвращает число выгруженных заявок.
+# Синхронная: из бота вызывается в пуле потоков БД.
+def export_tickets(path, fmt, statuses=None, date_from=None, date_to=None, configs=None):
+    writer = write_xlsx if fmt == 'xlsx' else write_csv
+    rows = iter_tickets_for_export(statuses, date_from, date_to, configs, EXPORT_BATCH_SIZE)
+    with contextlib.closing(rows):
+        return writer(rows, path)
+
+
+# Граница периода: дата (с начала суток UTC); date_to включительно, поэтому сдвигается на сутки
+def export_bounds(date_from=None, date_to=None):
+    def midnight(day):
+        return datetime.datetime.combine(day, datetime.time(), datetime.timezone.utc)
+    return (
+        midnight(date_from) if date_from else None,
+        midnight(date_to + datetime.timedelta(days=1)) if date_to else None,
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Выгрузка заявок с оценками в CSV или XLSX")
+    parser.add_argument('path', help="файл выгрузки; формат по расширению, если не задан --format")
+    parser.add_argument('--format', choices=EXPORT_FORMATS)
+    parser.add_argument('--status', action='append', help="статус заявки (можно несколько раз)")
+    parser.add_argument('--config', action='append', help="конфигурация (можно несколько раз)")
+    parser.add_argument('--from', dest='date_from', type=datetime.date.fromisoformat, help="созданные с даты, ГГГГ-ММ-ДД")
+    parser.add_argument('--to', dest='date_to', type=datetime.date.fromisoformat, help="созданные по дату включительно")
+    args = parser.parse_args()
+
+    fmt = args.format or os.path.splitext(args.path)[1].lstrip('.').lower()
+    if fmt not in EXPORT_FORMATS:
+        parser.error("укажите --format csv или xlsx")
+    date_from, date_to = export_bounds(args.date_from, args.date_to)
+    try:
+        count = export_tickets(args.path, fmt, args.status, date_from, date_to, args.config)
+    except Exception as e:
+        print(f"Ошибка выгрузки заявок: {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        close_pool()
+    print(f"Выгружено заявок: {count} -> {args.path}")
@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import os
+
+from dotenv import load_dotenv
+from telegram.error import BadRequest
+
+# Загружаем переменные из .env
+load_dotenv()
+
+# Сколько ждать следующее изменение сообщения о ходе заявки, прежде чем отправить последнее, с
+LIVE_MESSAGE_DEBOUNCE = float(os.getenv("LIVE_MESSAGE_DEBOUNCE", "0.5"))
+
+logger = logging.getLogger(__name__)
+
+
+class _ChatUpdate:
+    def __init__(self, bot, user_data, text, reply_markup):
+        self.set(bot, user_data, text, reply_markup)
+        self.wake = asyncio.Event()
+        self.task = None
+
+    def set(self, bot, user_data, text, reply_markup):
+        self.bot, self.user_data, self.text, self.reply_markup = bot, user_data, text, reply_markup
+        self.changed = True
+
+
+# Одно «живое» сообщение о ходе заявки в чате. Его ID хранится в user_data['last_message_id'],
+# новое содержимое показывается изменением этого сообщения (один запрос вместо удаления и отправки).
+# show() не ждёт отправки: изменение откладывается на delay секунд, и если за это время
+# (или пока идёт предыдущее изменение) пришли новые варианты, отправляется только последний.
+# Так серия отдельных вложений даёт одно изменение сообщения. show(wait=True) отправляет
+# отложенное сразу и возвращает ID сообщения — для итогового текста, после которого
+# user_data очищается; discard() отменяет отложенное, когда сообщение нужно для другого.
+# Если сообщение изменить нельзя (удалено, слишком старое), оно удаляется и отправляется новое.
+class LiveMessage:
+    def __init__(self, delay=LIVE_MESSAGE_DEBOUNCE):
+        self.delay = delay
+        self._chats = {}    # chat_id -> _ChatUpdate, ожидающее отправки или отправляемое
+        self.edits = 0
+        self.sends = 0
+        self.coalesced = 0
+
+    async def show(self, bot, chat_id, user_data, text, reply_markup=None, wait=False):
+        current = self._chats.get(chat_id)
+        if current is None:
+            current = self._chats[chat_id] = _ChatUpdate(bot, user_data, text, reply_markup)
+            current.task = asyncio.create_task(self._flush(chat_id, current))
+        else:
+            current.set(bot, user_data, text, reply_markup)
+            self.coalesced += 1
+        if wait:
+            current.wake.set()
+            return await asyncio.shield(current.task)
+        return None
+
+    # Отмена отложенного изменения; начатое изменение дожидается завершения
+    async def discard(self, chat_id):
+        current = self._chats.get(chat_id)
+        if current is not None:
+            current.changed = False
+            current.wake.set()
+            await asyncio.shield(current.task)
+
+    # Отправка всех отложенных изменений, например перед остановкой бота
+    async def flush_all(self):
+        entries = list(self._chats.values())
+        for current in entries:
+            current.wake.set()
+        await asyncio.gather(*(current.task for current in entries))
+
+    async def _flush(self, chat_id, current):
+        message_id = None
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(current.wake.wait(), self.delay)
+                except asyncio.TimeoutError:
+                    pass
+                current.wake.clear()
+                # discard() мог отменить отложенное
+                if not current.changed:
+                    return message_id
+                current.changed = False
+                try:
+                    message_id = await self._apply(current.bot, chat_id, current.user_data,
+                                                   current.text, current.reply_markup)
+                except Exception as e:
+                    logger.error(f"Ошибка обновления сообщения о ходе заявки в чате {chat_id}: {e}")
+                    message_id = None
+                # Варианты, пришедшие во время изменения, тоже ждут delay и уходят следующим проходом
+                if not current.changed:
+                    return message_id
+        finally:
+            del self._chats[chat_id]
+
+    async def _apply(self, bot, chat_id, user_data, text, reply_markup):
+        message_id = user_data.get('last_message_id')
+        if message_id is not None:
+            try:
+                await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, reply_markup=reply_markup)
+                self.edits += 1
+                return message_id
+            except BadRequest as e:
+                if 'not modified' in str(e).lower():
+                    return message_id
+                logger.info(f"Сообщение {message_id} в чате {chat_id} не изменить ({e}), отправляем новое")
+            # Удаляем старое сообщение, чтобы в чате не осталось двух
+            try:
+                await bot.delete_message(chat_id=chat_id, message_id=message_id)
+            except Exception as e:
+                logger.error(f"Ошибка при удалении сообщения: {e}")
+        message = await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
+        self.sends += 1
+        user_data['last_message_id'] = message.message_id
+        return message.message_id
+
+    def stats(self):
+        return {'edits': self.edits, 'sends': self.sends, 'coalesced': self.coalesced}
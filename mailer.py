@@ -0,0 +1,311 @@
+import asyncio
+import base64
+import logging
+import os
+import random
+import smtplib
+import ssl
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from email import policy
+from email.message import EmailMessage
+from email.mime.base import MIMEBase
+from email.mime.text import MIMEText
+from email.utils import formatdate, make_msgid
+
+from dotenv import load_dotenv
+
+from async_db import claim_outbox_batch, mark_outbox_sent, mark_outbox_retry, mark_outbox_failed
+from attachments import display_name, remove_attachments
+from metrics import SMTP_DURATION
+
+# Загружаем переменные из .env
+load_dotenv()
+
+# Настройки email для Яндекс.Почты
+EMAIL_HOST = os.getenv("EMAIL_HOST")
+EMAIL_PORT = int(os.getenv("EMAIL_PORT"))
+EMAIL_USER = os.getenv("EMAIL_USER")
+EMAIL_PASS = os.getenv("EMAIL_PASS")
+ADMIN_EMAIL = os.getenv("ADMIN_EMAIL")
+# Соединение с SMTP-сервером через SSL (порт 465); 0 — без шифрования, например с локальным сервером для тестов
+EMAIL_USE_SSL = os.getenv("EMAIL_USE_SSL", "1") == "1"
+
+# Параметры очереди уведомлений
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "10"))   # как часто проверять очередь без сигнала, с
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "20"))
+OUTBOX_LEASE = float(os.getenv("OUTBOX_LEASE", "300"))                  # на сколько откладывается забранное уведомление, с
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "30"))     # пауза после первой неудачи, с
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "3600"))
+SMTP_KEEPALIVE = float(os.getenv("SMTP_KEEPALIVE", "60"))               # закрывать сессию после простоя, с
+
+logger = logging.getLogger(__name__)
+
+# Сколько байт файла кодировать в base64 за раз: кратно 57, чтобы каждая строка была полной (76 символов)
+BASE64_CHUNK = 57 * 1152
+
+# Письмо, которое собирается по частям прямо во время отправки: вложения читаются с диска
+# и кодируются в base64 блоками, поэтому ни файл, ни письмо целиком в памяти не лежат.
+# chunks() можно вызвать повторно, если отправку пришлось начать заново.
+class StreamedMessage:
+    def __init__(self, from_addr, to_addr, subject, body, attachments=None):
+        self.from_addr = from_addr
+        self.to_addr = to_addr
+        self.subject = subject
+        self.body = body
+        self.attachments = []
+        self.missing = []       # вложения, которых нет на диске этого экземпляра
+        for file_path in attachments or []:
+            if os.path.exists(file_path):
+                self.attachments.append(file_path)
+            else:
+                self.missing.append(file_path)
+        self.boundary = f"==={uuid.uuid4().hex}=="
+        self.message_id = make_msgid()
+
+    def _headers(self):
+        msg = EmailMessage(policy=policy.SMTP)
+        msg['Subject'] = self.subject
+        msg['From'] = self.from_addr
+        msg['To'] = self.to_addr
+        msg['Date'] = formatdate(localtime=True)
+        msg['Message-ID'] = self.message_id
+        msg['MIME-Version'] = '1.0'
+        msg['Content-Type'] = f'multipart/mixed; boundary="{self.boundary}"'
+        # Только заголовки: тело multipart формируется в chunks()
+        return b''.join(policy.SMTP.fold_binary(name, value) for name, value in msg.items()) + b"\r\n"
+
+    @staticmethod
+    def _attachment_headers(file_path):
+        name = display_name(file_path)
+        part = MIMEBase('application', 'octet-stream')
+        part['Content-Transfer-Encoding'] = 'base64'
+        if name.isascii():
+            part.add_header('Content-Disposition', 'attachment', filename=name)
+        else:
+            part.add_header('Content-Disposition', 'attachment', filename=('utf-8', '', name))
+        return part.as_bytes(policy=policy.SMTP)
+
+    # Части письма в формате, готовом для команды DATA (строки через CRLF).
+    # Строк, начинающихся с точки, в письме нет: тело и вложения закодированы в base64.
+    def chunks(self):
+        delimiter = f"--{self.boundary}\r\n".encode()
+        yield self._headers()
+        yield delimiter
+        yield MIMEText(self.body, 'plain', 'utf-8').as_bytes(policy=policy.SMTP) + b"\r\n"
+        for file_path in self.attachments:
+            yield delimiter
+            yield self._attachment_headers(file_path)
+            with open(file_path, 'rb') as f:
+                while True:
+                    chunk = f.read(BASE64_CHUNK)
+                    if not chunk:
+                        break
+                    yield base64.encodebytes(chunk).replace(b"\n", b"\r\n")
+        yield f"--{self.boundary}--\r\n".encode()
+
+# Формирует письмо с заявкой для администратора
+def build_message(ticket_id, config, org_dept, name, phone, description, attachments=None):
+    subject = f"Новая заявка #{ticket_id} в техподдержку"
+    body = (
+        f"Новая заявка #{ticket_id}:\n"
+        f"Конфигурация: {config}\n"
+        f"Организация и отдел: {org_dept}\n"
+        f"Имя: {name}\n"
+        f"Номер телефона: {phone}\n"
+        f"Описание: {description}\n"
+        f"Статус: Принято"
+    )
+    # Адрес отправителя совпадает с логином SMTP
+    return StreamedMessage(EMAIL_USER, ADMIN_EMAIL, subject, body, attachments)
+
+# Постоянная авторизованная SMTP-сессия. Используется только из одного потока.
+class SmtpSession:
+    def __init__(self, host=None, port=None, user=None, password=None, keepalive=SMTP_KEEPALIVE):
+        self.host = host or EMAIL_HOST
+        self.port = port or EMAIL_PORT
+        self.user = user or EMAIL_USER
+        self.password = password or EMAIL_PASS
+        self.keepalive = keepalive
+        self._server = None
+        self._last_used = 0.0
+        self.connects = 0
+
+    def _connect(self):
+        if EMAIL_USE_SSL:
+            # Используем SMTP_SSL для порта 465
+            server = smtplib.SMTP_SSL(self.host, self.port, context=ssl.create_default_context(), timeout=60)
+        else:
+            server = smtplib.SMTP(self.host, self.port, timeout=60)
+        try:
+            if self.user:
+                server.login(self.user, self.password)
+        except Exception:
+            server.close()
+            raise
+        self._server = server
+        self.connects += 1
+        logger.info(f"Открыта SMTP-сессия с {self.host}:{self.port}")
+
+    # Возвращает рабочую сессию: после долгого простоя проверяет её командой NOOP
+    def _ensure(self):
+        if self._server is not None and time.monotonic() - self._last_used > self.keepalive / 2:
+            try:
+                code, _ = self._server.noop()
+                if code != 250:
+                    self.close()
+            except smtplib.SMTPException:
+                self.close()
+            except OSError:
+                self.close()
+        if self._server is None:
+            self._connect()
+        return self._server
+
+    def send(self, msg):
+        try:
+            self._transmit(self._ensure(), msg)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            # Сервер закрыл соединение между письмами — переподключаемся один раз
+            self.close()
+            self._transmit(self._ensure(), msg)
+        self._last_used = time.monotonic()
+
+    # Транзакция MAIL/RCPT/DATA, в которой письмо передаётся серверу по частям.
+    # smtplib.send_message требует письмо целиком в памяти, поэтому команды отправляются вручную.
+    @staticmethod
+    def _transmit(server, msg):
+        server.ehlo_or_helo_if_needed()
+        code, response = server.mail(msg.from_addr)
+        if code != 250:
+            raise smtplib.SMTPSenderRefused(code, response, msg.from_addr)
+        code, response = server.rcpt(msg.to_addr)
+        if code not in (250, 251):
+            raise smtplib.SMTPRecipientsRefused({msg.to_addr: (code, response)})
+        code, response = server.docmd('data')
+        if code != 354:
+            raise smtplib.SMTPDataError(code, response)
+        for chunk in msg.chunks():
+            server.send(chunk)
+        server.send(b".\r\n")
+        code, response = server.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, response)
+
+    # Закрывает сессию, если она простаивает дольше keepalive
+    def close_if_idle(self):
+        if self._server is not None and time.monotonic() - self._last_used > self.keepalive:
+            self.close()
+
+    def close(self):
+        if self._server is None:
+            return
+        server, self._server = self._server, None
+        try:
+            server.quit()
+        except Exception:
+            server.close()
+
+# Фоновая отправка уведомлений из таблицы email_outbox.
+# Заявка считается принятой сразу после сохранения; письмо уходит отсюда,
+# а при ошибке повторяется с экспоненциальной паузой.
+class EmailOutboxWorker:
+    def __init__(self, session=None):
+        self._session = session or SmtpSession()
+        # Одна SMTP-сессия — один поток
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='smtp')
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    # Сообщает, что в очереди появилось новое уведомление
+    def notify(self):
+        self._wakeup.set()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._session.close)
+        self._executor.shutdown(wait=True)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                processed = await self.process_batch()
+            except Exception as e:
+                logger.error(f"Ошибка обработки очереди уведомлений: {e}")
+                processed = 0
+            if processed >= OUTBOX_BATCH_SIZE:
+                continue
+            await loop.run_in_executor(self._executor, self._session.close_if_idle)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def process_batch(self):
+        rows = await claim_outbox_batch(OUTBOX_BATCH_SIZE, OUTBOX_LEASE)
+        for row in rows:
+            await self._deliver(*row)
+        return len(rows)
+
+    async def _deliver(self, outbox_id, ticket_id, attachments, attempts, config, org_dept, name, phone, description):
+        if config is None and description is None:
+            logger.error(f"Заявка #{ticket_id} для уведомления {outbox_id} не найдена")
+            await mark_outbox_failed(outbox_id, "ticket not found")
+            remove_attachments(attachments)
+            return
+
+        msg = build_message(ticket_id, config, org_dept, name, phone, description, attachments)
+        if msg.missing:
+            # Файлы сохранены на диск другого экземпляра или общий том недоступен: письмо без них
+            # не отправляем, а откладываем, как при ошибке SMTP
+            error = f"attachments not found: {', '.join(msg.missing)}"
+            logger.error(f"Вложения заявки #{ticket_id} не найдены (попытка {attempts}): {', '.join(msg.missing)}")
+            await self._retry_or_fail(outbox_id, ticket_id, attachments, attempts, error)
+            return
+
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            await loop.run_in_executor(self._executor, self._session.send, msg)
+            SMTP_DURATION.observe(time.perf_counter() - started, 'sent')
+        except Exception as e:
+            SMTP_DURATION.observe(time.perf_counter() - started, 'error')
+            if isinstance(e, smtplib.SMTPAuthenticationError):
+                logger.error(f"Ошибка аутентификации: Проверьте логин ({EMAIL_USER}) и пароль. Ошибка: {e}")
+            elif isinstance(e, smtplib.SMTPConnectError):
+                logger.error(f"Ошибка соединения с {EMAIL_HOST}:{EMAIL_PORT}. Проверьте порт и доступность сервера. Ошибка: {e}")
+            else:
+                logger.error(f"Ошибка отправки email по заявке #{ticket_id} (попытка {attempts}): {e}")
+            await loop.run_in_executor(self._executor, self._session.close)
+            await self._retry_or_fail(outbox_id, ticket_id, attachments, attempts, str(e))
+            return
+
+        await mark_outbox_sent(outbox_id)
+        logger.info(f"Email с заявкой #{ticket_id} отправлен на {ADMIN_EMAIL} через {EMAIL_HOST} (порт {EMAIL_PORT})")
+        remove_attachments(attachments)
+
+    # Повтор с экспоненциальной паузой; после OUTBOX_MAX_ATTEMPTS попыток уведомление помечается неудачным
+    async def _retry_or_fail(self, outbox_id, ticket_id, attachments, attempts, error):
+        if attempts >= OUTBOX_MAX_ATTEMPTS:
+            logger.error(f"Уведомление по заявке #{ticket_id} не отправлено после {attempts} попыток")
+            await mark_outbox_failed(outbox_id, error)
+            remove_attachments(attachments)
+        else:
+            delay = min(OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1), OUTBOX_BACKOFF_MAX)
+            delay *= random.uniform(0.8, 1.2)
+            await mark_outbox_retry(outbox_id, error, delay)
@@ -1,19 +1,48 @@
+import asyncio
+import datetime
 import logging
 import os
-import sys
-import smtplib
-import ssl
-from email import encoders
-from email.mime.base import MIMEBase
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+import tempfile
 from dotenv import load_dotenv
 
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, filters, CallbackQueryHandler
+from telegram.error import BadRequest
+from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, filters, CallbackQueryHandler, TypeHandler
 
 # Импорт функции для работы с БД
-from database import init_db, add_admin, is_admin, save_ticket, update_status, get_user_id_by_ticket, get_tickets_by_status, save_feedback, get_feedback
+from database import init_db, add_admin, close_pool, start_admin_listener, stop_admin_listener, database_connect_kwargs, get_referenced_attachments, get_pool_stats, get_admin_cache_stats, get_user_tickets_cache_stats
+# Асинхронные версии для обработчиков: запросы выполняются вне цикла событий
+from async_db import run_db, is_admin, save_ticket, bulk_update_status, save_feedback, get_admin_panel_page, search_tickets, get_user_tickets, get_ticket_stats, shutdown_executor
+# Фоновая отправка email-уведомлений
+from mailer import EmailOutboxWorker
+# Получение обновлений через webhook
+from webhook import BOT_MODE, run_webhook
+# Выбор лидера среди экземпляров бота
+from coordination import create_elector, run_polling
+# Хранение состояния диалогов в PostgreSQL
+from persistence import PostgresPersistence
+# Параллельная обработка обновлений с сохранением порядка внутри пользователя
+from update_processor import ChatOrderedUpdateProcessor
+# Планировщик исходящих запросов с учётом лимитов Telegram
+from rate_limiter import OutboundScheduler, PRIORITY_BULK
+# Загрузка вложений в отдельный каталог с ограничениями размера
+from attachments import AttachmentLimitError, download_attachment, attachments_size, remove_attachments, cleanup_orphans, close_http_client, get_cache_stats
+# Сборка альбомов из отдельных обновлений
+from media_groups import MediaGroupCollector
+# Сообщение о ходе заявки, изменяемое на месте
+from live_message import LiveMessage
+# Отложенное удаление сообщений
+from message_expiry import MESSAGE_EXPIRY_INTERVAL, expire_message, expire_messages, sweep_expired_messages
+# Границы гистограммы времени решения в сводной статистике
+from migrations import RESOLVE_TIME_BUCKETS
+# Разделы заявок и архив решённых заявок
+from ticket_retention import TICKET_MAINTENANCE_INTERVAL, maintain_tickets
+# Метрики в формате Prometheus
+from metrics import MetricsServer, add_collector, timed_handler
+# Трассировка медленных обновлений
+from tracing import traced
+
+from export import EXPORT_FORMATS, export_bounds, export_tickets
 
 # Загружаем переменные из .env
 load_dotenv()
@@ -21,23 +50,69 @@ load_dotenv()
 # Токен бота
 TOKEN = os.getenv("BOT_TOKEN")
 
-# Настройки email для Яндекс.Почты
-EMAIL_HOST = os.getenv("EMAIL_HOST")
-EMAIL_PORT = int(os.getenv("EMAIL_PORT"))
-EMAIL_USER = os.getenv("EMAIL_USER")
-EMAIL_PASS = os.getenv("EMAIL_PASS")
-ADMIN_EMAIL = os.getenv("ADMIN_EMAIL")
+# Адрес Bot API, если используется не api.telegram.org (локальный сервер Bot API или имитация для тестов)
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL")
 
 # Максимальное количество вложений
 MAX_ATTACHMENTS = 3
 
-# Файл блокировки для проверки одного экземпляра
-LOCK_FILE = "bot.lock"
+# Заявок на одной странице панели администратора
+ADMIN_PAGE_SIZE = int(os.getenv("ADMIN_PAGE_SIZE", "8"))
+
+# Заявок на одной странице «Мои заявки»
+MY_TICKETS_PAGE_SIZE = int(os.getenv("MY_TICKETS_PAGE_SIZE", "5"))
+
+# Значки статусов заявок в списках
+STATUS_ICONS = {'Принято': "📥", 'В работе': "📋", 'Решено': "✅"}
+
+# Смена статуса (одной заявки и массовая): новый статус -> статусы, из которых в него можно перейти
+STATUS_TRANSITIONS = {
+    'В работе': ('Принято',),
+    'Решено': ('Принято', 'В работе'),
+}
+
+# За сколько последних дней /stats показывает статистику, если не указано в команде
+STATS_DAYS = int(os.getenv("STATS_DAYS", "30"))
+# Сколько конфигураций и организаций показывать в /stats
+STATS_TOP = 10
+
+# Максимальная длина текста сообщения в Telegram
+TELEGRAM_TEXT_LIMIT = 4096
+
+# Максимальный размер файла, который бот может отправить через Bot API
+TELEGRAM_UPLOAD_LIMIT = 50 * 1024 * 1024
+
+# Конфигурации 1С: код кнопки -> название
+CONFIG_NAMES = {
+    'bp': 'Бухгалтерия предприятия',
+    'zup': 'ЗУП',
+    'unf': 'УНФ',
+    'ut': 'УТ',
+    'doc': 'Документооборот',
+    'food': 'Общепит',
+    'other': 'Другая'
+}
+
+# Коды статусов в команде /export
+EXPORT_STATUS_CODES = {
+    'new': 'Принято',
+    'work': 'В работе',
+    'done': 'Решено',
+}
 
 # Настройка логирования
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Отправитель email-уведомлений из очереди
+outbox_worker = EmailOutboxWorker()
+
+# Сообщение о ходе заявки в каждом чате
+status_message = LiveMessage()
+
+# HTTP-адрес /metrics (если задан METRICS_PORT)
+metrics_server = MetricsServer()
+
 # Состояния для заявки
 STATES = {
     'START': 0,
@@ -49,83 +124,16 @@ STATES = {
     'FEEDBACK': 6
 }
 
-# Асинхронная функция для загрузки файла из Telegram
-async def download_file(bot, file_id, file_name):
-    file = await bot.get_file(file_id)
-    file_path = f"temp_{file_id}_{file_name}"  # Уникальное имя файла
-    await file.download_to_drive(file_path)
-    return file_path
-
-# Отправка email-уведомления через Яндекс Почту
-def send_email(ticket_id, config, org_dept, name, phone, description, attachments=None):
-    subject = f"Новая заявка #{ticket_id} в техподдержку"
-    body = (
-        f"Новая заявка #{ticket_id}:\n"
-        f"Конфигурация: {config}\n"
-        f"Организация и отдел: {org_dept}\n"
-        f"Имя: {name}\n"
-        f"Номер телефона: {phone}\n"
-        f"Описание: {description}\n"
-        f"Статус: Принято"
-    )
-
-    msg = MIMEMultipart()
-    msg['Subject'] = subject
-    msg['From'] = EMAIL_USER  # Адрес отправителя совпадает с логином SMTP
-    msg['To'] = ADMIN_EMAIL
-    msg.attach(MIMEText(body, 'plain'))
-
-    if attachments:
-        for file_path in attachments:
-            try:
-                with open(file_path, 'rb') as f:
-                    part = MIMEBase('application', 'octet-stream')
-                    part.set_payload(f.read())
-                    encoders.encode_base64(part)
-                    part.add_header('Content-Disposition', f'attachment; filename={os.path.basename(file_path)}')
-                    msg.attach(part)
-            except Exception as e:
-                logger.error(f"Ошибка при прикреплении файла {file_path}: {e}")
-
-    try:
-        # Используем SMTP_SSL для порта 465
-        with smtplib.SMTP_SSL(EMAIL_HOST, EMAIL_PORT, context=ssl.create_default_context()) as server:
-            server.login(EMAIL_USER, EMAIL_PASS)
-            server.send_message(msg)
-            logger.info(f"Email с заявкой #{ticket_id} отправлен на {ADMIN_EMAIL} через {EMAIL_HOST} (порт {EMAIL_PORT})")
-    except smtplib.SMTPAuthenticationError as e:
-        logger.error(f"Ошибка аутентификации: Проверьте логин ({EMAIL_USER}) и пароль. Ошибка: {e}")
-    except smtplib.SMTPConnectError as e:
-        logger.error(f"Ошибка соединения с {EMAIL_HOST}:{EMAIL_PORT}. Проверьте порт и доступность сервера. Ошибка: {e}")
-    except Exception as e:
-        logger.error(f"Общая ошибка отправки email: {e}")
-    finally:
-        if attachments:
-            for file_path in attachments:
-                try:
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
-                        logger.info(f"Удалён временный файл: {file_path}")
-                except Exception as e:
-                    logger.error(f"Ошибка при удалении файла {file_path}: {e}")
-
-# Функция для удаления сообщения через заданное время
-async def delete_message(context: ContextTypes.DEFAULT_TYPE):
-    chat_id = context.job.context['chat_id']
-    message_id = context.job.context['message_id']
-    try:
-        await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-        logger.info(f"Сообщение {message_id} удалено из чата {chat_id}")
-    except Exception as e:
-        logger.error(f"Ошибка при удалении сообщения {message_id} из чата {chat_id}: {e}")
-
 # Приветственное сообщение
+@timed_handler
+@traced('handler')
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     keyboard = [
         [InlineKeyboardButton("Оставить заявку 📝", callback_data='create_ticket')],
+        [InlineKeyboardButton("Мои заявки 🗂", callback_data='mytickets')],
         [InlineKeyboardButton("Справка 📚", callback_data='help')]
     ]
-    if is_admin(update.effective_user.id):
+    if await is_admin(update.effective_user.id):
         keyboard.append([InlineKeyboardButton("Панель администратора ⚙️", callback_data='admin_panel')])
     reply_markup = InlineKeyboardMarkup(keyboard)
 
@@ -171,6 +179,8 @@ async def help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await query.message.reply_text(help_text, reply_markup=reply_markup, parse_mode='Markdown')
 
 # Обработка кнопок
+@timed_handler
+@traced('handler')
 async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
@@ -197,16 +207,7 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         await help(update, context)
 
     elif query.data.startswith('config_'):
-        config_map = {
-            'config_bp': 'Бухгалтерия предприятия',
-            'config_zup': 'ЗУП',
-            'config_unf': 'УНФ',
-            'config_ut': 'УТ',
-            'config_doc': 'Документооборот',
-            'config_food': 'Общепит',
-            'config_other': 'Другая'
-        }
-        config = config_map[query.data]
+        config = CONFIG_NAMES[query.data[len('config_'):]]
         context.user_data['config'] = config
         keyboard = [[InlineKeyboardButton("Назад ⬅️", callback_data='back_to_start')]]
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -217,25 +218,77 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         context.user_data['state'] = STATES['ORG_DEPT']
 
     elif query.data == 'back_to_start':
+        # Заявка отменена — загруженные вложения больше не нужны
+        remove_attachments(context.user_data.get('attachments'))
+        # Меню покажется в сообщении о ходе заявки: отложенное изменение его бы затёрло
+        await status_message.discard(update.effective_chat.id)
         context.user_data.clear()
         await start(update, context)
 
-    elif query.data == 'admin_panel' and is_admin(query.from_user.id):
+    elif query.data == 'mytickets' or query.data.startswith(('mytickets_older_', 'mytickets_newer_')):
+        await show_my_tickets(update, context, query.data)
+
+    elif query.data == 'admin_panel' and await is_admin(query.from_user.id):
+        await admin_panel(update, context, page='')
+
+    elif query.data.startswith(('admin_next_', 'admin_prev_')) and await is_admin(query.from_user.id):
+        await admin_panel(update, context, page=query.data)
+
+    elif query.data.startswith('status_') and await is_admin(query.from_user.id):
+        # status_<id>_<секунда создания>_<статус>; в кнопках, отправленных до разделов, секунды нет
+        parts = query.data.split('_')
+        ticket_id, new_status = int(parts[1]), parts[-1]
+        created = int(parts[2]) if len(parts) == 4 else None
+        if new_status not in STATUS_TRANSITIONS:
+            logger.error(f"Некорректный callback_data: {query.data}")
+            return
+        # Те же допустимые переходы, что и при массовой смене: устаревшая кнопка
+        # «В работе» не вернёт решённую заявку в работу и не вызовет повторную просьбу об оценке
+        changed = await bulk_update_status([ticket_id], new_status, STATUS_TRANSITIONS[new_status], [created])
+        if changed:
+            _, user_id, created = changed[0]
+            await notify_user(ticket_id, created, user_id, new_status, context)
+        else:
+            logger.info(f"Статус заявки #{ticket_id} не изменён на «{new_status}»: переход недопустим или заявка не найдена")
         await admin_panel(update, context)
 
-    elif query.data.startswith('status_'):
-        ticket_id, new_status = query.data.split('_')[1], query.data.split('_')[2]
-        update_status(ticket_id, new_status)
-        await notify_user(ticket_id, new_status, context)
+    elif query.data.startswith('search_') and await is_admin(query.from_user.id):
+        await show_search_results(update, context, int(query.data.split('_')[1]))
+
+    elif query.data.startswith('select_') and await is_admin(query.from_user.id):
+        ref = ticket_ref(query.data)
+        selected = context.user_data.setdefault('admin_selected', [])
+        if ref[0] in selected_ids(selected):
+            selected[:] = [entry for entry in selected if selected_ref(entry)[0] != ref[0]]
+        else:
+            selected.append(list(ref))
+        await redraw_selection(query, selected)
+
+    elif query.data == 'bulk_clear' and await is_admin(query.from_user.id):
+        context.user_data['admin_selected'] = []
+        await redraw_selection(query, [])
+
+    elif query.data.startswith('bulk_') and await is_admin(query.from_user.id):
+        new_status = query.data.split('_')[1]
+        refs = [selected_ref(entry) for entry in context.user_data.get('admin_selected') or []]
+        changed = await bulk_update_status([ticket_id for ticket_id, _ in refs], new_status,
+                                           STATUS_TRANSITIONS[new_status], [created for _, created in refs])
+        context.user_data['admin_selected'] = []
+        logger.info(f"Статус «{new_status}» установлен для заявок: {[ticket_id for ticket_id, _, _ in changed]}")
+        if new_status == 'Решено' and changed:
+            # Просьбы об оценке уходят в фоне через планировщик отправки, панель перерисовывается сразу
+            context.application.create_task(send_rating_prompts(context.bot, changed))
         await admin_panel(update, context)
 
     elif query.data.startswith('rate_'):
+        # rate_<id>_<секунда создания>_<оценка>; в кнопках, отправленных до разделов, секунды нет
         parts = query.data.split('_')
-        if len(parts) != 3:
+        if len(parts) not in (3, 4) or not all(part.isdigit() for part in parts[1:-1]):
             logger.error(f"Некорректный callback_data: {query.data}")
             await query.edit_message_text("Произошла ошибка при обработке отзыва. Попробуйте снова.")
             return
-        ticket_id, rating_str = parts[1], parts[2]
+        ticket_id, rating_str = int(parts[1]), parts[-1]
+        created = int(parts[2]) if len(parts) == 4 else None
         try:
             rating = int(rating_str)
             if rating not in range(1, 6):
@@ -247,18 +300,14 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
         rating_text = {5: "Отлично", 4: "Хорошо", 3: "Нормально", 2: "Плохо", 1: "Ужасно"}[rating]
         logger.info(f"Сохранение отзыва для ticket_id: {ticket_id}, рейтинг: {rating} ({rating_text})")
-        save_feedback(ticket_id, rating)
+        if not await save_feedback(ticket_id, rating, update.effective_user.id, created):
+            logger.error(f"Отзыв пользователя {update.effective_user.id} для ticket_id: {ticket_id} не сохранён")
+            await query.edit_message_text("Произошла ошибка при обработке отзыва. Попробуйте снова.")
+            return
         await query.edit_message_text(f"Спасибо за ваш отзыв: {rating_text} ({rating}/5)! 🙌")
 
         # Планируем удаление сообщения с подтверждением оценки через 30 секунд
-        context.job_queue.run_once(
-            delete_message,
-            30,
-            context={
-                'chat_id': update.effective_chat.id,
-                'message_id': query.message.message_id
-            }
-        )
+        await expire_message(update.effective_chat.id, query.message.message_id, 30)
 
         context.user_data.clear()
         await start(update, context)  # Возвращаемся в начало после оценки
@@ -267,6 +316,8 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         await save_and_finish(update, context)
 
 # Обработка ввода текста
+@timed_handler
+@traced('handler')
 async def handle_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     state = context.user_data.get('state', 0)
     text = update.message.text
@@ -324,24 +375,16 @@ async def handle_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             keyboard = [[InlineKeyboardButton("Завершить заявку ✅", callback_data='finish_ticket')],
                         [InlineKeyboardButton("Назад ⬅️", callback_data='back_to_start')]]
             reply_markup = InlineKeyboardMarkup(keyboard)
-            # Удаляем предыдущее сообщение
-            if 'last_message_id' in context.user_data:
-                try:
-                    await context.bot.delete_message(
-                        chat_id=update.effective_chat.id,
-                        message_id=context.user_data['last_message_id']
-                    )
-                except Exception as e:
-                    logger.error(f"Ошибка при удалении сообщения: {e}")
-            # Отправляем новое сообщение
-            message = await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=f"Текст добавлен. Можете отправить до {MAX_ATTACHMENTS - len(context.user_data['attachments'])} вложений или завершить заявку.",
-                reply_markup=reply_markup
+            # Изменяем сообщение о ходе заявки
+            await status_message.show(
+                context.bot, update.effective_chat.id, context.user_data,
+                f"Текст добавлен. Можете отправить до {MAX_ATTACHMENTS - len(context.user_data['attachments'])} вложений или завершить заявку.",
+                reply_markup
             )
-            context.user_data['last_message_id'] = message.message_id  # Сохраняем ID нового сообщения
 
 # Обработка номера телефона через кнопку
+@timed_handler
+@traced('handler')
 async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     state = context.user_data.get('state', 0)
     if state == STATES['PHONE'] and update.message.contact:
@@ -360,105 +403,140 @@ async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         context.user_data['description'] = ""
         context.user_data['last_message_id'] = message.message_id  # Сохраняем ID сообщения
 
+# Сведения о вложении сообщения: (file_id, имя файла, запись в описании, file_unique_id, размер) или None
+def media_info(message):
+    if message.photo:
+        # Берём только последнее фото (самое большое)
+        media = message.photo[-1]
+        return media.file_id, f"photo_{media.file_id}.jpg", "Прикреплённое фото", media.file_unique_id, media.file_size
+    if message.video:
+        media = message.video
+        return media.file_id, f"video_{media.file_id}.mp4", "Прикреплённое видео", media.file_unique_id, media.file_size
+    if message.document:
+        media = message.document
+        return media.file_id, media.file_name, f"Прикреплённый документ: {media.file_name}", media.file_unique_id, media.file_size
+    if message.audio:
+        media = message.audio
+        return media.file_id, media.file_name, f"Прикреплённое аудио: {media.file_name}", media.file_unique_id, media.file_size
+    if message.voice:
+        media = message.voice
+        return media.file_id, f"voice_{media.file_id}.ogg", "Прикреплённое голосовое сообщение", media.file_unique_id, media.file_size
+    if message.sticker:
+        media = message.sticker
+        return media.file_id, f"sticker_{media.file_id}.webp", "Прикреплённый стикер", media.file_unique_id, media.file_size
+    return None
+
+# Показывает текст в сообщении о ходе заявки вместе с кнопками шага описания
+async def send_description_prompt(bot, chat_id, user_data, text):
+    keyboard = [[InlineKeyboardButton("Завершить заявку ✅", callback_data='finish_ticket')],
+                [InlineKeyboardButton("Назад ⬅️", callback_data='back_to_start')]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await status_message.show(bot, chat_id, user_data, text, reply_markup)
+
+def attachments_prompt(attachments):
+    remaining = MAX_ATTACHMENTS - len(attachments)
+    return (f"🛑 Опишите проблему текстом или отправьте до {remaining} вложений (фото, видео, документы).\n"
+            f"Уже добавлено: {len(attachments)} из {MAX_ATTACHMENTS}. Когда закончите, нажмите 'Завершить заявку'. ✍️")
+
+MAX_ATTACHMENTS_TEXT = f"Вы уже отправили максимум {MAX_ATTACHMENTS} вложений. Нажмите 'Завершить заявку' или начните заново."
+
+# Загружает вложения сообщений (одного или всего альбома) параллельно и добавляет их к заявке.
+# Лимит количества проверяется один раз: лишние сообщения не загружаются.
+# Файл загружается блоками; слишком большой отклоняется, не дойдя до диска целиком.
+# Повторно присланный файл берётся из кэша без загрузки из Telegram.
+# Возвращает (добавлено, пропущено сверх лимита, тексты ошибок).
+async def add_attachments(bot, user_data, messages):
+    attachments = user_data.get('attachments', [])
+    ticket_size = attachments_size(attachments)
+    items = []
+    skipped = 0
+    for message in messages:
+        info = media_info(message)
+        if info is None:
+            continue
+        if len(attachments) + len(items) >= MAX_ATTACHMENTS:
+            skipped += 1
+            continue
+        # Известные размеры предыдущих файлов альбома учитываются в лимите заявки заранее
+        items.append((info, ticket_size))
+        ticket_size += info[4] or 0
+
+    results = await asyncio.gather(
+        *(download_attachment(bot, info[0], info[1], size, info[3], info[4]) for info, size in items),
+        return_exceptions=True
+    )
+    description_updates = []
+    errors = []
+    for (info, _), result in zip(items, results):
+        if isinstance(result, AttachmentLimitError):
+            errors.append(str(result))
+        elif isinstance(result, Exception):
+            logger.error(f"Ошибка при загрузке вложения {info[1]}: {result}")
+            errors.append("не удалось загрузить файл")
+        else:
+            attachments.append(result)
+            description_updates.append(info[2])
+
+    if description_updates:
+        user_data['attachments'] = attachments
+        user_data['description'] = user_data.get('description', '') + "\n".join(description_updates) + "\n"
+    return len(description_updates), skipped, errors
+
 # Обработка всех типов вложений
+@timed_handler
+@traced('handler')
 async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     state = context.user_data.get('state', 0)
     if state != STATES['DESCRIPTION']:
         return
 
-    attachments = context.user_data.get('attachments', [])
-    remaining = MAX_ATTACHMENTS - len(attachments)
-    if remaining <= 0:
-        keyboard = [[InlineKeyboardButton("Завершить заявку ✅", callback_data='finish_ticket')],
-                    [InlineKeyboardButton("Назад ⬅️", callback_data='back_to_start')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        # Удаляем предыдущее сообщение
-        if 'last_message_id' in context.user_data:
-            try:
-                await context.bot.delete_message(
-                    chat_id=update.effective_chat.id,
-                    message_id=context.user_data['last_message_id']
-                )
-            except Exception as e:
-                logger.error(f"Ошибка при удалении сообщения: {e}")
-        # Отправляем новое сообщение
-        message = await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text=f"Вы уже отправили максимум {MAX_ATTACHMENTS} вложений. Нажмите 'Завершить заявку' или начните заново.",
-            reply_markup=reply_markup
-        )
-        context.user_data['last_message_id'] = message.message_id
+    if update.message.media_group_id:
+        # Элементы альбома приходят отдельными обновлениями; обработаем их вместе, когда придут все
+        await media_groups.add(context.application, update.effective_user.id, update.effective_chat.id, update.message)
         return
 
-    new_attachments = []
-    description_updates = []
+    if len(context.user_data.get('attachments', [])) >= MAX_ATTACHMENTS:
+        await send_description_prompt(context.bot, update.effective_chat.id, context.user_data, MAX_ATTACHMENTS_TEXT)
+        return
 
-    # Обрабатываем только одно вложение за раз
-    if update.message.photo:
-        # Берём только последнее фото (самое большое)
-        photo = update.message.photo[-1]
-        file_id = photo.file_id
-        file_name = f"photo_{file_id}.jpg"
-        file_path = await download_file(context.bot, file_id, file_name)
-        new_attachments.append(file_path)
-        description_updates.append("Прикреплённое фото")
-    elif update.message.video:
-        file_id = update.message.video.file_id
-        file_name = f"video_{file_id}.mp4"
-        file_path = await download_file(context.bot, file_id, file_name)
-        new_attachments.append(file_path)
-        description_updates.append("Прикреплённое видео")
-    elif update.message.document:
-        file_id = update.message.document.file_id
-        file_name = update.message.document.file_name
-        file_path = await download_file(context.bot, file_id, file_name)
-        new_attachments.append(file_path)
-        description_updates.append(f"Прикреплённый документ: {file_name}")
-    elif update.message.audio:
-        file_id = update.message.audio.file_id
-        file_name = update.message.audio.file_name
-        file_path = await download_file(context.bot, file_id, file_name)
-        new_attachments.append(file_path)
-        description_updates.append(f"Прикреплённое аудио: {file_name}")
-    elif update.message.voice:
-        file_id = update.message.voice.file_id
-        file_name = f"voice_{file_id}.ogg"
-        file_path = await download_file(context.bot, file_id, file_name)
-        new_attachments.append(file_path)
-        description_updates.append("Прикреплённое голосовое сообщение")
-    elif update.message.sticker:
-        file_id = update.message.sticker.file_id
-        file_name = f"sticker_{file_id}.webp"
-        file_path = await download_file(context.bot, file_id, file_name)
-        new_attachments.append(file_path)
-        description_updates.append("Прикреплённый стикер")
-
-    if new_attachments:
-        attachments.extend(new_attachments)
-        context.user_data['attachments'] = attachments
-        context.user_data['description'] += "\n".join(description_updates) + "\n"
-
-        remaining = MAX_ATTACHMENTS - len(attachments)
-        keyboard = [[InlineKeyboardButton("Завершить заявку ✅", callback_data='finish_ticket')],
-                    [InlineKeyboardButton("Назад ⬅️", callback_data='back_to_start')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        # Удаляем предыдущее сообщение
-        if 'last_message_id' in context.user_data:
-            try:
-                await context.bot.delete_message(
-                    chat_id=update.effective_chat.id,
-                    message_id=context.user_data['last_message_id']
-                )
-            except Exception as e:
-                logger.error(f"Ошибка при удалении сообщения: {e}")
-        # Отправляем новое сообщение
-        message = await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text=f"🛑 Опишите проблему текстом или отправьте до {remaining} вложений (фото, видео, документы).\n"
-                 f"Уже добавлено: {len(attachments)} из {MAX_ATTACHMENTS}. Когда закончите, нажмите 'Завершить заявку'. ✍️",
-            reply_markup=reply_markup
-        )
-        context.user_data['last_message_id'] = message.message_id
+    added, _, errors = await add_attachments(context.bot, context.user_data, [update.message])
+    if errors:
+        await update.message.reply_text(f"Вложение не добавлено: {errors[0]}. ⚠️")
+        return
+    if added:
+        await send_description_prompt(context.bot, update.effective_chat.id, context.user_data,
+                                      attachments_prompt(context.user_data['attachments']))
+
+# Обработка собранного альбома: одна проверка лимита, параллельная загрузка и одно сообщение о результате
+@timed_handler
+@traced('handler')
+async def process_media_group(application, user_id, chat_id, messages) -> None:
+    user_data = application.user_data.get(user_id)
+    if user_data is None or user_data.get('state', 0) != STATES['DESCRIPTION']:
+        return
+
+    if len(user_data.get('attachments', [])) >= MAX_ATTACHMENTS:
+        await send_description_prompt(application.bot, chat_id, user_data, MAX_ATTACHMENTS_TEXT)
+    else:
+        added, skipped, errors = await add_attachments(application.bot, user_data, messages)
+        text = attachments_prompt(user_data.get('attachments', []))
+        if skipped:
+            text += f"\n\n⚠️ Не добавлено вложений сверх лимита: {skipped}."
+        for error in errors:
+            text += f"\n⚠️ Вложение не добавлено: {error}."
+        await send_description_prompt(application.bot, chat_id, user_data, text)
+    # Альбом обрабатывается вне обработчика, поэтому об изменении user_data сообщаем сами
+    application.mark_data_for_update_persistence(user_ids=user_id)
+
+# Сборщик альбомов пользователей
+media_groups = MediaGroupCollector(process_media_group)
+
+# Недособранный альбом обрабатывается раньше любого следующего обновления пользователя
+async def flush_media_group(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user is None:
+        return
+    media_group_id = update.message.media_group_id if update.message else None
+    await media_groups.flush_before(context.application, update.effective_user.id, media_group_id)
 
 # Сохранение заявки
 async def save_and_finish(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -470,9 +548,10 @@ async def save_and_finish(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     description = context.user_data.get('description', 'Без описания').strip()
     attachments = context.user_data.get('attachments', None)
 
-    ticket_id = save_ticket(user_id, config, org_dept, name, phone, description)
+    # Письмо администратору ставится в очередь в той же транзакции, что и заявка
+    ticket_id = await save_ticket(user_id, config, org_dept, name, phone, description, attachments)
     if ticket_id:
-        send_email(ticket_id, config, org_dept, name, phone, description, attachments)
+        outbox_worker.notify()
 
         response_text = (
             f"Заявка #{ticket_id} принята! ✅\n"
@@ -484,21 +563,8 @@ async def save_and_finish(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             "Заявка будет обработана в ближайшее время! ⏳"
         )
 
-        # Удаляем предыдущее сообщение, если оно есть
-        if 'last_message_id' in context.user_data:
-            try:
-                await context.bot.delete_message(
-                    chat_id=update.effective_chat.id,
-                    message_id=context.user_data['last_message_id']
-                )
-            except Exception as e:
-                logger.error(f"Ошибка при удалении сообщения: {e}")
-
-        # Отправляем итоговое сообщение
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text=response_text
-        )
+        # Итог заявки заменяет сообщение о ходе заявки (кнопки убираются)
+        await status_message.show(context.bot, update.effective_chat.id, context.user_data, response_text, wait=True)
 
         # Очищаем данные
         context.user_data.clear()
@@ -506,9 +572,10 @@ async def save_and_finish(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         # Отправляем приветственное сообщение напрямую
         keyboard = [
             [InlineKeyboardButton("Оставить заявку 📝", callback_data='create_ticket')],
+            [InlineKeyboardButton("Мои заявки 🗂", callback_data='mytickets')],
             [InlineKeyboardButton("Справка 📚", callback_data='help')]
         ]
-        if is_admin(update.effective_user.id):
+        if await is_admin(update.effective_user.id):
             keyboard.append([InlineKeyboardButton("Панель администратора ⚙️", callback_data='admin_panel')])
         reply_markup = InlineKeyboardMarkup(keyboard)
         await context.bot.send_message(
@@ -519,123 +586,537 @@ async def save_and_finish(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         context.user_data['state'] = STATES['START']
         logger.info(f"Приветственное сообщение отправлено пользователю {update.effective_user.id} после принятия заявки")
 
-# Уведомление пользователя о смене статуса
-async def notify_user(ticket_id, new_status, context):
-    user_id = get_user_id_by_ticket(ticket_id)
+# Просьба оценить решённую заявку; created — секунда создания заявки для кнопок.
+# Возвращает отправленное сообщение: удаление через 30 секунд планирует вызывающий.
+async def send_rating_prompt(bot, ticket_id, user_id, created=None):
+    ref = format_ticket_ref(ticket_id, created)
+    keyboard = [
+        [InlineKeyboardButton("Отлично 👍 (5/5)", callback_data=f'rate_{ref}_5')],
+        [InlineKeyboardButton("Хорошо 👌 (4/5)", callback_data=f'rate_{ref}_4')],
+        [InlineKeyboardButton("Нормально 🤔 (3/5)", callback_data=f'rate_{ref}_3')],
+        [InlineKeyboardButton("Плохо 👎 (2/5)", callback_data=f'rate_{ref}_2')],
+        [InlineKeyboardButton("Ужасно 😞 (1/5)", callback_data=f'rate_{ref}_1')]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    return await bot.send_message(
+        chat_id=user_id,
+        text=f"Статус вашей заявки #{ticket_id} обновлён: Решено 🚀\n"
+             "Пожалуйста, оцените качество поддержки:",
+        reply_markup=reply_markup,
+        # Уведомление другому пользователю уступает очередь ответам администратору
+        rate_limit_args={'priority': PRIORITY_BULK}
+    )
+
+# Просьбы об оценке после массовой смены статуса. Запросы ставятся в очередь планировщика
+# отправки разом, а он выпускает их с учётом лимитов Telegram; ошибка одной отправки
+# (например, пользователь заблокировал бота) не мешает остальным. Удаление всех
+# отправленных просьб через 30 секунд планируется одной записью в БД.
+async def send_rating_prompts(bot, tickets):
+    tickets = [(ticket_id, user_id, created) for ticket_id, user_id, created in tickets if user_id]
+    results = await asyncio.gather(
+        *(send_rating_prompt(bot, ticket_id, user_id, created) for ticket_id, user_id, created in tickets),
+        return_exceptions=True
+    )
+    sent = []
+    for (ticket_id, user_id, _), result in zip(tickets, results):
+        if isinstance(result, Exception):
+            logger.error(f"Ошибка отправки просьбы об оценке заявки #{ticket_id} пользователю {user_id}: {result}")
+        else:
+            sent.append((user_id, result.message_id))
+    if sent:
+        logger.info(f"Планируем удаление {len(sent)} сообщений с оценкой через 30 секунд")
+        await expire_messages(sent, 30)
+
+# Уведомление пользователя о смене статуса; вызывается из button_click и входит в его время и трассу
+async def notify_user(ticket_id, created, user_id, new_status, context):
     if user_id and new_status == 'Решено':
-        keyboard = [
-            [InlineKeyboardButton("Отлично 👍 (5/5)", callback_data=f'rate_{ticket_id}_5')],
-            [InlineKeyboardButton("Хорошо 👌 (4/5)", callback_data=f'rate_{ticket_id}_4')],
-            [InlineKeyboardButton("Нормально 🤔 (3/5)", callback_data=f'rate_{ticket_id}_3')],
-            [InlineKeyboardButton("Плохо 👎 (2/5)", callback_data=f'rate_{ticket_id}_2')],
-            [InlineKeyboardButton("Ужасно 😞 (1/5)", callback_data=f'rate_{ticket_id}_1')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
         context.user_data['ticket_id'] = ticket_id
-        message = await context.bot.send_message(
-            chat_id=user_id,
-            text=f"Статус вашей заявки #{ticket_id} обновлён: {new_status} 🚀\n"
-                 "Пожалуйста, оцените качество поддержки:",
-            reply_markup=reply_markup
-        )
+        message = await send_rating_prompt(context.bot, ticket_id, user_id, created)
 
         # Планируем удаление сообщения с оценкой через 30 секунд
         logger.info(f"Планируем удаление сообщения с оценкой (message_id: {message.message_id}) через 30 секунд")
-        context.job_queue.run_once(
-            delete_message,
-            30,
-            context={
-                'chat_id': user_id,
-                'message_id': message.message_id
-            }
-        )
+        await expire_message(user_id, message.message_id, 30)
+
+# Заявка в callback_data: <id>_<секунда создания>; секунда позволяет запросу найти раздел заявки
+def format_ticket_ref(ticket_id, created):
+    return f'{ticket_id}_{created}' if created is not None else f'{ticket_id}'
+
+# (номер, секунда создания) из callback_data вида <действие>_<id>[_<секунда создания>]
+def ticket_ref(data):
+    parts = data.split('_')
+    return int(parts[1]), int(parts[2]) if len(parts) > 2 else None
+
+# Выбранная заявка хранится как [номер, секунда создания]; в старом состоянии — просто номер
+def selected_ref(entry):
+    return tuple(entry) if isinstance(entry, list) else (entry, None)
+
+def selected_ids(selected):
+    return {selected_ref(entry)[0] for entry in selected}
+
+# Кнопка выбора заявки для массовой смены статуса
+def selection_button(ticket_id, created, selected):
+    mark = "☑️" if selected else "⬜"
+    return InlineKeyboardButton(f"{mark} #{ticket_id}", callback_data=f'select_{format_ticket_ref(ticket_id, created)}')
+
+# Действия над выбранными заявками (в том числе на других страницах)
+def bulk_actions_row(selected):
+    count = len(selected)
+    return [
+        InlineKeyboardButton(f"В работе ({count})", callback_data='bulk_В работе'),
+        InlineKeyboardButton(f"Решено ({count})", callback_data='bulk_Решено'),
+        InlineKeyboardButton("Снять выбор ✖️", callback_data='bulk_clear')
+    ]
 
-# Панель администратора
-async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query
+# Выбор заявки меняет только кнопки текущего сообщения панели, без запроса к БД
+async def redraw_selection(query, selected):
+    keyboard = []
+    footer = []
+    chosen = selected_ids(selected)
+    for row in query.message.reply_markup.inline_keyboard:
+        data = row[0].callback_data
+        if data.startswith('bulk_'):
+            continue
+        if data.startswith('admin_'):
+            # Навигация и «Обновить» остаются внизу, под действиями
+            footer.append(row)
+            continue
+        buttons = []
+        for button in row:
+            if button.callback_data.startswith('select_'):
+                ticket_id, created = ticket_ref(button.callback_data)
+                button = selection_button(ticket_id, created, ticket_id in chosen)
+            buttons.append(button)
+        keyboard.append(buttons)
+    if selected:
+        keyboard.append(bulk_actions_row(selected))
+    try:
+        await query.edit_message_reply_markup(InlineKeyboardMarkup(keyboard + footer))
+    except BadRequest as e:
+        if 'not modified' not in str(e):
+            raise
+
+# Заявка в панели администратора и в результатах поиска
+def format_ticket(ticket_id, status, user_id, config, org_dept, name, phone, description, rating):
+    text = (
+        f"#{ticket_id} | {config}\n"
+        f"   UserID: {user_id} | Орг/Отдел: {org_dept}\n"
+        f"   Имя: {name} | Телефон: {phone}\n"
+        f"   Описание: {description}"
+    )
+    if status == 'Решено':
+        text += f"\n   Оценка: {rating}/5" if rating is not None else "\n   Оценка: не оставлена"
+    return text
+
+# Длительность для подписей статистики: 3 ч, 2 д
+def format_duration(seconds, precision=1):
+    if seconds < 86400:
+        return f"{seconds / 3600:.{precision}f} ч"
+    return f"{seconds / 86400:.{precision}f} д"
+
+# Строка сводной статистики: решено, среднее время решения, средняя оценка
+def format_stats(row):
+    key, resolved, resolve_seconds, resolve_hist, ratings, rating_sum, rating_hist = row
+    text = f"решено {resolved}"
+    if resolved:
+        text += f", ср. время {format_duration(resolve_seconds / resolved)}"
+    if ratings:
+        text += f", оценка {rating_sum / ratings:.2f} ({ratings})"
+    return text
+
+# Сводная статистика решений и оценок: /stats [дней]. Читает готовые агрегаты, а не заявки.
+@timed_handler
+@traced('handler')
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await is_admin(update.effective_user.id):
+        await update.message.reply_text("Статистика доступна только администраторам.")
+        return
+    days = int(context.args[0]) if context.args and context.args[0].isdigit() and int(context.args[0]) > 0 else STATS_DAYS
+    result = await get_ticket_stats(days, STATS_TOP)
+    if result is None:
+        await update.message.reply_text("Не удалось получить статистику, попробуйте позже.")
+        return
+    if result['total'] is None:
+        await update.message.reply_text("Статистики пока нет: ни одна заявка не решена.")
+        return
 
-    in_progress = get_tickets_by_status('В работе')
-    in_progress_text = "📋 Заявки в работе:\n" if in_progress else "📋 Заявки в работе: отсутствуют\n"
-    in_progress_keyboard = []
-    for i, ticket in enumerate(in_progress, 1):
-        in_progress_text += (
-            f"{i}. #{ticket[0]} | {ticket[2]}\n"
-            f"   UserID: {ticket[1]} | Орг/Отдел: {ticket[3]}\n"
-            f"   Имя: {ticket[4]} | Телефон: {ticket[5]}\n"
-            f"   Описание: {ticket[6]}\n"
-        )
-        in_progress_keyboard.append([InlineKeyboardButton("Решено", callback_data=f'status_{ticket[0]}_Решено')])
-
-    resolved = get_tickets_by_status('Решено')
-    resolved_text = "✅ Решённые заявки:\n" if resolved else "✅ Решённые заявки: отсутствуют\n"
-    for i, ticket in enumerate(resolved, 1):
-        rating = get_feedback(ticket[0])
-        rating_text = f"Оценка: {rating}/5" if rating is not None else "Оценка: не оставлена"
-        resolved_text += (
-            f"{i}. #{ticket[0]} | {ticket[2]}\n"
-            f"   UserID: {ticket[1]} | Орг/Отдел: {ticket[3]}\n"
-            f"   Имя: {ticket[4]} | Телефон: {ticket[5]}\n"
-            f"   Описание: {ticket[6]}\n"
-            f"   {rating_text}\n"
-        )
+    total = result['total']
+    bounds = [format_duration(bound, precision=0) for bound in RESOLVE_TIME_BUCKETS]
+    labels = [f"до {bounds[0]}"] + [f"{low}–{high}" for low, high in zip(bounds, bounds[1:])] + [f"от {bounds[-1]}"]
+    lines = [
+        "📊 Статистика заявок",
+        "",
+        f"Всего: {format_stats(total)}",
+        f"За {days} дн.: {format_stats(result['recent'])}" if result['recent'] else f"За {days} дн.: нет данных",
+        "Время решения: " + ", ".join(f"{label} — {count}" for label, count in zip(labels, total[3])),
+        "Оценки: " + ", ".join(f"{rating}★ — {total[6][rating - 1]}" for rating in range(5, 0, -1)),
+    ]
+    for dimension, title in (('config', "По конфигурациям:"), ('org', f"По организациям (топ {STATS_TOP}):")):
+        if result[dimension]:
+            lines += ["", title]
+            lines += [f"  {row[0] or '—'}: {format_stats(row)}" for row in result[dimension]]
+    text = "\n".join(lines)
+    if len(text) > TELEGRAM_TEXT_LIMIT:
+        text = text[:TELEGRAM_TEXT_LIMIT - 1] + "…"
+    await update.message.reply_text(text)
+
+EXPORT_USAGE = (
+    "Выгрузка заявок: /export [период] [csv|xlsx] [status=...] [config=...]\n"
+    "Период: 2026-09, 2026-09-15 или 2026-09-01..2026-09-30 (по умолчанию все заявки)\n"
+    f"Статусы: {', '.join(f'{code} — {name}' for code, name in EXPORT_STATUS_CODES.items())}\n"
+    f"Конфигурации: {', '.join(f'{code} — {name}' for code, name in CONFIG_NAMES.items())}\n"
+    "Например: /export 2026-09 xlsx status=done config=zup,bp"
+)
+
+# Разбирает аргументы /export; возвращает параметры выгрузки или None, если аргументы неверны
+def parse_export_args(args):
+    options = {'fmt': 'xlsx', 'statuses': None, 'configs': None, 'period': 'all', 'date_from': None, 'date_to': None}
+    for arg in args:
+        arg = arg.lower()
+        key, _, value = arg.partition('=')
+        if arg in EXPORT_FORMATS:
+            options['fmt'] = arg
+        elif key in ('status', 'config') and value:
+            names = EXPORT_STATUS_CODES if key == 'status' else CONFIG_NAMES
+            codes = value.split(',')
+            if not all(code in names for code in codes):
+                return None
+            options['statuses' if key == 'status' else 'configs'] = [names[code] for code in codes]
+        else:
+            try:
+                if '..' in arg:
+                    first, last = (datetime.date.fromisoformat(part) for part in arg.split('..', 1))
+                elif len(arg) == 7:
+                    first = datetime.date.fromisoformat(f'{arg}-01')
+                    last = (first.replace(day=28) + datetime.timedelta(days=4)).replace(day=1) - datetime.timedelta(days=1)
+                else:
+                    first = last = datetime.date.fromisoformat(arg)
+            except ValueError:
+                return None
+            if first > last:
+                return None
+            options['period'] = arg
+            options['date_from'], options['date_to'] = export_bounds(first, last)
+    return options
+
+# Выгрузка заявок с оценками в файл: /export [период] [csv|xlsx] [status=...] [config=...].
+# Файл пишется потоком из курсора на сервере во временный файл и отправляется документом.
+@timed_handler
+@traced('handler')
+async def export(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await is_admin(update.effective_user.id):
+        await update.message.reply_text("Выгрузка заявок доступна только администраторам.")
+        return
+    options = parse_export_args(context.args)
+    if options is None:
+        await update.message.reply_text(EXPORT_USAGE)
+        return
+
+    fmt = options['fmt']
+    fd, path = tempfile.mkstemp(suffix=f'.{fmt}', prefix='tickets_')
+    os.close(fd)
+    try:
+        try:
+            count = await run_db(export_tickets, path, fmt, options['statuses'],
+                                 options['date_from'], options['date_to'], options['configs'])
+        except Exception as e:
+            logger.error(f"Ошибка выгрузки заявок: {e}")
+            await update.message.reply_text("Не удалось выгрузить заявки, попробуйте позже.")
+            return
+        if count == 0:
+            await update.message.reply_text("Нет заявок, подходящих под условия выгрузки.")
+            return
+        if os.path.getsize(path) > TELEGRAM_UPLOAD_LIMIT:
+            await update.message.reply_text(
+                f"Файл выгрузки ({count} заявок) больше 50 МБ и не может быть отправлен. "
+                "Сузьте период или фильтры, либо выгрузите заявки на сервере: python export.py"
+            )
+            return
+        with open(path, 'rb') as f:
+            await update.message.reply_document(
+                document=f,
+                filename=f"tickets_{options['period'].replace('..', '_')}.{fmt}",
+                caption=f"Выгружено заявок: {count}",
+            )
+    finally:
+        os.remove(path)
+
+# История заявок пользователя: /mytickets
+@timed_handler
+@traced('handler')
+async def my_tickets(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await show_my_tickets(update, context, 'mytickets')
+
+# Страница «Мои заявки». page — callback_data кнопки ('mytickets_older_<id>' / 'mytickets_newer_<id>'),
+# 'mytickets' — первая страница. При листании сообщение изменяется на месте.
+async def show_my_tickets(update: Update, context: ContextTypes.DEFAULT_TYPE, page) -> None:
+    older_than = newer_than = None
+    if page.startswith('mytickets_older_'):
+        older_than = int(page.split('_')[2])
+    elif page.startswith('mytickets_newer_'):
+        newer_than = int(page.split('_')[2])
+    tickets, has_older, has_newer = await get_user_tickets(update.effective_user.id, MY_TICKETS_PAGE_SIZE, older_than, newer_than)
+
+    sections = ["🗂 Мои заявки"]
+    for ticket_id, status, config, created_at, description, rating in tickets:
+        ticket_text = f"{STATUS_ICONS.get(status, '')} #{ticket_id} | {config} | {created_at:%d.%m.%Y}\n   Статус: {status}"
+        if status == 'Решено':
+            ticket_text += f", оценка {rating}/5" if rating is not None else ", оценка не оставлена"
+        ticket_text += f"\n   {description}"
+        sections.append(ticket_text)
+    if not tickets:
+        sections.append("У вас пока нет заявок." if page == 'mytickets' else "Больше заявок нет")
+    full_text = "\n\n".join(sections)
+    if len(full_text) > TELEGRAM_TEXT_LIMIT:
+        full_text = full_text[:TELEGRAM_TEXT_LIMIT - 1] + "…"
+
+    navigation = []
+    if tickets and has_newer:
+        navigation.append(InlineKeyboardButton("⬅️ Новее", callback_data=f'mytickets_newer_{tickets[0][0]}'))
+    if tickets and has_older:
+        navigation.append(InlineKeyboardButton("Старее ➡️", callback_data=f'mytickets_older_{tickets[-1][0]}'))
+    keyboard = [navigation] if navigation else []
+    keyboard.append([InlineKeyboardButton("Оставить заявку 📝", callback_data='create_ticket')])
+    reply_markup = InlineKeyboardMarkup(keyboard)
 
-    accepted = get_tickets_by_status('Принято')
-    accepted_text = "📥 Новые заявки:\n" if accepted else "📥 Новые заявки: отсутствуют\n"
-    accepted_keyboard = []
-    for i, ticket in enumerate(accepted, 1):
-        accepted_text += (
-            f"{i}. #{ticket[0]} | {ticket[2]}\n"
-            f"   UserID: {ticket[1]} | Орг/Отдел: {ticket[3]}\n"
-            f"   Имя: {ticket[4]} | Телефон: {ticket[5]}\n"
-            f"   Описание: {ticket[6]}\n"
+    query = update.callback_query
+    if query is None:
+        await update.message.reply_text(full_text, reply_markup=reply_markup)
+        return
+    if page == 'mytickets':
+        # Из меню список открывается новым сообщением, меню остаётся
+        await query.message.reply_text(full_text, reply_markup=reply_markup)
+        return
+    try:
+        await query.edit_message_text(full_text, reply_markup=reply_markup)
+    except BadRequest as e:
+        if 'not modified' not in str(e):
+            raise
+
+# Поиск заявок администратором: /search <слова>
+@timed_handler
+@traced('handler')
+async def search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await is_admin(update.effective_user.id):
+        await update.message.reply_text("Поиск заявок доступен только администраторам.")
+        return
+    text = ' '.join(context.args)
+    if not text:
+        await update.message.reply_text(
+            "Укажите, что искать, например:\n"
+            "/search Ромашка принтер\n"
+            "/search \"не проводится документ\" -ЗУП\n"
+            "/search 89991234567\n"
+            "/search #123"
         )
-        accepted_keyboard.append([
-            InlineKeyboardButton("В работе", callback_data=f'status_{ticket[0]}_В работе'),
-            InlineKeyboardButton("Решено", callback_data=f'status_{ticket[0]}_Решено')
-        ])
+        return
+    # Запрос хранится в состоянии, а не в кнопках: callback_data ограничены 64 байтами
+    context.user_data['search_query'] = text
+    await show_search_results(update, context, 0)
 
-    full_text = f"{accepted_text}\n{in_progress_text}\n{resolved_text}"
-    keyboard = accepted_keyboard + in_progress_keyboard + [[InlineKeyboardButton("Обновить 🔄", callback_data='admin_panel')]]
+# Страница результатов поиска, начиная с offset; при листании сообщение изменяется на месте
+async def show_search_results(update: Update, context: ContextTypes.DEFAULT_TYPE, offset) -> None:
+    query = update.callback_query
+    text = context.user_data.get('search_query')
+    if not text:
+        await query.edit_message_text("Поиск устарел, повторите команду /search.")
+        return
+    tickets, has_next = await search_tickets(text, ADMIN_PAGE_SIZE, offset)
+
+    sections = [f"🔎 Поиск: {text}"]
+    for ticket_id, status, user_id, config, org_dept, name, phone, description, rating in tickets:
+        ticket_text = format_ticket(ticket_id, status, user_id, config, org_dept, name, phone, description, rating)
+        sections.append(f"{STATUS_ICONS.get(status, '')} {ticket_text}")
+    if not tickets:
+        sections.append("Ничего не найдено" if offset == 0 else "Больше результатов нет")
+    full_text = "\n".join(sections)
+    if len(full_text) > TELEGRAM_TEXT_LIMIT:
+        full_text = full_text[:TELEGRAM_TEXT_LIMIT - 1] + "…"
+
+    navigation = []
+    if offset > 0:
+        navigation.append(InlineKeyboardButton("⬅️ Назад", callback_data=f'search_{max(0, offset - ADMIN_PAGE_SIZE)}'))
+    if has_next:
+        navigation.append(InlineKeyboardButton("Вперёд ➡️", callback_data=f'search_{offset + ADMIN_PAGE_SIZE}'))
+    keyboard = [navigation] if navigation else []
+    keyboard.append([InlineKeyboardButton("Панель администратора ⚙️", callback_data='admin_panel')])
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    await query.edit_message_text(full_text, reply_markup=reply_markup)
-
-# Проверка на запуск одного экземпляра
-def check_single_instance():
-    if os.path.exists(LOCK_FILE):
-        print("Бот уже запущен! Завершайте предыдущий процесс перед новым запуском.")
-        sys.exit(1)
-    with open(LOCK_FILE, 'w') as f:
-        f.write(str(os.getpid()))
+    if query is None:
+        await update.message.reply_text(full_text, reply_markup=reply_markup)
+        return
+    try:
+        await query.edit_message_text(full_text, reply_markup=reply_markup)
+    except BadRequest as e:
+        if 'not modified' not in str(e):
+            raise
+
+# Панель администратора: одна страница заявок, отсортированных по статусу и номеру.
+# page — callback_data кнопки навигации ('admin_next_<ранг>_<id>' / 'admin_prev_<ранг>_<id>'),
+# None — первая страница. Текущая страница запоминается, чтобы перерисовать её после смены статуса.
+async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE, page=None) -> None:
+    query = update.callback_query
+    if page is None:
+        page = context.user_data.get('admin_page')
+
+    after = before = None
+    if page:
+        direction, rank, ticket_id = page.split('_')[1:]
+        cursor = (int(rank), int(ticket_id))
+        if direction == 'next':
+            after = cursor
+        else:
+            before = cursor
+    tickets, has_prev, has_next = await get_admin_panel_page(ADMIN_PAGE_SIZE, after=after, before=before)
+    if not tickets and page:
+        # Страница опустела (например, после смены статуса) — показываем первую
+        page = None
+        tickets, has_prev, has_next = await get_admin_panel_page(ADMIN_PAGE_SIZE)
+    context.user_data['admin_page'] = page
+    selected = context.user_data.get('admin_selected') or []
+    chosen = selected_ids(selected)
+
+    headers = {
+        'Принято': "📥 Новые заявки:",
+        'В работе': "📋 Заявки в работе:",
+        'Решено': "✅ Решённые заявки:"
+    }
+    sections = []
+    keyboard = []
+    current_status = None
+    for ticket_id, status, user_id, config, org_dept, name, phone, description, rating, rank, created in tickets:
+        if status != current_status:
+            current_status = status
+            sections.append(headers[status])
+        sections.append(format_ticket(ticket_id, status, user_id, config, org_dept, name, phone, description, rating))
+
+        if status == 'Принято':
+            keyboard.append([
+                selection_button(ticket_id, created, ticket_id in chosen),
+                InlineKeyboardButton(f"#{ticket_id} В работе", callback_data=f'status_{ticket_id}_{created}_В работе'),
+                InlineKeyboardButton(f"#{ticket_id} Решено", callback_data=f'status_{ticket_id}_{created}_Решено')
+            ])
+        elif status == 'В работе':
+            keyboard.append([
+                selection_button(ticket_id, created, ticket_id in chosen),
+                InlineKeyboardButton(f"#{ticket_id} Решено", callback_data=f'status_{ticket_id}_{created}_Решено')
+            ])
+    if selected:
+        keyboard.append(bulk_actions_row(selected))
+
+    full_text = "\n".join(sections) if sections else "Заявок нет 🎉"
+    if len(full_text) > TELEGRAM_TEXT_LIMIT:
+        full_text = full_text[:TELEGRAM_TEXT_LIMIT - 1] + "…"
+
+    navigation = []
+    if has_prev and tickets:
+        first = tickets[0]
+        navigation.append(InlineKeyboardButton("⬅️ Назад", callback_data=f'admin_prev_{first[9]}_{first[0]}'))
+    if has_next and tickets:
+        last = tickets[-1]
+        navigation.append(InlineKeyboardButton("Вперёд ➡️", callback_data=f'admin_next_{last[9]}_{last[0]}'))
+    if navigation:
+        keyboard.append(navigation)
+    keyboard.append([InlineKeyboardButton("Обновить 🔄", callback_data=page or 'admin_panel')])
+    reply_markup = InlineKeyboardMarkup(keyboard)
 
-def remove_lock():
-    if os.path.exists(LOCK_FILE):
-        os.remove(LOCK_FILE)
+    try:
+        await query.edit_message_text(full_text, reply_markup=reply_markup)
+    except BadRequest as e:
+        # Повторное нажатие «Обновить» без изменений в заявках
+        if 'not modified' not in str(e):
+            raise
+
+# Запуск и остановка фоновых задач вместе с приложением
+async def post_init(application) -> None:
+    outbox_worker.start()
+    # Показатели компонентов для /metrics
+    add_collector('bot_updates', application.update_processor.stats)
+    add_collector('bot_persistence', application.persistence.stats)
+    add_collector('bot_outbound', application.bot.rate_limiter.stats)
+    add_collector('bot_status_message', status_message.stats)
+    add_collector('bot_media_groups', media_groups.stats)
+    add_collector('attachment_cache', get_cache_stats)
+    add_collector('db_pool', get_pool_stats)
+    add_collector('user_tickets_cache', get_user_tickets_cache_stats)
+    add_collector('admin_cache', get_admin_cache_stats)
+    await metrics_server.start()
+
+async def post_stop(application) -> None:
+    # Альбомы, не дождавшиеся обработки, обрабатываются до остановки
+    await media_groups.flush_all(application)
+    # Отложенные изменения сообщений о ходе заявки отправляются, пока бот ещё работает
+    await status_message.flush_all()
+
+async def post_shutdown(application) -> None:
+    await metrics_server.stop()
+    await outbox_worker.stop()
+    await close_http_client()
+
+# Создание приложения с обработчиками
+def build_application(mode='polling'):
+    builder = ApplicationBuilder().token(TOKEN).post_init(post_init).post_stop(post_stop).post_shutdown(post_shutdown)
+    # Состояние диалогов переживает перезапуск и доступно другим экземплярам
+    builder = builder.persistence(PostgresPersistence())
+    # Обновления разных пользователей обрабатываются параллельно, одного пользователя — по порядку
+    builder = builder.concurrent_updates(ChatOrderedUpdateProcessor())
+    # Все запросы к Bot API проходят через общий планировщик с лимитами по чатам и приоритетами
+    builder = builder.rate_limiter(OutboundScheduler())
+    if TELEGRAM_BASE_URL:
+        # Локальный Bot API сервер или его имитация для тестов
+        builder = builder.base_url(f"{TELEGRAM_BASE_URL.rstrip('/')}/bot").base_file_url(f"{TELEGRAM_BASE_URL.rstrip('/')}/file/bot")
+    if mode == 'webhook':
+        # Обновления приходят на встроенный HTTP-сервер, Updater не нужен
+        builder = builder.updater(None)
+    application = builder.build()
+
+    # Удаление сообщений, срок которых истёк (выполняется только на лидере)
+    application.job_queue.run_repeating(sweep_expired_messages, interval=MESSAGE_EXPIRY_INTERVAL, first=MESSAGE_EXPIRY_INTERVAL)
+    # Разделы заявок на следующие месяцы и перенос старых решённых заявок в архив (только на лидере)
+    application.job_queue.run_repeating(maintain_tickets, interval=TICKET_MAINTENANCE_INTERVAL, first=60)
+
+    application.add_handler(TypeHandler(Update, flush_media_group), group=-1)
+    application.add_handler(CommandHandler('start', start))
+    application.add_handler(CommandHandler('mytickets', my_tickets))
+    application.add_handler(CommandHandler('search', search))
+    application.add_handler(CommandHandler('stats', stats))
+    application.add_handler(CommandHandler('export', export))
+    application.add_handler(CallbackQueryHandler(button_click))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_input))
+    application.add_handler(MessageHandler(filters.CONTACT, handle_contact))
+    application.add_handler(MessageHandler(filters.ALL & ~(filters.TEXT | filters.COMMAND | filters.CONTACT), handle_media))
+    return application
 
 # Основная функция
 def main():
-    check_single_instance()
     try:
         # Инициализация базы данных и добавление администраторов
         init_db()
         add_admin(7186761120)  # Первый администратор
         add_admin(289675630)   # Второй администратор
+        start_admin_listener()
+        # Вложения, оставшиеся от прерванных загрузок и отменённых заявок
+        referenced = get_referenced_attachments()
+        if referenced is not None:
+            cleanup_orphans(referenced)
+        # Координация экземпляров: вместо файла блокировки — advisory-блокировка в PostgreSQL
+        elector = create_elector(database_connect_kwargs())
 
         # Запуск бота
-        application = ApplicationBuilder().token(TOKEN).build()
-
-        application.add_handler(CommandHandler('start', start))
-        application.add_handler(CallbackQueryHandler(button_click))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_input))
-        application.add_handler(MessageHandler(filters.CONTACT, handle_contact))
-        application.add_handler(MessageHandler(filters.ALL & ~(filters.TEXT | filters.COMMAND | filters.CONTACT), handle_media))
-
-        logger.info("Бот запущен!")
-        application.run_polling()
+        application = build_application(BOT_MODE)
+        # Став лидером, подхватываем состояния диалогов, записанные прежним лидером
+        elector.on_elected(application.persistence.reload_changed)
+        logger.info(f"Бот запущен! Режим: {BOT_MODE}")
+        if BOT_MODE == 'webhook':
+            asyncio.run(run_webhook(application, elector))
+        else:
+            # Опрашивает только лидер; запуск polling снимает webhook, оставшийся от режима webhook
+            asyncio.run(run_polling(application, elector))
     except Exception as e:
         logger.error(f"Ошибка при запуске бота: {e}")
     finally:
-        remove_lock()
+        stop_admin_listener()
+        shutdown_executor()
+        close_pool()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import os
+
+from dotenv import load_dotenv
+
+# Загружаем переменные из .env
+load_dotenv()
+
+# Сколько ждать следующий элемент альбома, прежде чем обработать альбом целиком, с
+MEDIA_GROUP_DEBOUNCE = float(os.getenv("MEDIA_GROUP_DEBOUNCE", "1.0"))
+
+logger = logging.getLogger(__name__)
+
+
+class _Group:
+    def __init__(self, media_group_id, chat_id):
+        self.media_group_id = media_group_id
+        self.chat_id = chat_id
+        self.messages = []
+        self.timer = None
+
+
+# Сборщик альбомов. Telegram присылает каждый элемент альбома отдельным обновлением;
+# элементы копятся, пока новые не перестанут приходить, и передаются в callback одним списком.
+# callback(application, user_id, chat_id, messages) выполняется в очереди пользователя
+# (ChatOrderedUpdateProcessor.chat_slot), поэтому не пересекается с его обработчиками.
+class MediaGroupCollector:
+    def __init__(self, callback, delay=MEDIA_GROUP_DEBOUNCE):
+        self._callback = callback
+        self.delay = delay
+        self._groups = {}   # user_id -> _Group; у пользователя собирается не больше одного альбома
+        self.groups = 0
+        self.items = 0
+
+    async def add(self, application, user_id, chat_id, message):
+        group = self._groups.get(user_id)
+        if group is not None and group.media_group_id != message.media_group_id:
+            await self._flush(application, user_id)
+            group = None
+        if group is None:
+            group = self._groups[user_id] = _Group(message.media_group_id, chat_id)
+        group.messages.append(message)
+        self.items += 1
+        if group.timer is not None:
+            group.timer.cancel()
+        loop = asyncio.get_running_loop()
+        group.timer = loop.call_later(self.delay, self._expire, application, user_id, group)
+
+    def _expire(self, application, user_id, group):
+        if self._groups.get(user_id) is group:
+            application.create_task(self._run_in_slot(application, user_id, group))
+
+    async def _run_in_slot(self, application, user_id, group):
+        chat_slot = getattr(application.update_processor, 'chat_slot', None)
+        if chat_slot is None:
+            await self._flush(application, user_id, group)
+            return
+        async with chat_slot(user_id):
+            await self._flush(application, user_id, group)
+
+    # Обрабатывает собранный альбом пользователя. Вызывается и из его обработчика,
+    # который уже занимает очередь пользователя, поэтому сам очередь не занимает.
+    async def _flush(self, application, user_id, group=None):
+        current = self._groups.get(user_id)
+        if current is None or (group is not None and current is not group):
+            return
+        del self._groups[user_id]
+        if current.timer is not None:
+            current.timer.cancel()
+        self.groups += 1
+        try:
+            await self._callback(application, user_id, current.chat_id, current.messages)
+        except Exception as e:
+            logger.error(f"Ошибка обработки альбома {current.media_group_id} пользователя {user_id}: {e}")
+
+    # Перед любым другим обновлением пользователя его недособранный альбом обрабатывается сразу,
+    # чтобы, например, «Завершить заявку» не опередило вложения
+    async def flush_before(self, application, user_id, media_group_id=None):
+        group = self._groups.get(user_id)
+        if group is not None and group.media_group_id != media_group_id:
+            await self._flush(application, user_id)
+
+    # При остановке бота альбомы не должны потеряться
+    async def flush_all(self, application):
+        for user_id in list(self._groups):
+            await self._flush(application, user_id)
+
+    def stats(self):
+        return {'pending': len(self._groups), 'groups': self.groups, 'items': self.items}
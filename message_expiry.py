@@ -0,0 +1,78 @@
+import asyncio
+import logging
+import os
+from collections import defaultdict
+
+from dotenv import load_dotenv
+from telegram.error import BadRequest
+
+from async_db import schedule_message_deletion, get_expired_messages, remove_message_expiry
+from coordination import leader_only
+
+# Загружаем переменные из .env
+load_dotenv()
+
+# Как часто проверять сообщения, которым пора удалиться, с
+MESSAGE_EXPIRY_INTERVAL = float(os.getenv("MESSAGE_EXPIRY_INTERVAL", "5"))
+# Сколько сообщений удалять за один проход
+MESSAGE_EXPIRY_BATCH = int(os.getenv("MESSAGE_EXPIRY_BATCH", "500"))
+
+# deleteMessages принимает не больше 100 сообщений одного чата
+DELETE_MESSAGES_LIMIT = 100
+
+logger = logging.getLogger(__name__)
+
+
+# Удаление сообщения через delay секунд. Срок хранится в БД, поэтому переживает перезапуск бота.
+async def expire_message(chat_id, message_id, delay):
+    await expire_messages([(chat_id, message_id)], delay)
+
+
+# То же для нескольких сообщений (список (chat_id, message_id)) — одной записью в БД
+async def expire_messages(messages, delay):
+    if not await schedule_message_deletion(messages, delay):
+        logger.error(f"Сообщения {messages} не будут удалены автоматически")
+
+
+# Удаляет пачку сообщений одного чата. Возвращает True, если запись о них больше не нужна.
+async def _delete_chat_messages(bot, chat_id, message_ids):
+    try:
+        await bot.delete_messages(chat_id=chat_id, message_ids=message_ids)
+        logger.info(f"Удалено сообщений из чата {chat_id}: {len(message_ids)}")
+        return True
+    except BadRequest as e:
+        # Сообщения уже удалены или слишком старые: повтор не поможет
+        logger.error(f"Ошибка при удалении сообщений {message_ids} из чата {chat_id}: {e}")
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка при удалении сообщений {message_ids} из чата {chat_id}, повторим позже: {e}")
+        return False
+
+
+# Периодическая задача: удаляет все сообщения, срок которых истёк, по одному запросу на чат.
+# Запросы идут с приоритетом очистки через общий планировщик лимитов.
+# Выполняется только на лидере; записи удаляются из БД после удаления сообщений,
+# поэтому после перезапуска проход продолжается с того же места.
+@leader_only
+async def sweep_expired_messages(context):
+    while True:
+        rows = await get_expired_messages(MESSAGE_EXPIRY_BATCH)
+        if not rows:
+            return
+        chats = defaultdict(list)
+        for chat_id, message_id in rows:
+            chats[chat_id].append(message_id)
+
+        batches = []
+        for chat_id, message_ids in chats.items():
+            for start in range(0, len(message_ids), DELETE_MESSAGES_LIMIT):
+                batches.append((chat_id, message_ids[start:start + DELETE_MESSAGES_LIMIT]))
+        results = await asyncio.gather(
+            *(_delete_chat_messages(context.bot, chat_id, message_ids) for chat_id, message_ids in batches)
+        )
+
+        done = [(chat_id, message_id) for (chat_id, message_ids), ok in zip(batches, results) if ok
+                for message_id in message_ids]
+        await remove_message_expiry(done)
+        if len(rows) < MESSAGE_EXPIRY_BATCH or len(done) < len(rows):
+            return
@@ -0,0 +1,265 @@
+import asyncio
+import functools
+import logging
+import os
+import time
+
+from aiohttp import web
+from dotenv import load_dotenv
+
+# Загружаем переменные из .env
+load_dotenv()
+
+# Порт HTTP-адреса /metrics в формате Prometheus; 0 — метрики выключены и не собираются
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+# Как часто измерять задержку цикла событий, с
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+
+ENABLED = METRICS_PORT > 0
+
+# Границы корзин гистограмм задержек, с
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+logger = logging.getLogger(__name__)
+
+_metrics = []
+_collectors = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Счётчик с метками: значения хранятся по кортежу значений меток
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values = {}
+        _metrics.append(self)
+
+    def inc(self, *label_values, amount=1):
+        if ENABLED:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for values, count in sorted(self._values.items()):
+            lines.append(f'{self.name}{_format_labels(self.labels, values)} {_format_value(count)}')
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values = {}
+        _metrics.append(self)
+
+    def set(self, value, *label_values):
+        if ENABLED:
+            self._values[label_values] = value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge']
+        for values, value in sorted(self._values.items()):
+            lines.append(f'{self.name}{_format_labels(self.labels, values)} {_format_value(value)}')
+        return lines
+
+
+# Гистограмма с метками: [счётчики по корзинам, сумма, количество] по кортежу значений меток
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._values = {}
+        _metrics.append(self)
+
+    def observe(self, value, *label_values):
+        if not ENABLED:
+            return
+        entry = self._values.get(label_values)
+        if entry is None:
+            entry = self._values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][i] += 1
+                break
+        entry[1] += value
+        entry[2] += 1
+
+    # Измеряет время выполнения блока: with histogram.time('label'): ...
+    def time(self, *label_values):
+        return _Timer(self, label_values)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for values, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = _format_labels(self.labels, values, f'le="{_format_value(float(bound))}"')
+                lines.append(f'{self.name}_bucket{le} {cumulative}')
+            le = _format_labels(self.labels, values, 'le="+Inf"')
+            lines.append(f'{self.name}_bucket{le} {count}')
+            labels = _format_labels(self.labels, values)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+        return False
+
+
+HANDLER_DURATION = Histogram('bot_handler_duration_seconds', 'Время обработки обновления обработчиком', ('handler',))
+HANDLER_ERRORS = Counter('bot_handler_errors_total', 'Исключения в обработчиках', ('handler',))
+DB_DURATION = Histogram('db_call_duration_seconds', 'Время вызова функции БД, включая ожидание потока', ('function',))
+SMTP_DURATION = Histogram('smtp_send_duration_seconds', 'Время отправки письма по SMTP', ('result',))
+ATTACHMENT_DURATION = Histogram('attachment_download_duration_seconds', 'Время получения вложения (из кэша или Telegram)')
+API_REQUESTS = Counter('telegram_api_requests_total', 'Запросы к Bot API', ('method',))
+API_ERRORS = Counter('telegram_api_errors_total', 'Ошибки запросов к Bot API', ('method', 'error'))
+API_DURATION = Histogram('telegram_api_duration_seconds', 'Время запроса к Bot API, включая ожидание лимитов', ('method',))
+LOOP_LAG = Histogram('event_loop_lag_seconds', 'Задержка срабатывания таймера цикла событий',
+                     buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+LOOP_LAG_MAX = Gauge('event_loop_lag_max_seconds', 'Наибольшая задержка цикла событий с прошлого опроса')
+
+
+# Показатели компонентов, у которых есть stats(): при каждом опросе значения
+# выводятся как gauge с именем <prefix>_<ключ>
+def add_collector(prefix, stats):
+    if ENABLED:
+        _collectors.append((prefix, stats))
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for prefix, stats in _collectors:
+        try:
+            values = stats()
+        except Exception as e:
+            logger.error(f"Ошибка получения показателей {prefix}: {e}")
+            continue
+        for key, value in values.items():
+            if isinstance(value, (bool, int, float)):
+                lines.append(f'# TYPE {prefix}_{key} gauge')
+                lines.append(f'{prefix}_{key} {_format_value(float(value))}')
+    # Максимум задержки считается заново до следующего опроса
+    LOOP_LAG_MAX._values.clear()
+    return '\n'.join(lines) + '\n'
+
+
+# Обёртка обработчика python-telegram-bot: время выполнения и исключения.
+# Если метрики выключены, возвращается сам обработчик.
+def timed_handler(callback):
+    if not ENABLED:
+        return callback
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_DURATION.observe(time.perf_counter() - started, name)
+    return wrapper
+
+
+# Обёртка асинхронной функции: время выполнения попадает в histogram с заданными метками.
+# Если метрики выключены, возвращается сама функция.
+def timed(histogram, *label_values):
+    def decorator(func):
+        if not ENABLED:
+            return func
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with histogram.time(*label_values):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Периодически засыпает на interval и измеряет, насколько позже проснулась
+async def _measure_loop_lag(interval):
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - started - interval)
+        LOOP_LAG.observe(lag)
+        current = LOOP_LAG_MAX._values.get((), 0.0)
+        LOOP_LAG_MAX.set(max(current, lag))
+
+
+# HTTP-сервер /metrics и измерение задержки цикла событий
+class MetricsServer:
+    def __init__(self, listen=METRICS_LISTEN, port=METRICS_PORT, lag_interval=LOOP_LAG_INTERVAL):
+        self.listen = listen
+        self.port = port
+        self.lag_interval = lag_interval
+        self._runner = None
+        self._lag_task = None
+
+    async def start(self):
+        if not ENABLED or self._runner is not None:
+            return
+
+        async def handle_metrics(request):
+            return web.Response(text=render(), content_type='text/plain', charset='utf-8',
+                                headers={'X-Content-Type-Options': 'nosniff'})
+
+        app = web.Application()
+        app.router.add_get('/metrics', handle_metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.listen, self.port).start()
+        self._lag_task = asyncio.create_task(_measure_loop_lag(self.lag_interval))
+        logger.info(f"Метрики доступны на http://{self.listen}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+            try:
+                await self._lag_task
+            except asyncio.CancelledError:
+                pass
+            self._lag_task = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,515 @@
+import datetime
+
+# Версионированные миграции схемы БД.
+# Каждая миграция — (номер, описание, шаги); шаг — SQL-команда или функция, принимающая курсор.
+# Применённые миграции записываются в schema_migrations; новые добавляются только в конец списка.
+
+# Ключ advisory-блокировки, чтобы два процесса не применяли миграции одновременно
+MIGRATION_LOCK_KEY = 4240001
+
+# Порядок разделов панели администратора: новые, в работе, решённые.
+# Выражение используется и в запросах, и в индексе, поэтому записано в одном месте.
+STATUS_RANK_SQL = "(CASE status WHEN 'Принято' THEN 0 WHEN 'В работе' THEN 1 ELSE 2 END)"
+
+# Конфигурация полнотекстового поиска по заявкам: русская морфология.
+# Запросы должны разбираться той же конфигурацией, что и колонка search_vector.
+SEARCH_CONFIG = 'russian'
+
+# Поисковый вектор заявки: вес A — организация, имя и телефон (телефон ещё и одними цифрами),
+# B — описание. Одно выражение у рабочей таблицы и архива.
+SEARCH_VECTOR_SQL = f'''(
+    setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(org_dept, '') || ' ' || coalesce(name, '')), 'A') ||
+    setweight(to_tsvector('simple', coalesce(phone, '') || ' ' || regexp_replace(coalesce(phone, ''), '\\D', '', 'g')), 'A') ||
+    setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(description, '')), 'B')
+)'''
+
+# Границы корзин гистограммы времени решения заявки, с: 1 ч, 4 ч, 1 сутки, 3 суток, 7 суток
+RESOLVE_TIME_BUCKETS = (3600, 14400, 86400, 259200, 604800)
+
+# Заявки разбиты на разделы по месяцам created_at: tickets_YYYY_MM
+TICKET_PARTITION_PREFIX = 'tickets_'
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+def ticket_partition_name(month):
+    return f"{TICKET_PARTITION_PREFIX}{month:%Y_%m}"
+
+# Месяц раздела по его имени или None, если таблица — не месячный раздел
+def ticket_partition_month(name):
+    try:
+        return datetime.datetime.strptime(name[len(TICKET_PARTITION_PREFIX):], '%Y_%m').date()
+    except ValueError:
+        return None
+
+# Создаёт месячные разделы tickets с месяца first (по умолчанию текущего) до months_ahead месяцев вперёд.
+# Границы — полночь первого числа по UTC. Разделы создаются под блокировкой миграций,
+# чтобы два процесса не создавали один и тот же раздел одновременно.
+# CREATE TABLE ... PARTITION OF блокирует tickets целиком: с lock_timeout создание раздела
+# не ждёт долгую транзакцию (а рабочие запросы — его), а завершается ошибкой до следующего запуска.
+def ensure_ticket_partitions(c, months_ahead, first=None, lock_timeout=None):
+    today = datetime.datetime.now(datetime.timezone.utc).date().replace(day=1)
+    month = (first or today).replace(day=1)
+    last = add_months(today, months_ahead)
+    c.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_KEY,))
+    if lock_timeout:
+        c.execute("SET LOCAL lock_timeout = %s", (lock_timeout,))
+    created = []
+    while month <= last:
+        name = ticket_partition_name(month)
+        c.execute("SELECT to_regclass(%s)", (name,))
+        if c.fetchone()[0] is None:
+            c.execute(
+                f"CREATE TABLE {name} PARTITION OF tickets FOR VALUES FROM (%s) TO (%s)",
+                (f"{month} 00:00:00+00", f"{add_months(month, 1)} 00:00:00+00")
+            )
+            created.append(name)
+        month = add_months(month, 1)
+    return created
+
+# Перенос данных из прежней таблицы в разделы: разделы создаются с месяца самой старой заявки
+def _copy_legacy_tickets(c):
+    c.execute("SELECT min(created_at) FROM tickets_legacy")
+    oldest = c.fetchone()[0]
+    first = oldest.astimezone(datetime.timezone.utc).date() if oldest else None
+    ensure_ticket_partitions(c, 2, first)
+    c.execute('''
+        INSERT INTO tickets (id, user_id, config, org_dept, name, phone, description, status, created_at, updated_at)
+        SELECT id, user_id, config, org_dept, name, phone, description, status, created_at, updated_at
+        FROM tickets_legacy
+    ''')
+
+# Начальное заполнение сводной статистики по уже решённым заявкам и оценкам.
+# Время решения — от создания до последнего изменения, день — день последнего изменения (UTC).
+def _stats_backfill_sql(table, with_day):
+    day = "day, " if with_day else ""
+    bounds = f"ARRAY{list(RESOLVE_TIME_BUCKETS)}::float8[]"
+    resolve_hist = ', '.join(
+        f"count(*) FILTER (WHERE resolved = 1 AND width_bucket(seconds, {bounds}) = {bucket})"
+        for bucket in range(len(RESOLVE_TIME_BUCKETS) + 1)
+    )
+    rating_hist = ', '.join(f"count(*) FILTER (WHERE rating = {rating})" for rating in range(1, 6))
+    return f'''
+        WITH facts AS (
+            SELECT tickets_all.config, tickets_all.org_dept,
+                   (tickets_all.updated_at AT TIME ZONE 'UTC')::date AS day,
+                   (tickets_all.status = 'Решено')::int AS resolved,
+                   extract(epoch FROM tickets_all.updated_at - tickets_all.created_at) AS seconds,
+                   feedback.rating
+            FROM tickets_all
+            LEFT JOIN feedback ON feedback.ticket_id = tickets_all.id AND feedback.rating BETWEEN 1 AND 5
+            WHERE tickets_all.status = 'Решено' OR feedback.rating IS NOT NULL
+        ), dims AS (
+            SELECT 'all' AS dimension, '' AS key, * FROM facts
+            UNION ALL
+            SELECT 'config', coalesce(config, ''), * FROM facts
+            UNION ALL
+            SELECT 'org', coalesce(org_dept, ''), * FROM facts
+        )
+        INSERT INTO {table} ({day}dimension, key, resolved, resolve_seconds, resolve_hist, ratings, rating_sum, rating_hist)
+        SELECT {day}dimension, key, sum(resolved), coalesce(sum(seconds * resolved), 0), ARRAY[{resolve_hist}],
+               count(rating), coalesce(sum(rating), 0), ARRAY[{rating_hist}]
+        FROM dims
+        GROUP BY {day}dimension, key
+    '''
+
+MIGRATIONS = [
+    (1, "Базовые таблицы", [
+        # Таблица tickets
+        '''
+        CREATE TABLE IF NOT EXISTS tickets (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            config TEXT,
+            org_dept TEXT,
+            name TEXT,
+            phone TEXT,
+            description TEXT,
+            status TEXT DEFAULT 'Принято'
+        )
+        ''',
+        # Таблица admins
+        '''
+        CREATE TABLE IF NOT EXISTS admins (
+            user_id BIGINT PRIMARY KEY
+        )
+        ''',
+        # Таблица feedback
+        '''
+        CREATE TABLE IF NOT EXISTS feedback (
+            ticket_id INTEGER PRIMARY KEY,
+            rating INTEGER,
+            FOREIGN KEY (ticket_id) REFERENCES tickets(id)
+        )
+        ''',
+        # Таблица email_outbox: уведомления, ожидающие отправки
+        '''
+        CREATE TABLE IF NOT EXISTS email_outbox (
+            id SERIAL PRIMARY KEY,
+            ticket_id INTEGER NOT NULL,
+            attachments TEXT[] NOT NULL DEFAULT '{}',
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            last_error TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            sent_at TIMESTAMPTZ
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS email_outbox_pending_idx
+        ON email_outbox (next_attempt_at) WHERE status = 'pending'
+        ''',
+        # Уведомление об изменении таблицы admins для кэшей во всех процессах
+        '''
+        CREATE OR REPLACE FUNCTION notify_admins_changed() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('admins_changed', '');
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+        "DROP TRIGGER IF EXISTS admins_changed ON admins",
+        '''
+        CREATE TRIGGER admins_changed
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON admins
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_admins_changed()
+        ''',
+    ]),
+    (2, "Индексы для частых запросов, created_at/updated_at у заявок", [
+        '''
+        ALTER TABLE tickets
+            ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION touch_updated_at() RETURNS trigger AS $$
+        BEGIN
+            NEW.updated_at = now();
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+        "DROP TRIGGER IF EXISTS tickets_touch_updated_at ON tickets",
+        '''
+        CREATE TRIGGER tickets_touch_updated_at
+        BEFORE UPDATE ON tickets
+        FOR EACH ROW EXECUTE FUNCTION touch_updated_at()
+        ''',
+        # Страницы панели администратора: ORDER BY ранг статуса, id
+        f"CREATE INDEX IF NOT EXISTS tickets_panel_idx ON tickets ({STATUS_RANK_SQL}, id)",
+        # Выборка открытых заявок по статусу: индекс мал, потому что решённые в него не попадают
+        '''
+        CREATE INDEX IF NOT EXISTS tickets_open_status_idx
+        ON tickets (status, id) WHERE status IN ('Принято', 'В работе')
+        ''',
+        # Поиск владельца заявки и история заявок пользователя
+        "CREATE INDEX IF NOT EXISTS tickets_user_id_idx ON tickets (user_id, id)",
+    ]),
+    (3, "Состояние диалогов пользователей (user_data)", [
+        '''
+        CREATE TABLE IF NOT EXISTS user_data (
+            user_id BIGINT PRIMARY KEY,
+            data JSONB NOT NULL DEFAULT '{}',
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        ''',
+        # Загрузка изменений от других экземпляров и удаление заброшенных диалогов
+        "CREATE INDEX IF NOT EXISTS user_data_updated_at_idx ON user_data (updated_at)",
+    ]),
+    (4, "Отложенное удаление сообщений", [
+        '''
+        CREATE TABLE IF NOT EXISTS message_expiry (
+            chat_id BIGINT NOT NULL,
+            message_id BIGINT NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (chat_id, message_id)
+        )
+        ''',
+        # Выборка сообщений, которым пора удалиться
+        "CREATE INDEX IF NOT EXISTS message_expiry_expires_at_idx ON message_expiry (expires_at)",
+    ]),
+    (5, "Полнотекстовый поиск по заявкам", [
+        # Вычисляемая колонка обновляется самой СУБД при каждом INSERT/UPDATE
+        f"ALTER TABLE tickets ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS {SEARCH_VECTOR_SQL} STORED",
+        "CREATE INDEX IF NOT EXISTS tickets_search_idx ON tickets USING GIN (search_vector)",
+    ]),
+    (6, "Месячные разделы заявок и архив решённых заявок", [
+        # Первичный ключ разделённой таблицы обязан включать created_at, поэтому внешний ключ
+        # feedback -> tickets(id) невозможен; последовательность номеров переходит к новой таблице
+        "ALTER SEQUENCE tickets_id_seq OWNED BY NONE",
+        "ALTER TABLE tickets RENAME TO tickets_legacy",
+        "ALTER TABLE feedback DROP CONSTRAINT IF EXISTS feedback_ticket_id_fkey",
+        f'''
+        CREATE TABLE tickets (
+            id INTEGER NOT NULL DEFAULT nextval('tickets_id_seq'),
+            user_id BIGINT,
+            config TEXT,
+            org_dept TEXT,
+            name TEXT,
+            phone TEXT,
+            description TEXT,
+            status TEXT DEFAULT 'Принято',
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            search_vector tsvector GENERATED ALWAYS AS {SEARCH_VECTOR_SQL} STORED
+        ) PARTITION BY RANGE (created_at)
+        ''',
+        _copy_legacy_tickets,
+        "DROP TABLE tickets_legacy",
+        "ALTER SEQUENCE tickets_id_seq OWNED BY tickets.id",
+        "ALTER TABLE tickets ADD PRIMARY KEY (id, created_at)",
+        f"CREATE INDEX tickets_panel_idx ON tickets ({STATUS_RANK_SQL}, id)",
+        "CREATE INDEX tickets_open_status_idx ON tickets (status, id) WHERE status IN ('Принято', 'В работе')",
+        "CREATE INDEX tickets_user_id_idx ON tickets (user_id, id)",
+        "CREATE INDEX tickets_search_idx ON tickets USING GIN (search_vector)",
+        '''
+        CREATE TRIGGER tickets_touch_updated_at
+        BEFORE UPDATE ON tickets
+        FOR EACH ROW EXECUTE FUNCTION touch_updated_at()
+        ''',
+        # Решённые заявки старше срока хранения переносятся сюда и не попадают в рабочие запросы
+        f'''
+        CREATE TABLE IF NOT EXISTS tickets_archive (
+            id INTEGER PRIMARY KEY,
+            user_id BIGINT,
+            config TEXT,
+            org_dept TEXT,
+            name TEXT,
+            phone TEXT,
+            description TEXT,
+            status TEXT,
+            created_at TIMESTAMPTZ NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL,
+            archived_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            search_vector tsvector GENERATED ALWAYS AS {SEARCH_VECTOR_SQL} STORED
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS tickets_archive_user_id_idx ON tickets_archive (user_id, id)",
+        "CREATE INDEX IF NOT EXISTS tickets_archive_search_idx ON tickets_archive USING GIN (search_vector)",
+        # Все заявки, включая архив: для поиска и истории пользователя
+        '''
+        CREATE OR REPLACE VIEW tickets_all AS
+        SELECT id, user_id, config, org_dept, name, phone, description, status, created_at, updated_at, search_vector
+        FROM tickets
+        UNION ALL
+        SELECT id, user_id, config, org_dept, name, phone, description, status, created_at, updated_at, search_vector
+        FROM tickets_archive
+        ''',
+    ]),
+    (7, "Сводная статистика решений и оценок", [
+        # Строка на (разрез, значение, день) и на (разрез, значение) за всё время.
+        # Разрезы: all (ключ ''), config, org. Гистограммы — массивы счётчиков по корзинам.
+        f'''
+        CREATE TABLE IF NOT EXISTS ticket_stats_daily (
+            day DATE NOT NULL,
+            dimension TEXT NOT NULL,
+            key TEXT NOT NULL,
+            resolved INTEGER NOT NULL DEFAULT 0,
+            resolve_seconds DOUBLE PRECISION NOT NULL DEFAULT 0,
+            resolve_hist INTEGER[] NOT NULL DEFAULT array_fill(0, ARRAY[{len(RESOLVE_TIME_BUCKETS) + 1}]),
+            ratings INTEGER NOT NULL DEFAULT 0,
+            rating_sum INTEGER NOT NULL DEFAULT 0,
+            rating_hist INTEGER[] NOT NULL DEFAULT array_fill(0, ARRAY[5]),
+            PRIMARY KEY (dimension, key, day)
+        )
+        ''',
+        f'''
+        CREATE TABLE IF NOT EXISTS ticket_stats_totals (
+            dimension TEXT NOT NULL,
+            key TEXT NOT NULL,
+            resolved INTEGER NOT NULL DEFAULT 0,
+            resolve_seconds DOUBLE PRECISION NOT NULL DEFAULT 0,
+            resolve_hist INTEGER[] NOT NULL DEFAULT array_fill(0, ARRAY[{len(RESOLVE_TIME_BUCKETS) + 1}]),
+            ratings INTEGER NOT NULL DEFAULT 0,
+            rating_sum INTEGER NOT NULL DEFAULT 0,
+            rating_hist INTEGER[] NOT NULL DEFAULT array_fill(0, ARRAY[5]),
+            PRIMARY KEY (dimension, key)
+        )
+        ''',
+        # Самые нагруженные конфигурации и организации без сортировки всей таблицы
+        "CREATE INDEX IF NOT EXISTS ticket_stats_totals_resolved_idx ON ticket_stats_totals (dimension, resolved DESC)",
+        _stats_backfill_sql('ticket_stats_daily', with_day=True),
+        _stats_backfill_sql('ticket_stats_totals', with_day=False),
+        '''
+        CREATE OR REPLACE FUNCTION stats_array_add(a INTEGER[], b INTEGER[]) RETURNS INTEGER[] AS $$
+            SELECT array_agg(coalesce(x, 0) + coalesce(y, 0) ORDER BY i) FROM unnest(a, b) WITH ORDINALITY AS u(x, y, i)
+        $$ LANGUAGE sql IMMUTABLE
+        ''',
+        # Добавляет событие во все разрезы за сегодня и за всё время:
+        # resolved решённых заявок со временем решения seconds и/или delta оценок rating
+        f'''
+        CREATE OR REPLACE FUNCTION ticket_stats_add(
+            p_config TEXT, p_org TEXT, p_resolved INTEGER, p_seconds DOUBLE PRECISION, p_rating INTEGER, p_delta INTEGER
+        ) RETURNS void AS $$
+        DECLARE
+            v_day DATE := (now() AT TIME ZONE 'UTC')::date;
+            v_resolve_hist INTEGER[] := array_fill(0, ARRAY[{len(RESOLVE_TIME_BUCKETS) + 1}]);
+            v_rating_hist INTEGER[] := array_fill(0, ARRAY[5]);
+        BEGIN
+            IF p_resolved <> 0 THEN
+                v_resolve_hist[width_bucket(p_seconds, ARRAY{list(RESOLVE_TIME_BUCKETS)}::float8[]) + 1] := p_resolved;
+            END IF;
+            IF p_rating IS NOT NULL THEN
+                v_rating_hist[p_rating] := p_delta;
+            END IF;
+
+            INSERT INTO ticket_stats_daily AS s
+                (day, dimension, key, resolved, resolve_seconds, resolve_hist, ratings, rating_sum, rating_hist)
+            SELECT v_day, d.dimension, d.key, p_resolved, p_seconds * p_resolved, v_resolve_hist,
+                   p_delta, coalesce(p_rating, 0) * p_delta, v_rating_hist
+            FROM (VALUES ('all', ''), ('config', coalesce(p_config, '')), ('org', coalesce(p_org, ''))) AS d(dimension, key)
+            ON CONFLICT (dimension, key, day) DO UPDATE SET
+                resolved = s.resolved + EXCLUDED.resolved,
+                resolve_seconds = s.resolve_seconds + EXCLUDED.resolve_seconds,
+                resolve_hist = stats_array_add(s.resolve_hist, EXCLUDED.resolve_hist),
+                ratings = s.ratings + EXCLUDED.ratings,
+                rating_sum = s.rating_sum + EXCLUDED.rating_sum,
+                rating_hist = stats_array_add(s.rating_hist, EXCLUDED.rating_hist);
+
+            INSERT INTO ticket_stats_totals AS s
+                (dimension, key, resolved, resolve_seconds, resolve_hist, ratings, rating_sum, rating_hist)
+            SELECT d.dimension, d.key, p_resolved, p_seconds * p_resolved, v_resolve_hist,
+                   p_delta, coalesce(p_rating, 0) * p_delta, v_rating_hist
+            FROM (VALUES ('all', ''), ('config', coalesce(p_config, '')), ('org', coalesce(p_org, ''))) AS d(dimension, key)
+            ON CONFLICT (dimension, key) DO UPDATE SET
+                resolved = s.resolved + EXCLUDED.resolved,
+                resolve_seconds = s.resolve_seconds + EXCLUDED.resolve_seconds,
+                resolve_hist = stats_array_add(s.resolve_hist, EXCLUDED.resolve_hist),
+                ratings = s.ratings + EXCLUDED.ratings,
+                rating_sum = s.rating_sum + EXCLUDED.rating_sum,
+                rating_hist = stats_array_add(s.rating_hist, EXCLUDED.rating_hist);
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+        # Заявка решена: время от создания до решения
+        '''
+        CREATE OR REPLACE FUNCTION tickets_stats_resolved() RETURNS trigger AS $$
+        BEGIN
+            PERFORM ticket_stats_add(NEW.config, NEW.org_dept, 1, extract(epoch FROM now() - NEW.created_at), NULL, 0);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+        "DROP TRIGGER IF EXISTS tickets_stats_resolved ON tickets",
+        '''
+        CREATE TRIGGER tickets_stats_resolved
+        AFTER UPDATE OF status ON tickets
+        FOR EACH ROW WHEN (NEW.status = 'Решено' AND OLD.status IS DISTINCT FROM NEW.status)
+        EXECUTE FUNCTION tickets_stats_resolved()
+        ''',
+        # Оценка поставлена или изменена: прежняя вычитается, новая добавляется
+        '''
+        CREATE OR REPLACE FUNCTION feedback_stats() RETURNS trigger AS $$
+        DECLARE
+            v_config TEXT;
+            v_org TEXT;
+        BEGIN
+            IF TG_OP = 'UPDATE' AND OLD.rating IS NOT DISTINCT FROM NEW.rating THEN
+                RETURN NULL;
+            END IF;
+            SELECT config, org_dept INTO v_config, v_org FROM tickets_all WHERE id = NEW.ticket_id;
+            IF TG_OP = 'UPDATE' AND OLD.rating BETWEEN 1 AND 5 THEN
+                PERFORM ticket_stats_add(v_config, v_org, 0, 0, OLD.rating, -1);
+            END IF;
+            IF NEW.rating BETWEEN 1 AND 5 THEN
+                PERFORM ticket_stats_add(v_config, v_org, 0, 0, NEW.rating, 1);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+        "DROP TRIGGER IF EXISTS feedback_stats ON feedback",
+        '''
+        CREATE TRIGGER feedback_stats
+        AFTER INSERT OR UPDATE OF rating ON feedback
+        FOR EACH ROW EXECUTE FUNCTION feedback_stats()
+        ''',
+    ]),
+    (8, "Время создания заявки в очереди писем и оценках", [
+        # Рядом с номером заявки хранится время её создания: по нему запросы
+        # к tickets и tickets_all находят раздел заявки, а не просматривают все.
+        # У оценок несуществующих заявок (до проверки в save_feedback) время остаётся пустым.
+        "ALTER TABLE email_outbox ADD COLUMN IF NOT EXISTS ticket_created_at TIMESTAMPTZ",
+        "UPDATE email_outbox SET ticket_created_at = t.created_at FROM tickets_all t WHERE t.id = email_outbox.ticket_id",
+        "ALTER TABLE feedback ADD COLUMN IF NOT EXISTS ticket_created_at TIMESTAMPTZ",
+        "UPDATE feedback SET ticket_created_at = t.created_at FROM tickets_all t WHERE t.id = feedback.ticket_id",
+        '''
+        CREATE OR REPLACE FUNCTION feedback_stats() RETURNS trigger AS $$
+        DECLARE
+            v_config TEXT;
+            v_org TEXT;
+        BEGIN
+            IF TG_OP = 'UPDATE' AND OLD.rating IS NOT DISTINCT FROM NEW.rating THEN
+                RETURN NULL;
+            END IF;
+            SELECT config, org_dept INTO v_config, v_org FROM tickets_all
+            WHERE id = NEW.ticket_id AND created_at = NEW.ticket_created_at;
+            IF TG_OP = 'UPDATE' AND OLD.rating BETWEEN 1 AND 5 THEN
+                PERFORM ticket_stats_add(v_config, v_org, 0, 0, OLD.rating, -1);
+            END IF;
+            IF NEW.rating BETWEEN 1 AND 5 THEN
+                PERFORM ticket_stats_add(v_config, v_org, 0, 0, NEW.rating, 1);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def get_schema_version(c):
+    c.execute("SELECT to_regclass('schema_migrations')")
+    if c.fetchone()[0] is None:
+        return 0
+    c.execute("SELECT coalesce(max(version), 0) FROM schema_migrations")
+    return c.fetchone()[0]
+
+# Применяет недостающие миграции, каждую в своей транзакции.
+# Если схема актуальна, выполняется один SELECT и никакого DDL.
+# Возвращает номера применённых миграций.
+def migrate(conn):
+    c = conn.cursor()
+    version = get_schema_version(c)
+    conn.rollback()
+    if version >= LATEST_VERSION:
+        return []
+
+    applied = []
+    c.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_KEY,))
+    try:
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+        ''')
+        conn.commit()
+        # Пока ждали блокировку, миграции мог применить другой процесс
+        version = get_schema_version(c)
+        for number, description, steps in MIGRATIONS:
+            if number <= version:
+                continue
+            for step in steps:
+                if callable(step):
+                    step(c)
+                else:
+                    c.execute(step)
+            c.execute(
+                "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                (number, description)
+            )
+            conn.commit()
+            applied.append(number)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        c.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_KEY,))
+        conn.commit()
+    return applied
@@ -0,0 +1,172 @@
+import asyncio
+import json
+import logging
+import os
+from datetime import timedelta
+
+from dotenv import load_dotenv
+from telegram.ext import BasePersistence, PersistenceInput
+
+from async_db import load_user_data, get_user_data_row, save_user_data_batch
+
+# Загружаем переменные из .env
+load_dotenv()
+
+# Как часто накопленные изменения user_data записываются в БД, с
+PERSISTENCE_FLUSH_INTERVAL = float(os.getenv("PERSISTENCE_FLUSH_INTERVAL", "2"))
+# Диалоги, не менявшиеся дольше этого срока, при запуске удаляются, дни
+PERSISTENCE_MAX_AGE_DAYS = int(os.getenv("PERSISTENCE_MAX_AGE_DAYS", "30"))
+# Перечитывать состояние пользователя из БД перед каждым обновлением.
+# Нужно, только если обновления одного пользователя могут попасть на разные экземпляры (webhook за балансировщиком).
+PERSISTENCE_REFRESH = os.getenv("PERSISTENCE_REFRESH", "0") == "1"
+
+# Запас при загрузке изменений других экземпляров: updated_at — время начала их транзакции
+RELOAD_OVERLAP = timedelta(seconds=60)
+
+logger = logging.getLogger(__name__)
+
+
+# Хранение context.user_data в PostgreSQL с отложенной записью.
+# Изменения копятся в памяти и записываются одним пакетным upsert на каждом цикле
+# сохранения python-telegram-bot (раз в flush_interval) и при остановке бота.
+class PostgresPersistence(BasePersistence):
+    def __init__(self, flush_interval=PERSISTENCE_FLUSH_INTERVAL, max_age_days=PERSISTENCE_MAX_AGE_DAYS,
+                 refresh=PERSISTENCE_REFRESH):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=flush_interval
+        )
+        self.max_age_days = max_age_days
+        self.refresh = refresh
+        self._pending = {}      # user_id -> JSON для записи или None для удаления
+        self._stamps = {}       # user_id -> updated_at последней известной версии в БД
+        self._incoming = {}     # user_id -> состояние, изменённое другим экземпляром
+        self._since = None      # наибольший updated_at среди прочитанных строк
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+        self.flushes = 0
+        self.rows_written = 0
+        self.flush_errors = 0
+
+    def _remember(self, user_id, updated_at):
+        self._stamps[user_id] = updated_at
+        if self._since is None or updated_at > self._since:
+            self._since = updated_at
+
+    async def get_user_data(self):
+        rows = await load_user_data(self.max_age_days)
+        for user_id, _, updated_at in rows:
+            self._remember(user_id, updated_at)
+        logger.info(f"Загружено состояний диалогов: {len(rows)}")
+        return {user_id: data for user_id, data, _ in rows}
+
+    # Подхватывает состояния, которые записали другие экземпляры, пока этот был в резерве.
+    # Применяются они в refresh_user_data, перед следующим обновлением от пользователя.
+    async def reload_changed(self):
+        since = None
+        if self._since is not None:
+            since = self._since - RELOAD_OVERLAP
+        rows = await load_user_data(self.max_age_days, since)
+        changed = 0
+        for user_id, data, updated_at in rows:
+            if self._stamps.get(user_id) == updated_at or user_id in self._pending:
+                continue
+            self._incoming[user_id] = data
+            self._remember(user_id, updated_at)
+            changed += 1
+        if changed:
+            logger.info(f"Состояний диалогов изменено другими экземплярами: {changed}")
+
+    async def refresh_user_data(self, user_id, user_data):
+        data = self._incoming.pop(user_id, None)
+        if data is None and self.refresh and user_id not in self._pending:
+            row = await get_user_data_row(user_id)
+            # Своя последняя запись совпадает с версией в БД — локальное состояние не старее
+            if row is not None and row[1] != self._stamps.get(user_id):
+                data = row[0]
+                self._remember(user_id, row[1])
+        if data is not None:
+            user_data.clear()
+            user_data.update(data)
+
+    async def update_user_data(self, user_id, data):
+        try:
+            self._pending[user_id] = json.dumps(data, ensure_ascii=False)
+        except (TypeError, ValueError) as e:
+            logger.error(f"Состояние диалога {user_id} не сериализуется в JSON: {e}")
+            return
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id):
+        self._pending[user_id] = None
+        self._stamps.pop(user_id, None)
+        self._schedule_flush()
+
+    # python-telegram-bot вызывает update_user_data для всех изменённых пользователей одним gather;
+    # задача записи запускается после них и забирает весь цикл одним запросом
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_pending())
+
+    async def _flush_pending(self):
+        async with self._flush_lock:
+            while self._pending:
+                batch, self._pending = self._pending, {}
+                upserts = [(user_id, data) for user_id, data in batch.items() if data is not None]
+                deletes = [user_id for user_id, data in batch.items() if data is None]
+                stamps = await save_user_data_batch(upserts, deletes)
+                if stamps is None:
+                    # Вернём в буфер, не затирая изменения, пришедшие во время записи
+                    self.flush_errors += 1
+                    for user_id, data in batch.items():
+                        self._pending.setdefault(user_id, data)
+                    return
+                for user_id, updated_at in stamps.items():
+                    self._remember(user_id, updated_at)
+                self.flushes += 1
+                self.rows_written += len(batch)
+
+    async def flush(self):
+        await self._flush_pending()
+
+    def stats(self):
+        return {
+            'pending': len(self._pending),
+            'flushes': self.flushes,
+            'rows_written': self.rows_written,
+            'flush_errors': self.flush_errors,
+        }
+
+    # Остальные данные бот не хранит
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
@@ -0,0 +1,290 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+
+from dotenv import load_dotenv
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from metrics import API_REQUESTS, API_ERRORS, API_DURATION
+from tracing import span
+
+# Загружаем переменные из .env
+load_dotenv()
+
+# Ограничения Telegram: около 30 сообщений в секунду всего, 1 в секунду в личный чат, 20 в минуту в группу
+RATE_LIMIT_GLOBAL = float(os.getenv("RATE_LIMIT_GLOBAL", "30"))            # запросов в секунду
+RATE_LIMIT_PRIVATE = float(os.getenv("RATE_LIMIT_PRIVATE", "1"))           # сообщений в секунду в личный чат
+RATE_LIMIT_GROUP = float(os.getenv("RATE_LIMIT_GROUP", "20"))              # сообщений в минуту в группу
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "3"))                 # сообщений подряд в личный чат без паузы
+RATE_LIMIT_MAX_RETRIES = int(os.getenv("RATE_LIMIT_MAX_RETRIES", "3"))     # повторов после ответа 429
+
+# Приоритеты очереди: меньше — раньше
+PRIORITY_INTERACTIVE = 0   # ответы пользователю, который ждёт реакции бота
+PRIORITY_BULK = 1          # уведомления другим пользователям
+PRIORITY_CLEANUP = 2       # удаление устаревших сообщений
+
+# Методы, которые не отправляют ничего в чаты и не ограничиваются
+UNLIMITED_ENDPOINTS = {
+    'getMe', 'getUpdates', 'getFile', 'setWebhook', 'deleteWebhook', 'getWebhookInfo', 'logOut', 'close',
+}
+CLEANUP_ENDPOINTS = {'deleteMessage', 'deleteMessages'}
+# Повторные вызовы с тем же (метод, чат, сообщение), ещё не отправленные в Telegram, объединяются
+COALESCED_ENDPOINTS = {'editMessageText', 'editMessageReplyMarkup', 'editMessageCaption', 'deleteMessage'}
+
+# Сколько корзин чатов держать в памяти, прежде чем удалять полные (давно не использованные)
+CHAT_BUCKETS_MAX = 10000
+
+logger = logging.getLogger(__name__)
+
+
+# Корзина токенов: rate токенов в секунду, не больше capacity про запас
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Сколько секунд ждать до появления токена
+    def delay(self):
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+# Запрос, ожидающий отправки. Объединённые запросы разделяют одну запись:
+# отправляется последний вариант, результат получают все.
+class _Pending:
+    def __init__(self, callback, args, kwargs, priority):
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.result = asyncio.get_running_loop().create_future()
+        self.started = False
+
+
+# Центральный планировщик исходящих запросов к Bot API.
+# Перед отправкой запрос ждёт токен своего чата (только отправка и изменение сообщений),
+# затем токен общей корзины; общие токены выдаются по приоритету, поэтому ответы пользователям
+# обгоняют удаление старых сообщений. Ответ 429 приостанавливает все отправки на retry_after.
+# Приоритет можно задать вызывающему коду: bot.send_message(..., rate_limit_args={'priority': PRIORITY_BULK}).
+class OutboundScheduler(BaseRateLimiter):
+    def __init__(self, global_rate=RATE_LIMIT_GLOBAL, private_rate=RATE_LIMIT_PRIVATE,
+                 group_rate_per_minute=RATE_LIMIT_GROUP, burst=RATE_LIMIT_BURST,
+                 max_retries=RATE_LIMIT_MAX_RETRIES):
+        self.global_rate = global_rate
+        self.private_rate = private_rate
+        self.group_rate = group_rate_per_minute / 60
+        self.burst = burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, max(1, int(global_rate)))
+        self._chats = {}            # chat_id -> [корзина, блокировка]
+        self._waiters = []          # куча (приоритет, номер, future) ожидающих общий токен
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._dispatcher = None
+        self._paused_until = 0.0
+        self._coalesce = {}         # (метод, чат, сообщение) -> _Pending
+        self.requests = 0
+        self.throttled = 0
+        self.wait_time = 0.0
+        self.retries = 0
+        self.coalesced = 0
+
+    async def initialize(self):
+        if self._dispatcher is None:
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+        for _, _, future in self._waiters:
+            if not future.done():
+                future.cancel()
+        self._waiters.clear()
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'throttled': self.throttled,
+            'wait_time': self.wait_time,
+            'retries': self.retries,
+            'coalesced': self.coalesced,
+            'queued': len(self._waiters),
+        }
+
+    # Выдаёт общие токены ожидающим в порядке приоритета
+    async def _dispatch(self):
+        while True:
+            while self._waiters and self._waiters[0][2].done():
+                heapq.heappop(self._waiters)
+            if not self._waiters:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = max(self._global.delay(), self._paused_until - time.monotonic())
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                self._global.take()
+                future.set_result(None)
+
+    async def _acquire_global(self, priority):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        self._wakeup.set()
+        await future
+
+    def _chat_entry(self, chat_id):
+        entry = self._chats.get(chat_id)
+        if entry is None:
+            if len(self._chats) >= CHAT_BUCKETS_MAX:
+                for key in [k for k, (bucket, lock) in self._chats.items() if not lock.locked() and bucket.is_full()]:
+                    del self._chats[key]
+            if chat_id > 0:
+                bucket = TokenBucket(self.private_rate, self.burst)
+            else:
+                bucket = TokenBucket(self.group_rate, max(1, self.burst))
+            entry = self._chats[chat_id] = [bucket, asyncio.Lock()]
+        return entry
+
+    # Запросы в один чат получают токены по очереди
+    async def _acquire_chat(self, chat_id):
+        bucket, lock = self._chat_entry(chat_id)
+        async with lock:
+            delay = bucket.delay()
+            while delay > 0:
+                await asyncio.sleep(delay)
+                delay = bucket.delay()
+            bucket.take()
+
+    async def _acquire(self, endpoint, chat_id, priority):
+        started = time.monotonic()
+        if chat_id is not None and endpoint not in CLEANUP_ENDPOINTS and endpoint != 'answerCallbackQuery':
+            await self._acquire_chat(chat_id)
+        await self._acquire_global(priority)
+        waited = time.monotonic() - started
+        if waited > 0.001:
+            self.throttled += 1
+            self.wait_time += waited
+
+    def _pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        API_REQUESTS.inc(endpoint)
+        started = time.monotonic()
+        try:
+            with span('telegram', endpoint):
+                return await self._process(callback, args, kwargs, endpoint, data, rate_limit_args)
+        except Exception as e:
+            API_ERRORS.inc(endpoint, type(e).__name__)
+            raise
+        finally:
+            # getUpdates — долгий опрос, его длительность ничего не говорит
+            if endpoint != 'getUpdates':
+                API_DURATION.observe(time.monotonic() - started, endpoint)
+
+    async def _process(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint in UNLIMITED_ENDPOINTS:
+            return await callback(*args, **kwargs)
+        self.requests += 1
+
+        chat_id = data.get('chat_id')
+        try:
+            chat_id = int(chat_id) if chat_id is not None else None
+        except (TypeError, ValueError):
+            # @username канала
+            chat_id = None
+        priority = PRIORITY_CLEANUP if endpoint in CLEANUP_ENDPOINTS else PRIORITY_INTERACTIVE
+        if isinstance(rate_limit_args, dict):
+            priority = rate_limit_args.get('priority', priority)
+
+        key = None
+        if endpoint in COALESCED_ENDPOINTS and chat_id is not None and data.get('message_id') is not None:
+            key = (endpoint, chat_id, data['message_id'])
+            if endpoint == 'deleteMessage':
+                self._drop_edits(chat_id, data['message_id'])
+            pending = self._coalesce.get(key)
+            if pending is not None and not pending.started:
+                # Ещё не отправленный запрос к тому же сообщению: отправим только последний вариант
+                pending.callback, pending.args, pending.kwargs = callback, args, kwargs
+                pending.priority = min(pending.priority, priority)
+                self.coalesced += 1
+                return await asyncio.shield(pending.result)
+
+        pending = _Pending(callback, args, kwargs, priority)
+        if key is not None:
+            self._coalesce[key] = pending
+        try:
+            result = await self._send(endpoint, chat_id, pending)
+            if not pending.result.done():
+                pending.result.set_result(result)
+            return result
+        except BaseException as e:
+            if not pending.result.done():
+                if isinstance(e, Exception):
+                    pending.result.set_exception(e)
+                    # Исключение получит и этот вызов; объединённые получат его из future
+                    pending.result.exception()
+                else:
+                    pending.result.cancel()
+            raise
+        finally:
+            if key is not None and self._coalesce.get(key) is pending:
+                del self._coalesce[key]
+
+    # Удаление сообщения делает ожидающие изменения этого сообщения ненужными
+    def _drop_edits(self, chat_id, message_id):
+        for endpoint in COALESCED_ENDPOINTS - CLEANUP_ENDPOINTS:
+            pending = self._coalesce.get((endpoint, chat_id, message_id))
+            if pending is not None and not pending.started:
+                del self._coalesce[(endpoint, chat_id, message_id)]
+                pending.started = True
+                pending.result.set_result(True)
+                self.coalesced += 1
+
+    async def _send(self, endpoint, chat_id, pending):
+        for attempt in range(self.max_retries + 1):
+            with span('rate_limit', endpoint):
+                await self._acquire(endpoint, chat_id, pending.priority)
+            if pending.result.done():
+                # Запрос отменён удалением сообщения, пока ждал токен
+                return pending.result.result()
+            pending.started = True
+            try:
+                return await pending.callback(*pending.args, **pending.kwargs)
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                seconds = retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else float(retry_after)
+                if attempt == self.max_retries:
+                    logger.error(f"{endpoint}: превышен лимит Telegram после {attempt} повторов")
+                    raise
+                self.retries += 1
+                logger.warning(f"{endpoint}: Telegram просит подождать {seconds} с, отправка приостановлена")
+                self._pause(seconds + 0.1)
+                pending.started = False
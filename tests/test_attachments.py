@@ -0,0 +1,69 @@
+# Проверка совместной загрузки одного файла несколькими запросами.
+#
+# Запуск:
+#   python -m unittest discover tests
+import asyncio
+import hashlib
+import os
+import sys
+import tempfile
+import unittest
+import uuid
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import attachments
+from attachments import BlobStore, PARTIAL_SUFFIX
+
+
+class InflightDownloadTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = BlobStore(os.path.join(self.tmp.name, 'blobs'), os.path.join(self.tmp.name, 'by_uid'), 0)
+        self.fetches = 0
+        for patcher in (
+            mock.patch.object(attachments, 'ATTACHMENTS_DIR', self.tmp.name),
+            mock.patch.object(attachments, '_store', self.store),
+            mock.patch.object(attachments, '_fetch', self.fake_fetch),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmp.cleanup)
+
+    # Первая загрузка завершается ошибкой, следующие — успешно
+    async def fake_fetch(self, bot, file_id, ticket_size, unique_id):
+        self.fetches += 1
+        attempt = self.fetches
+        await asyncio.sleep(0.05)
+        if attempt == 1:
+            raise RuntimeError('сеть недоступна')
+        content = 'содержимое'.encode()
+        partial = os.path.join(self.store.blobs_dir, uuid.uuid4().hex + PARTIAL_SUFFIX)
+        with open(partial, 'wb') as f:
+            f.write(content)
+        blob, _ = self.store.add(partial, hashlib.sha256(content).hexdigest(), unique_id)
+        return blob
+
+    async def test_waiters_retry_once_after_failed_download(self):
+        results = await asyncio.wait_for(asyncio.gather(
+            *(attachments.download_attachment(None, 'file', f'{i}.txt', file_unique_id='uid') for i in range(4)),
+            return_exceptions=True
+        ), 5)
+
+        errors = [r for r in results if isinstance(r, Exception)]
+        self.assertEqual([str(e) for e in errors], ['сеть недоступна'])
+        paths = [r for r in results if not isinstance(r, Exception)]
+        self.assertEqual(len(paths), 3)
+        for path in paths:
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), 'содержимое'.encode())
+        # Упавшую загрузку повторил один запрос, остальные получили его файл
+        self.assertEqual(self.fetches, 2)
+        self.assertEqual(self.store.hits, 2)
+        self.assertEqual(self.store._inflight, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+# Проверка объединения изменений сообщения о ходе заявки.
+#
+# Запуск:
+#   python -m unittest discover tests
+import asyncio
+import os
+import sys
+import unittest
+
+from telegram.error import BadRequest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from live_message import LiveMessage
+
+
+class FakeMessage:
+    def __init__(self, message_id):
+        self.message_id = message_id
+
+
+class FakeBot:
+    def __init__(self, edit_error=None):
+        self.calls = []
+        self.edit_error = edit_error
+
+    async def edit_message_text(self, chat_id, message_id, text, reply_markup=None):
+        self.calls.append(('edit', message_id, text))
+        await asyncio.sleep(0.01)
+        if self.edit_error:
+            raise self.edit_error
+
+    async def delete_message(self, chat_id, message_id):
+        self.calls.append(('delete', message_id))
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        self.calls.append(('send', text))
+        return FakeMessage(100)
+
+
+class LiveMessageTest(unittest.IsolatedAsyncioTestCase):
+    async def test_burst_gives_one_edit(self):
+        live, bot, user_data = LiveMessage(delay=0.05), FakeBot(), {'last_message_id': 1}
+        for i in range(5):
+            self.assertIsNone(await live.show(bot, 1, user_data, f'вложений: {i + 1}'))
+        self.assertEqual(bot.calls, [])
+        await asyncio.sleep(0.2)
+        self.assertEqual(bot.calls, [('edit', 1, 'вложений: 5')])
+        self.assertEqual(live.stats(), {'edits': 1, 'sends': 0, 'coalesced': 4})
+
+    async def test_changes_during_edit_are_sent_after_it(self):
+        live, bot, user_data = LiveMessage(delay=0.01), FakeBot(), {'last_message_id': 1}
+        await live.show(bot, 1, user_data, 'a')
+        await asyncio.sleep(0.015)  # изменение «a» уже отправляется
+        await live.show(bot, 1, user_data, 'b')
+        await live.show(bot, 1, user_data, 'c')
+        await asyncio.sleep(0.1)
+        self.assertEqual(bot.calls, [('edit', 1, 'a'), ('edit', 1, 'c')])
+
+    async def test_wait_sends_latest_immediately(self):
+        live, bot, user_data = LiveMessage(delay=10), FakeBot(), {'last_message_id': 1}
+        await live.show(bot, 1, user_data, 'промежуточный')
+        message_id = await asyncio.wait_for(live.show(bot, 1, user_data, 'итог', wait=True), 1)
+        self.assertEqual(message_id, 1)
+        self.assertEqual(bot.calls, [('edit', 1, 'итог')])
+
+    async def test_discard_drops_pending_edit(self):
+        live, bot, user_data = LiveMessage(delay=10), FakeBot(), {'last_message_id': 1}
+        await live.show(bot, 1, user_data, 'устаревший')
+        await asyncio.wait_for(live.discard(1), 1)
+        self.assertEqual(bot.calls, [])
+        self.assertEqual(live.stats()['edits'], 0)
+
+    async def test_unchangeable_message_is_replaced(self):
+        live, user_data = LiveMessage(delay=0), {'last_message_id': 1}
+        bot = FakeBot(edit_error=BadRequest('Message to edit not found'))
+        self.assertEqual(await live.show(bot, 1, user_data, 'текст', wait=True), 100)
+        self.assertEqual(bot.calls, [('edit', 1, 'текст'), ('delete', 1), ('send', 'текст')])
+        self.assertEqual(user_data['last_message_id'], 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
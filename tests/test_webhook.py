@@ -0,0 +1,87 @@
+# Проверка ограничения webhook при параллельной обработке обновлений.
+#
+# Запуск:
+#   python -m unittest discover tests
+import asyncio
+import os
+import socket
+import sys
+import unittest
+
+from aiohttp.test_utils import TestClient, TestServer
+from telegram import Update
+from telegram.ext import ApplicationBuilder, TypeHandler
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from fake_telegram import FakeBotApi, make_message_update
+from update_processor import ChatOrderedUpdateProcessor
+from webhook import SECRET_HEADER, create_webhook_app
+
+SECRET = 'test-secret'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class WebhookBackpressureTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.api = FakeBotApi()
+        base_url = await self.api.start(port=free_port())
+        # Семафор базового класса пропускает два обновления, остальные ждут его в задачах приложения
+        self.processor = ChatOrderedUpdateProcessor(max_concurrent=2, backlog_limit=2)
+        self.application = (
+            ApplicationBuilder().token('123456:TEST').updater(None)
+            .base_url(f"{base_url}/bot").base_file_url(f"{base_url}/file/bot")
+            .concurrent_updates(self.processor).build()
+        )
+        self.release = asyncio.Event()
+
+        async def blocked(update, context):
+            await self.release.wait()
+
+        self.application.add_handler(TypeHandler(Update, blocked))
+        await self.application.initialize()
+        await self.application.start()
+        self.client = TestClient(TestServer(create_webhook_app(self.application, SECRET, path='/telegram', queue_limit=5)))
+        await self.client.start_server()
+
+    async def asyncTearDown(self):
+        self.release.set()
+        await self.client.close()
+        await self.application.stop()
+        await self.application.shutdown()
+        await self.api.stop()
+
+    async def post(self, user_id):
+        response = await self.client.post('/telegram', json=make_message_update(user_id, 'текст'),
+                                          headers={SECRET_HEADER: SECRET})
+        return response.status
+
+    async def wait_backlog(self, count, timeout=5):
+        deadline = asyncio.get_running_loop().time() + timeout
+        while self.processor.backlog != count or self.application.update_queue.qsize():
+            if asyncio.get_running_loop().time() > deadline:
+                self.fail(f"backlog {self.processor.backlog}, в очереди {self.application.update_queue.qsize()}")
+            await asyncio.sleep(0.01)
+
+    async def test_rejects_when_backlog_full(self):
+        for user_id in range(5):
+            self.assertEqual(await self.post(950100 + user_id), 200)
+        # Очередь приложения пуста: все обновления уже разобраны по задачам
+        await self.wait_backlog(5)
+        self.assertEqual(self.processor.stats()['active'], 2)
+        self.assertEqual(await self.post(950105), 503)
+
+        self.release.set()
+        await self.wait_backlog(0)
+        self.assertEqual(await self.post(950105), 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
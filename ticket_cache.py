@@ -0,0 +1,66 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+# Страницы «Мои заявки» в памяти процесса: user_id -> {курсор страницы: страница}.
+# Хранится не больше max_users пользователей, давно не заходившие вытесняются первыми (LRU).
+# Записи пользователя сбрасываются при изменении его заявок; ttl ограничивает устаревание
+# из-за изменений, сделанных другими процессами бота.
+class UserTicketCache:
+    def __init__(self, max_users=1000, ttl=60.0):
+        self.max_users = max_users
+        self.ttl = ttl
+        self._users = OrderedDict()     # user_id -> (время загрузки, {курсор: страница})
+        self._version = 0               # растёт при каждой инвалидации
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    # Страница из кэша или None. Второе значение — версия, которую нужно передать в put.
+    def get(self, user_id, key):
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is not None and self.ttl and time.monotonic() - entry[0] >= self.ttl:
+                del self._users[user_id]
+                entry = None
+            if entry is not None and key in entry[1]:
+                self._users.move_to_end(user_id)
+                self.hits += 1
+                return entry[1][key], None
+            self.misses += 1
+            return None, self._version
+
+    def put(self, user_id, key, page, version):
+        if not self.max_users:
+            return
+        with self._lock:
+            # Если во время загрузки пришла инвалидация, страница может быть устаревшей:
+            # её показываем, но не кэшируем
+            if version != self._version:
+                return
+            entry = self._users.get(user_id)
+            if entry is None:
+                entry = self._users[user_id] = (time.monotonic(), {})
+            entry[1][key] = page
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._users.pop(user_id, None)
+            self._version += 1
+            self.invalidations += 1
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'evictions': self.evictions,
+            'size': len(self._users),
+        }
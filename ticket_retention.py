@@ -0,0 +1,44 @@
+import logging
+import os
+
+from dotenv import load_dotenv
+
+from async_db import create_ticket_partitions, archive_resolved_tickets, drop_empty_ticket_partitions
+from coordination import leader_only
+
+# Загружаем переменные из .env
+load_dotenv()
+
+# Как часто обслуживать таблицу заявок (разделы, архив), с
+TICKET_MAINTENANCE_INTERVAL = float(os.getenv("TICKET_MAINTENANCE_INTERVAL", "3600"))
+# Решённые заявки старше стольких дней переносятся в архив; 0 — не архивировать
+TICKET_ARCHIVE_AFTER_DAYS = int(os.getenv("TICKET_ARCHIVE_AFTER_DAYS", "180"))
+# Сколько заявок переносить одной транзакцией
+TICKET_ARCHIVE_BATCH = int(os.getenv("TICKET_ARCHIVE_BATCH", "1000"))
+
+logger = logging.getLogger(__name__)
+
+
+# Периодическая задача: создаёт разделы заявок на следующие месяцы, переносит старые решённые
+# заявки в tickets_archive небольшими транзакциями и удаляет опустевшие старые разделы.
+# Выполняется только на лидере.
+@leader_only
+async def maintain_tickets(context):
+    created = await create_ticket_partitions()
+    if created:
+        logger.info(f"Созданы разделы заявок: {', '.join(created)}")
+    if TICKET_ARCHIVE_AFTER_DAYS <= 0:
+        return
+
+    archived = 0
+    while True:
+        moved = await archive_resolved_tickets(TICKET_ARCHIVE_AFTER_DAYS, TICKET_ARCHIVE_BATCH)
+        archived += moved
+        if moved < TICKET_ARCHIVE_BATCH:
+            break
+    if archived:
+        logger.info(f"Перенесено в архив решённых заявок: {archived}")
+
+    dropped = await drop_empty_ticket_partitions(TICKET_ARCHIVE_AFTER_DAYS)
+    if dropped:
+        logger.info(f"Удалены пустые разделы заявок: {', '.join(dropped)}")
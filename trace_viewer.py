@@ -0,0 +1,180 @@
+# Сводка по медленным трассам, которые бот пишет при TRACE_ENABLED=1:
+# время по обработчикам, по видам интервалов (БД, Bot API, лимиты, загрузки),
+# самые медленные обновления и самые частые стеки из профиля.
+#
+# Пример:
+#   python trace_viewer.py
+#   python trace_viewer.py traces/slow_updates.jsonl --top 5
+#   python trace_viewer.py --trace 123456789
+import argparse
+import json
+import os
+from collections import Counter, defaultdict
+
+from tracing import TRACE_FILE, TRACE_FILE_BACKUPS
+
+
+# Файл и его ротированные копии, от старых к новым
+def trace_files(path, backups):
+    files = [f"{path}.{i}" for i in range(backups, 0, -1)] + [path]
+    return [name for name in files if os.path.exists(name)]
+
+
+def load_traces(files):
+    traces = []
+    for name in files:
+        with open(name, encoding='utf-8') as f:
+            for number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    traces.append(json.loads(line))
+                except ValueError:
+                    print(f"Пропущена повреждённая строка {name}:{number}")
+    return traces
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+# Имя обработчика — первый интервал вида handler
+def handler_name(trace):
+    for span in trace['spans']:
+        if span['kind'] == 'handler':
+            return span['name']
+    return '(без обработчика)'
+
+
+# Собственное время интервалов: длительность минус вложенные интервалы.
+# Вложенные интервалы могут идти параллельно, поэтому результат не меньше нуля.
+def self_times(trace):
+    spans = trace['spans']
+    child_time = defaultdict(float)
+    for span in spans:
+        if span['parent'] is not None and span['duration'] is not None:
+            child_time[span['parent']] += span['duration']
+    for index, span in enumerate(spans):
+        duration = span['duration'] or 0.0
+        yield span, max(0.0, duration - child_time[index])
+
+
+def ms(seconds):
+    return f"{seconds * 1000:.1f} мс"
+
+
+def print_tree(trace, indent='    '):
+    spans = trace['spans']
+    children = defaultdict(list)
+    for index, span in enumerate(spans):
+        children[span['parent']].append(index)
+
+    def walk(parent, depth):
+        for index in children[parent]:
+            span = spans[index]
+            error = f" !{span['error']}" if span['error'] else ''
+            duration = ms(span['duration']) if span['duration'] is not None else 'не завершён'
+            print(f"{indent}{'  ' * depth}+{ms(span['start'])} {span['kind']}:{span['name']} {duration}{error}")
+            walk(index, depth + 1)
+
+    walk(None, 0)
+    if trace.get('dropped_spans'):
+        print(f"{indent}... ещё интервалов не записано: {trace['dropped_spans']}")
+
+
+# Стеки длинные из-за python-telegram-bot и httpx, поэтому печатаем только
+# depth кадров со стороны места ожидания
+def print_stack(stack, depth, indent):
+    if depth and len(stack) > depth:
+        print(f"{indent}... ещё кадров: {len(stack) - depth}")
+        stack = stack[-depth:]
+    for frame in stack:
+        print(f"{indent}{frame}")
+
+
+def print_trace(trace, samples=3, depth=0):
+    error = f", ошибка {trace['error']}" if trace.get('error') else ''
+    print(f"  обновление {trace['update_id']} ({trace['key']}): {ms(trace['duration'])}, "
+          f"в очереди {ms(trace['wait'])}{error}")
+    print_tree(trace)
+    for sample in trace['samples'][:samples]:
+        print(f"    стек x{sample['count']}:")
+        print_stack(sample['stack'], depth, '      ')
+
+
+def summarize(traces, top, depth):
+    durations = [trace['duration'] for trace in traces]
+    print(f"Медленных обновлений: {len(traces)}, p50 {ms(percentile(durations, 0.5))}, "
+          f"p95 {ms(percentile(durations, 0.95))}, max {ms(max(durations))}")
+
+    by_handler = defaultdict(list)
+    for trace in traces:
+        by_handler[handler_name(trace)].append(trace['duration'])
+    print("\nПо обработчикам:")
+    print(f"  {'обработчик':<24} {'кол-во':>7} {'p50':>11} {'p95':>11} {'max':>11}")
+    for name, values in sorted(by_handler.items(), key=lambda item: -sum(item[1])):
+        print(f"  {name:<24} {len(values):>7} {ms(percentile(values, 0.5)):>11} "
+              f"{ms(percentile(values, 0.95)):>11} {ms(max(values)):>11}")
+
+    by_kind = defaultdict(float)
+    by_span = defaultdict(lambda: [0, 0.0])
+    for trace in traces:
+        for span, own in self_times(trace):
+            by_kind[span['kind']] += own
+            entry = by_span[(span['kind'], span['name'])]
+            entry[0] += 1
+            entry[1] += span['duration'] or 0.0
+    total = sum(by_kind.values()) or 1.0
+    print("\nСобственное время по видам интервалов:")
+    for kind, seconds in sorted(by_kind.items(), key=lambda item: -item[1]):
+        print(f"  {kind:<12} {ms(seconds):>12} {seconds / total:>6.0%}")
+
+    print(f"\nСамые долгие интервалы (по сумме, топ {top}):")
+    for (kind, name), (count, seconds) in sorted(by_span.items(), key=lambda item: -item[1][1])[:top]:
+        print(f"  {kind}:{name:<30} {count:>6} раз, всего {ms(seconds)}, в среднем {ms(seconds / count)}")
+
+    stacks = Counter()
+    for trace in traces:
+        for sample in trace['samples']:
+            stacks[tuple(sample['stack'])] += sample['count']
+    if stacks:
+        print(f"\nЧастые стеки медленных обновлений (топ {top}):")
+        for stack, count in stacks.most_common(top):
+            print(f"  x{count}:")
+            print_stack(stack, depth, '    ')
+
+    print(f"\nСамые медленные обновления (топ {top}):")
+    for trace in sorted(traces, key=lambda trace: -trace['duration'])[:top]:
+        print_trace(trace, samples=1, depth=depth)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Сводка по медленным трассам обновлений")
+    parser.add_argument('path', nargs='?', default=TRACE_FILE, help="файл трасс (ротированные копии читаются тоже)")
+    parser.add_argument('--backups', type=int, default=TRACE_FILE_BACKUPS, help="сколько ротированных копий читать")
+    parser.add_argument('--top', type=int, default=10, help="сколько строк выводить в списках")
+    parser.add_argument('--depth', type=int, default=12, help="сколько кадров стека показывать; 0 — все")
+    parser.add_argument('--handler', help="только обновления этого обработчика")
+    parser.add_argument('--trace', type=int, metavar='UPDATE_ID', help="подробности по одному обновлению")
+    args = parser.parse_args()
+
+    files = trace_files(args.path, args.backups)
+    if not files:
+        parser.exit(1, f"Файл трасс не найден: {args.path}\n")
+    traces = load_traces(files)
+    if args.handler:
+        traces = [trace for trace in traces if handler_name(trace) == args.handler]
+    if args.trace is not None:
+        traces = [trace for trace in traces if trace['update_id'] == args.trace]
+        if not traces:
+            parser.exit(1, f"Обновление {args.trace} не найдено\n")
+        for trace in traces:
+            print_trace(trace, samples=len(trace['samples']), depth=args.depth)
+    elif traces:
+        summarize(traces, args.top, args.depth)
+    else:
+        print("Медленных обновлений нет")
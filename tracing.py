@@ -0,0 +1,190 @@
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+import os
+import time
+from contextlib import asynccontextmanager, contextmanager
+from logging.handlers import RotatingFileHandler
+
+from dotenv import load_dotenv
+
+# Загружаем переменные из .env
+load_dotenv()
+
+# Трассировка обновлений: 1 — включена; без неё обёртки не устанавливаются
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "0") == "1"
+# Обновления дольше этого времени записываются в файл и профилируются, с
+TRACE_SLOW_THRESHOLD = float(os.getenv("TRACE_SLOW_THRESHOLD", "2"))
+# Файл медленных трасс (JSON по строке на трассу) и его ротация
+TRACE_FILE = os.getenv("TRACE_FILE", "traces/slow_updates.jsonl")
+TRACE_FILE_MAX_BYTES = int(os.getenv("TRACE_FILE_MAX_BYTES", str(10 * 1024 * 1024)))
+TRACE_FILE_BACKUPS = int(os.getenv("TRACE_FILE_BACKUPS", "5"))
+# Как часто снимать стек медленного обновления, с
+TRACE_SAMPLE_INTERVAL = float(os.getenv("TRACE_SAMPLE_INTERVAL", "0.05"))
+
+# Больше интервалов в одной трассе не записываем, чтобы зациклившийся обработчик не съел память
+MAX_SPANS = 1000
+
+logger = logging.getLogger(__name__)
+
+_trace = contextvars.ContextVar('trace', default=None)
+_span = contextvars.ContextVar('trace_span', default=None)
+_active = set()
+_sampler = None
+_writer = None
+
+
+# Трасса одного обновления: интервалы (вид, имя, начало, длительность, родитель, ошибка)
+# отсчитываются от начала обработки
+class _Trace:
+    def __init__(self, update_id, key, wait):
+        self.update_id = update_id
+        self.key = key
+        self.wait = wait
+        self.started = time.perf_counter()
+        self.wall_started = time.time()
+        self.spans = []
+        self.dropped = 0
+        self.samples = {}       # стек ожидания (кортеж кадров) -> число снимков
+        self.task = asyncio.current_task()
+        self.closed = False
+
+    def to_dict(self, duration, error):
+        return {
+            'time': self.wall_started,
+            'update_id': self.update_id,
+            'key': self.key,
+            'duration': duration,
+            'wait': self.wait,
+            'error': error,
+            'spans': [
+                {'kind': kind, 'name': name, 'start': start, 'duration': length, 'parent': parent, 'error': span_error}
+                for kind, name, start, length, parent, span_error in self.spans
+            ],
+            'dropped_spans': self.dropped,
+            'samples': [
+                {'stack': list(stack), 'count': count}
+                for stack, count in sorted(self.samples.items(), key=lambda item: -item[1])
+            ],
+        }
+
+
+def _get_writer():
+    global _writer
+    if _writer is None:
+        directory = os.path.dirname(os.path.abspath(TRACE_FILE))
+        os.makedirs(directory, exist_ok=True)
+        handler = RotatingFileHandler(TRACE_FILE, maxBytes=TRACE_FILE_MAX_BYTES,
+                                      backupCount=TRACE_FILE_BACKUPS, encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        _writer = logging.getLogger('tracing.slow')
+        _writer.setLevel(logging.INFO)
+        _writer.propagate = False
+        _writer.addHandler(handler)
+    return _writer
+
+
+# Стек ожидания задачи: цепочка корутин от обработчика до места, где она сейчас ждёт
+def _task_stack(task):
+    stack = []
+    coro = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+        if frame is None:
+            break
+        code = frame.f_code
+        stack.append(f"{os.path.basename(code.co_filename)}:{frame.f_lineno} {code.co_name}")
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+    return tuple(stack)
+
+
+# Снимает стеки обновлений, которые обрабатываются дольше порога
+async def _sample():
+    while _active:
+        await asyncio.sleep(TRACE_SAMPLE_INTERVAL)
+        now = time.perf_counter()
+        for trace in list(_active):
+            if now - trace.started >= TRACE_SLOW_THRESHOLD and trace.task is not None and not trace.task.done():
+                stack = _task_stack(trace.task)
+                if stack:
+                    trace.samples[stack] = trace.samples.get(stack, 0) + 1
+
+
+def _ensure_sampler():
+    global _sampler
+    if _sampler is None or _sampler.done():
+        _sampler = asyncio.get_running_loop().create_task(_sample())
+
+
+# Трасса обработки одного обновления. Медленная трасса записывается в TRACE_FILE.
+@asynccontextmanager
+async def trace_update(update_id, key=None, wait=0.0):
+    if not TRACE_ENABLED:
+        yield
+        return
+    trace = _Trace(update_id, key, wait)
+    token = _trace.set(trace)
+    span_token = _span.set(None)
+    _active.add(trace)
+    _ensure_sampler()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        _active.discard(trace)
+        trace.closed = True
+        _span.reset(span_token)
+        _trace.reset(token)
+        duration = time.perf_counter() - trace.started
+        if duration >= TRACE_SLOW_THRESHOLD:
+            try:
+                _get_writer().info(json.dumps(trace.to_dict(duration, error), ensure_ascii=False))
+            except Exception as e:
+                logger.error(f"Ошибка записи трассы обновления {update_id}: {e}")
+
+
+# Интервал внутри текущей трассы: with span('db', 'save_ticket'): ...
+@contextmanager
+def span(kind, name):
+    trace = _trace.get()
+    if trace is None or trace.closed:
+        yield
+        return
+    if len(trace.spans) >= MAX_SPANS:
+        trace.dropped += 1
+        yield
+        return
+    started = time.perf_counter()
+    record = [kind, name, started - trace.started, None, _span.get(), None]
+    index = len(trace.spans)
+    trace.spans.append(record)
+    token = _span.set(index)
+    try:
+        yield
+    except BaseException as e:
+        record[5] = type(e).__name__
+        raise
+    finally:
+        record[3] = time.perf_counter() - started
+        _span.reset(token)
+
+
+# Обёртка асинхронной функции: её вызов становится интервалом трассы.
+# Если трассировка выключена, возвращается сама функция.
+def traced(kind, name=None):
+    def decorator(func):
+        if not TRACE_ENABLED:
+            return func
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(kind, span_name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+
+from dotenv import load_dotenv
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from tracing import trace_update
+
+# Загружаем переменные из .env
+load_dotenv()
+
+# Сколько обновлений разных пользователей обрабатывается одновременно
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "32"))
+# Сколько обновлений может одновременно находиться в обработке или ожидании своей очереди;
+# следующие ждут в задачах приложения (их учитывает backlog)
+UPDATE_BACKLOG_LIMIT = int(os.getenv("UPDATE_BACKLOG_LIMIT", "1000"))
+# Ожидание дольше этого времени записывается в лог, с
+UPDATE_WAIT_WARNING = float(os.getenv("UPDATE_WAIT_WARNING", "5"))
+
+logger = logging.getLogger(__name__)
+
+
+# Ключ очереди обновления: пользователь (его user_data меняют обработчики), иначе чат
+def update_key(update):
+    if isinstance(update, Update):
+        if update.effective_user is not None:
+            return update.effective_user.id
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+    return None
+
+
+# Параллельная обработка обновлений с сохранением порядка внутри одного пользователя.
+# Обновления разных пользователей обрабатываются одновременно (не больше max_concurrent),
+# а обновления одного пользователя — строго по очереди, в порядке получения.
+# Слот общего лимита занимается только после того, как подошла очередь пользователя,
+# поэтому один пользователь с пачкой сообщений не занимает слоты остальных.
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent=MAX_CONCURRENT_UPDATES, backlog_limit=UPDATE_BACKLOG_LIMIT,
+                 wait_warning=UPDATE_WAIT_WARNING):
+        # Семафор базового класса ограничивает число обновлений в обработке и в ожидании
+        super().__init__(max(backlog_limit, max_concurrent, 2))
+        self.max_concurrent = max_concurrent
+        self.wait_warning = wait_warning
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._chats = {}    # ключ -> [блокировка, число обновлений в обработке и ожидании]
+        self.backlog = 0    # все полученные и ещё не обработанные обновления, включая ждущие семафор базового класса
+        self.active = 0
+        self.waiting = 0
+        self.processed = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    # Очередь одного пользователя; можно занять и вне обработчика, например из фоновой задачи
+    @asynccontextmanager
+    async def chat_slot(self, key):
+        if key is None:
+            yield
+            return
+        entry = self._chats.get(key)
+        if entry is None:
+            entry = self._chats[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chats[key]
+
+    # Приложение сразу забирает обновление из update_queue и создаёт для него задачу,
+    # поэтому размер очереди не отражает нагрузку; backlog считается до семафора базового класса
+    async def process_update(self, update, coroutine):
+        self.backlog += 1
+        try:
+            await super().process_update(update, coroutine)
+        finally:
+            self.backlog -= 1
+
+    async def do_process_update(self, update, coroutine):
+        started = time.monotonic()
+        self.waiting += 1
+        queued = True
+        try:
+            async with self.chat_slot(update_key(update)):
+                async with self._slots:
+                    queued = False
+                    self.waiting -= 1
+                    wait = time.monotonic() - started
+                    self._record_wait(wait, update)
+                    self.active += 1
+                    try:
+                        update_id = update.update_id if isinstance(update, Update) else None
+                        async with trace_update(update_id, update_key(update), wait):
+                            await coroutine
+                    finally:
+                        self.active -= 1
+                        self.processed += 1
+        finally:
+            if queued:
+                # Обновление отменено, не дождавшись своей очереди
+                self.waiting -= 1
+                coroutine.close()
+
+    def _record_wait(self, wait, update):
+        self.wait_time += wait
+        self.max_wait = max(self.max_wait, wait)
+        if self.wait_warning and wait >= self.wait_warning:
+            update_id = update.update_id if isinstance(update, Update) else None
+            logger.warning(f"Обновление {update_id} ждало обработки {wait:.1f} с (в очереди: {self.waiting})")
+
+    def stats(self):
+        return {
+            'active': self.active,
+            'waiting': self.waiting,
+            'backlog': self.backlog,
+            'chats': len(self._chats),
+            'processed': self.processed,
+            'avg_wait': self.wait_time / self.processed if self.processed else 0.0,
+            'max_wait': self.max_wait,
+        }
@@ -0,0 +1,118 @@
+import asyncio
+import hmac
+import logging
+import os
+import secrets
+
+from aiohttp import web
+from dotenv import load_dotenv
+from telegram import Update
+
+from coordination import install_stop_signals
+
+# Загружаем переменные из .env
+load_dotenv()
+
+# Режим получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+
+# Параметры webhook. Бот слушает локальный HTTP-адрес; TLS завершается на обратном прокси.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")                           # публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")                     # обязателен, если экземпляров несколько
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))  # параллельных соединений от Telegram (1-100)
+WEBHOOK_QUEUE_LIMIT = int(os.getenv("WEBHOOK_QUEUE_LIMIT", "1000"))        # при таком числе необработанных обновлений отвечаем 503
+WEBHOOK_REGISTER = os.getenv("WEBHOOK_REGISTER", "1") == "1"     # вызывать setWebhook, став лидером
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+logger = logging.getLogger(__name__)
+
+# Необработанные обновления: в очереди приложения и в задачах, созданных для параллельной обработки
+def pending_updates(application):
+    return application.update_queue.qsize() + getattr(application.update_processor, 'backlog', 0)
+
+# HTTP-приложение, принимающее обновления от Telegram и передающее их в очередь бота
+def create_webhook_app(application, secret, path=WEBHOOK_PATH, queue_limit=WEBHOOK_QUEUE_LIMIT):
+    async def handle_update(request):
+        token = request.headers.get(SECRET_HEADER, '')
+        if not hmac.compare_digest(token.encode(), secret.encode()):
+            logger.warning(f"Отклонён запрос к webhook с неверным секретом от {request.remote}")
+            return web.Response(status=403)
+        # Telegram повторит доставку позже, а очередь не будет расти бесконечно
+        if queue_limit and pending_updates(application) >= queue_limit:
+            return web.Response(status=503)
+        try:
+            data = await request.json()
+            update = Update.de_json(data, application.bot)
+        except Exception as e:
+            logger.error(f"Некорректное обновление в webhook: {e}")
+            return web.Response(status=400)
+        await application.update_queue.put(update)
+        return web.Response()
+
+    async def health(request):
+        return web.Response(text='ok')
+
+    app = web.Application()
+    app.router.add_post(path, handle_update)
+    app.router.add_get('/healthz', health)
+    return app
+
+# Запуск бота в режиме webhook: тот же жизненный цикл, что у run_polling,
+# но обновления приходят на встроенный HTTP-сервер. Обрабатывать обновления могут
+# несколько экземпляров за балансировщиком; webhook регистрирует только лидер.
+async def run_webhook(application, elector, stop_event=None):
+    if not WEBHOOK_SECRET and not WEBHOOK_REGISTER:
+        raise RuntimeError("Без регистрации webhook (WEBHOOK_REGISTER=0) нужно указать WEBHOOK_SECRET")
+    if WEBHOOK_REGISTER and not WEBHOOK_URL:
+        raise RuntimeError("Для режима webhook нужно указать WEBHOOK_URL")
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    stop_event = stop_event or asyncio.Event()
+    install_stop_signals(stop_event)
+
+    async def register_webhook():
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=secret,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES
+        )
+        logger.info(f"Webhook зарегистрирован: {WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH}")
+
+    if WEBHOOK_REGISTER:
+        elector.on_elected(register_webhook)
+
+    runner = web.AppRunner(create_webhook_app(application, secret))
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+
+        await runner.setup()
+        site = web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT)
+        await site.start()
+        await application.start()
+        await elector.start()
+        # Лидер уже есть — значит, экземпляров несколько, и случайный секрет этого экземпляра
+        # не совпадёт с зарегистрированным: все переданные ему обновления получили бы 403
+        if not WEBHOOK_SECRET and not elector.is_leader:
+            raise RuntimeError("Запущено несколько экземпляров в режиме webhook: укажите одинаковый WEBHOOK_SECRET у всех")
+        logger.info(f"Webhook слушает http://{WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+        try:
+            await stop_event.wait()
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            pass
+    finally:
+        await elector.stop()
+        await runner.cleanup()
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)